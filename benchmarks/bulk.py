@@ -0,0 +1,51 @@
+"""Compare per-sample and bulk histogram updates.
+
+Reports the cost per sample of `update_histogram` and
+`update_histogram_many`, and the cost of summarizing a full uniform reservoir
+at report time with and without NumPy.
+
+Run with ``python -m benchmarks.bulk``.
+"""
+from __future__ import absolute_import, division, print_function
+
+import random
+import timeit
+
+import mock
+from appmetrics import metrics as appmetrics
+
+import ss_metrics.histogram
+from ss_metrics import metrics
+
+SAMPLES = 100000
+
+
+def main():
+    rng = random.Random(0)
+    values = [rng.lognormvariate(0, 1) for _ in range(SAMPLES)]
+    numpy = ss_metrics.histogram.get_numpy()
+    if numpy is not None:
+        array = numpy.array(values)
+    else:
+        array = values
+    cases = (
+        ('update_histogram',
+         lambda: [metrics.update_histogram('single', v) for v in values]),
+        ('update_histogram_many',
+         lambda: metrics.update_histogram_many('bulk', array)),
+    )
+    print('{:<24} {:>12}'.format('update', 'us / sample'))
+    for name, update in cases:
+        elapsed = min(timeit.repeat(update, number=1, repeat=3))
+        print('{:<24} {:>12.3f}'.format(name, elapsed / SAMPLES * 1e6))
+
+    histogram = appmetrics.metric('bulk')
+    print('\n{:<24} {:>12}'.format('summary', 'get (ms)'))
+    for name, module in (('numpy', numpy), ('appmetrics', None)):
+        with mock.patch.object(ss_metrics.histogram, 'numpy', module):
+            get = min(timeit.repeat(histogram.get, number=10, repeat=3)) / 10
+        print('{:<24} {:>12.3f}'.format(name, get * 1e3))
+
+
+if __name__ == '__main__':
+    main()
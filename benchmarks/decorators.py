@@ -0,0 +1,44 @@
+"""Compare the per-call overhead of the instrumentation decorators.
+
+Run with ``python -m benchmarks.decorators``.
+"""
+from __future__ import absolute_import, print_function
+
+import timeit
+
+from ss_metrics import metrics
+
+NUMBER = 100000
+REPEAT = 5
+
+
+def undecorated():
+    pass
+
+
+@metrics.timed
+def timed():
+    pass
+
+
+@metrics.with_meter
+def metered():
+    pass
+
+
+def best_per_call(fn, number=NUMBER, repeat=REPEAT):
+    """Return the best observed time, in seconds, of a single call to fn."""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def main():
+    baseline = best_per_call(undecorated)
+    print('{:<12} {:>10.3f} us'.format('undecorated', baseline * 1e6))
+    for name, fn in (('timed', timed), ('with_meter', metered)):
+        per_call = best_per_call(fn)
+        print('{:<12} {:>10.3f} us (+{:.3f} us)'.format(
+            name, per_call * 1e6, (per_call - baseline) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""Measure the overhead of the instrumentation hot paths and catch regressions.
+
+Covers the per-call cost of the recording functions and decorators on one
+and on several threads, the duration and payload size of a `LibratoReporter`
+cycle as the registry grows and the memory held per metric. Submissions go
+to a stubbed librato connection, so no network access is needed.
+
+Run with ``python -m benchmarks.hotpath``. ``--save`` records the results as
+the baseline and ``--check`` exits with an error if any result is worse than
+the baseline by more than ``--threshold``, or warns when there is no
+baseline yet. Memory is only measured where `tracemalloc` is available.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import sys
+import threading
+import timeit
+
+import mock
+from appmetrics import metrics as appmetrics
+from appmetrics import reporter as appmetrics_reporter
+
+from ss_metrics import metrics
+from ss_metrics.reporter import LibratoReporter
+
+from .decorators import best_per_call
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Timings on a shared machine easily vary by a third between runs
+DEFAULT_THRESHOLD = 0.5
+NUMBER = 20000
+REPEAT = 5
+THREADS = 4
+REGISTRY_SIZES = (100, 1000, 10000)
+MEMORY_METRICS = 1000
+
+
+@metrics.timed
+def timed():
+    pass
+
+
+@metrics.with_meter
+def metered():
+    pass
+
+
+TIMER = metrics.timer('bench.timer')
+
+
+def timer_block():
+    with TIMER:
+        pass
+
+
+def timer_token():
+    TIMER.stop(TIMER.start())
+
+
+CALLS = (
+    ('timed', timed),
+    ('timer', timer_block),
+    ('timer_token', timer_token),
+    ('with_meter', metered),
+    ('inc_meter', lambda: metrics.inc_meter('bench.meter')),
+    ('gauge', lambda: metrics.gauge('bench.gauge', 1)),
+    ('update_histogram', lambda: metrics.update_histogram('bench.hist', 1.0)),
+)
+
+
+class _StubConnection(object):
+    """Stands in for `KeepAliveConnection`, counting the bytes posted."""
+
+    posted = 0
+
+    def __init__(self, librato_api):
+        pass
+
+    def post(self, chunk):
+        _StubConnection.posted += len(json.dumps(chunk))
+        return 200
+
+    def close(self):
+        pass
+
+
+def threaded_per_call(fn, threads=THREADS, number=NUMBER, repeat=REPEAT):
+    """Return the best observed wall time per call with concurrent callers."""
+    def run():
+        workers = [
+            threading.Thread(target=lambda: [fn() for _ in range(number)])
+            for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / (
+        threads * number)
+
+
+def populate(size):
+    """Fill the registry with `size` metrics, a third of each kind."""
+    for index in range(size):
+        kind = index % 3
+        name = 'bench.metric.{}'.format(index)
+        if kind == 0:
+            metrics.gauge(name, index)
+        elif kind == 1:
+            metrics.inc_meter(name, index)
+        else:
+            metrics.update_histogram_many(name, range(10))
+
+
+def bench_calls(results):
+    for name, fn in CALLS:
+        results['call.{}'.format(name)] = best_per_call(fn, NUMBER) * 1e6
+        results['threaded.{}'.format(name)] = threaded_per_call(fn) * 1e6
+
+
+def bench_reporter(results):
+    for size in REGISTRY_SIZES:
+        populate(size)
+        with mock.patch(
+                'ss_metrics.reporter.KeepAliveConnection', _StubConnection):
+            reporter = LibratoReporter(
+                'bench@example.com', 'token', pool_size=1)
+
+        def cycle():
+            reporter(appmetrics_reporter.get_metrics(None))
+
+        cycle()
+        _StubConnection.posted = 0
+        duration = min(timeit.repeat(cycle, number=1, repeat=REPEAT))
+        results['cycle.{}'.format(size)] = duration * 1e3
+        results['payload.{}'.format(size)] = (
+            _StubConnection.posted / REPEAT / 1024)
+        appmetrics.REGISTRY.clear()
+
+
+def bench_memory(results):
+    if tracemalloc is None:
+        return
+    for kind, create in (
+            ('gauge', lambda name: metrics.gauge(name, 1)),
+            ('meter', lambda name: metrics.inc_meter(name)),
+            ('histogram', lambda name: metrics.update_histogram(name, 1.0))):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for index in range(MEMORY_METRICS):
+            create('bench.memory.{}'.format(index))
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results['memory.{}'.format(kind)] = (after - before) / MEMORY_METRICS
+        appmetrics.REGISTRY.clear()
+
+
+# Units of each result by prefix, for display
+UNITS = {
+    'call': 'us / call',
+    'threaded': 'us / call',
+    'cycle': 'ms',
+    'payload': 'KB',
+    'memory': 'bytes / metric',
+}
+
+
+def run():
+    """Run every benchmark on an empty registry and return the results."""
+    results = {}
+    with mock.patch.dict(appmetrics.REGISTRY, {}, clear=True):
+        bench_calls(results)
+        appmetrics.REGISTRY.clear()
+        bench_reporter(results)
+        bench_memory(results)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the names of results worse than the baseline by `threshold`.
+
+    Every result is a cost, so higher values are worse.
+    """
+    return sorted(
+        name for name, value in results.items()
+        if name in baseline and value > baseline[name] * (1 + threshold))
+
+
+def report(results, baseline, regressions):
+    print('{:<28} {:>12} {:>12} {:>8}  {}'.format(
+        'benchmark', 'result', 'baseline', 'change', 'unit'))
+    for name in sorted(results):
+        value = results[name]
+        expected = baseline.get(name)
+        if expected:
+            change = '{:+.0%}'.format(value / expected - 1)
+            expected = '{:.3f}'.format(expected)
+        else:
+            change = expected = '-'
+        print('{:<28} {:>12.3f} {:>12} {:>8}  {}{}'.format(
+            name, value, expected, change, UNITS[name.split('.')[0]],
+            '  REGRESSION' if name in regressions else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown, as a fraction')
+    parser.add_argument('--save', action='store_true',
+                        help='record the results as the baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if a result regressed')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif args.check:
+        print('No baseline at {}, so nothing is checked; record one with '
+              '--save'.format(args.baseline), file=sys.stderr)
+    results = run()
+    regressions = compare(results, baseline, args.threshold)
+    report(results, baseline, regressions)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.check and regressions:
+        print('{} benchmarks regressed by more than {:.0%}'.format(
+            len(regressions), args.threshold), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""Compare sketch-backed histograms with appmetrics' uniform reservoir.
+
+Reports the cost of inserting a sample, of summarizing the histogram at
+report time, the approximate memory held and the worst relative error of the
+reported percentiles.
+
+Run with ``python -m benchmarks.sketch``.
+"""
+from __future__ import absolute_import, division, print_function
+
+import random
+import sys
+import timeit
+
+from appmetrics.histogram import Histogram, UniformReservoir
+
+from ss_metrics.sketch import SketchHistogram
+
+SAMPLES = 100000
+
+
+def size_of(histogram):
+    """Approximate the memory held by a histogram's data, in bytes."""
+    if isinstance(histogram, SketchHistogram):
+        bins = histogram.sketch.positive
+        return sys.getsizeof(bins) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) for k, v in bins.items())
+    values = histogram.reservoir._values
+    return sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+
+
+def worst_error(histogram, values):
+    ordered = sorted(values)
+    errors = []
+    for level, estimate in histogram.get()['percentile']:
+        exact = ordered[int(level / 100 * (len(ordered) - 1))]
+        errors.append(abs(estimate - exact) / exact)
+    return max(errors)
+
+
+def main():
+    rng = random.Random(0)
+    values = [rng.lognormvariate(0, 1) for _ in range(SAMPLES)]
+    print('{:<10} {:>12} {:>12} {:>12} {:>12}'.format(
+        'histogram', 'insert (us)', 'get (ms)', 'memory (KB)', 'max error'))
+    for name, factory in (('uniform', lambda: Histogram(UniformReservoir())),
+                          ('ddsketch', SketchHistogram)):
+        histogram = factory()
+        insert = timeit.timeit(
+            lambda: [histogram.notify(v) for v in values], number=1)
+        get = min(timeit.repeat(histogram.get, number=10, repeat=3)) / 10
+        print('{:<10} {:>12.3f} {:>12.3f} {:>12.1f} {:>12.4f}'.format(
+            name, insert / SAMPLES * 1e6, get * 1e3,
+            size_of(histogram) / 1024, worst_error(histogram, values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Measure the cost of importing ss_metrics and of disabled instrumentation.
+
+Imports are timed in fresh interpreters, with and without a reporter. Calls
+are timed with recording enabled and disabled.
+
+Run with ``python -m benchmarks.startup``.
+"""
+from __future__ import absolute_import, print_function
+
+import subprocess
+import sys
+
+import mock
+from appmetrics import metrics as appmetrics
+
+from ss_metrics import metrics
+
+from .decorators import best_per_call
+
+REPEAT = 10
+
+IMPORTS = (
+    ('import ss_metrics', 'import ss_metrics'),
+    ('with LibratoReporter', 'import ss_metrics; ss_metrics.LibratoReporter'),
+)
+
+SCRIPT = '''
+import time
+start = time.time()
+{statement}
+print(time.time() - start)
+'''
+
+
+def import_time(statement, repeat=REPEAT):
+    """Return the best observed time, in seconds, to run `statement` first.
+
+    Each run is in a new interpreter, so that no module is imported yet.
+    """
+    script = SCRIPT.format(statement=statement)
+    return min(
+        float(subprocess.check_output([sys.executable, '-c', script]))
+        for _ in range(repeat))
+
+
+def undecorated():
+    pass
+
+
+def calls():
+    """Return the instrumented calls to time, decorating functions anew."""
+    return (
+        ('timed', metrics.timed(undecorated)),
+        ('with_meter', metrics.with_meter(undecorated)),
+        ('inc_meter', lambda: metrics.inc_meter('bench.meter')),
+        ('gauge', lambda: metrics.gauge('bench.gauge', 1)),
+        ('update_histogram',
+         lambda: metrics.update_histogram('bench.hist', 1.0)),
+    )
+
+
+def main():
+    for name, statement in IMPORTS:
+        print('{:<24} {:>10.1f} ms'.format(
+            name, import_time(statement) * 1e3))
+    with mock.patch.dict(appmetrics.REGISTRY, {}, clear=True):
+        enabled = [(name, best_per_call(fn)) for name, fn in calls()]
+        metrics.set_enabled(False)
+        try:
+            disabled = [best_per_call(fn) for _, fn in calls()]
+        finally:
+            metrics.set_enabled(True)
+    for (name, on), off in zip(enabled, disabled):
+        print('{:<24} {:>10.3f} us enabled {:>10.3f} us disabled'.format(
+            name, on * 1e6, off * 1e6))
+
+
+if __name__ == '__main__':
+    main()
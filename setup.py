@@ -13,8 +13,11 @@ setup(
     packages=['ss_metrics'],
     install_requires=[
         'AppMetrics>=0.5.0',
-        'librato-metrics>=0.8.6',
+        'librato-metrics>=2.1.0',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     platforms='Platform Independent',
     classifiers=[
         'Development Status :: 3 - Alpha',
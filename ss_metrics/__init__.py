@@ -1,13 +1,50 @@
 """Metrics collection and reporting."""
 from __future__ import absolute_import
 
+import importlib
 import logging
+import sys
 
 __all__ = (
-    'gauge', 'inc_meter', 'logger', 'update_histogram', 'timed', 'with_meter',
-    'ConsoleReporter', 'LibratoReporter')
+    'gauge', 'get_sample_rate', 'inc_meter', 'inc_meter_many', 'logger',
+    'series_key', 'set_enabled', 'update_histogram', 'update_histogram_many',
+    'timed', 'timer', 'with_meter', 'BufferedRecorder', 'CardinalityLimiter',
+    'Timer', 'ConsoleReporter', 'LibratoReporter', 'StatsdClient',
+    'StatsdReporter')
 
 logger = logging.getLogger('metrics')
 
-from .metrics import gauge, inc_meter, update_histogram, timed, with_meter  # noqa
-from .reporter import ConsoleReporter, LibratoReporter  # noqa
+from .metrics import (  # noqa
+    gauge, get_sample_rate, inc_meter, inc_meter_many, series_key,
+    set_enabled, update_histogram, update_histogram_many, timed, timer,
+    with_meter, BufferedRecorder, CardinalityLimiter, Timer)
+
+# Reporters, by the module they are imported from on first use, as that
+# imports librato and its HTTP stack
+_LAZY = {
+    'ConsoleReporter': 'reporter',
+    'LibratoReporter': 'reporter',
+    'StatsdClient': 'statsd',
+    'StatsdReporter': 'statsd',
+}
+
+
+def __getattr__(name):
+    try:
+        module = _LAZY[name]
+    except KeyError:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported, so reporters are imported eagerly
+    from .reporter import ConsoleReporter, LibratoReporter  # noqa
+    from .statsd import StatsdClient, StatsdReporter  # noqa
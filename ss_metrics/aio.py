@@ -0,0 +1,305 @@
+"""Asyncio support: instrumenting coroutines and reporting from an event loop.
+
+`timed` and `with_meter` hand coroutine functions and async generators to
+this module, so that awaited work is measured rather than the creation of
+the coroutine. `start_reporting` runs a reporter on the event loop instead of
+appmetrics' reporting thread, and `AsyncLibratoReporter` submits to librato
+without blocking the loop::
+
+    reporter = AsyncLibratoReporter(librato_email, librato_token)
+    task = start_reporting(reporter, 5)
+
+Requires Python 3.6 or later.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import inspect
+import json
+import random
+import time
+from functools import wraps
+
+from appmetrics import reporter as appmetrics_reporter
+
+from . import logger
+from .metrics import DEFAULT_KEEPALIVE
+from .reporter import (
+    DEFAULT_BACKOFF, DEFAULT_BATCH_SIZE, DEFAULT_MAX_RETRIES, CycleStats,
+    LibratoReporter, _batches, _count_measurements, _endpoint,
+    _queued_chunks, _ServerError)
+
+
+def wrap_timed(fn, binding):
+    """Time the awaited calls of a coroutine or async generator function."""
+    if inspect.isasyncgenfunction(fn):
+        return _wrap_async_generator(fn, binding, timed=True)
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if binding.period > 1 and binding.skip():
+            return await fn(*args, **kwargs)
+        histogram = binding.get()
+        start = time.time()
+        result = await fn(*args, **kwargs)
+        histogram.notify(time.time() - start)
+        return result
+    return wrapper
+
+
+def wrap_metered(fn, binding):
+    """Count the awaited calls of a coroutine or async generator function."""
+    if inspect.isasyncgenfunction(fn):
+        return _wrap_async_generator(fn, binding, timed=False)
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if binding.period > 1 and binding.skip():
+            return await fn(*args, **kwargs)
+        meter = binding.get()
+        result = await fn(*args, **kwargs)
+        meter.notify(binding.period)
+        return result
+    return wrapper
+
+
+def _wrap_async_generator(fn, binding, timed):
+    # The metric is updated once the generator is exhausted. Its timing is
+    # the time spent producing items, excluding the consumer's time between
+    # them.
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        # Unsampled calls are driven the same way without a metric
+        metric = None
+        if binding.period == 1 or not binding.skip():
+            metric = binding.get()
+        generator = fn(*args, **kwargs)
+        elapsed = 0.0
+        sent, thrown = None, None
+        while True:
+            start = time.time()
+            try:
+                if thrown is None:
+                    item = await generator.asend(sent)
+                else:
+                    item = await generator.athrow(thrown)
+            except StopAsyncIteration:
+                elapsed += time.time() - start
+                break
+            elapsed += time.time() - start
+            sent, thrown = None, None
+            try:
+                sent = yield item
+            except GeneratorExit:
+                await generator.aclose()
+                raise
+            except BaseException as e:
+                thrown = e
+        if metric is not None:
+            metric.notify(elapsed if timed else binding.period)
+    return wrapper
+
+
+async def report_forever(reporter, interval, tag=None):
+    """Call a reporter with the metrics every `interval` seconds.
+
+    Like appmetrics' `fixed_interval_scheduler`, ticks are fixed relative to
+    the start, but ticks missed while a slow reporter ran are skipped. The
+    reporter may be a coroutine function. Errors are logged and do not stop
+    reporting.
+    """
+    loop = asyncio.get_event_loop()
+    next_tick = loop.time()
+    while True:
+        next_tick += interval
+        now = loop.time()
+        while next_tick < now:
+            next_tick += interval
+        await asyncio.sleep(next_tick - now)
+        try:
+            result = reporter(appmetrics_reporter.get_metrics(tag))
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            logger.exception('Failed to report metrics')
+
+
+def start_reporting(reporter, interval, tag=None):
+    """Report from the running event loop, returning a cancellable task."""
+    return asyncio.ensure_future(report_forever(reporter, interval, tag))
+
+
+class _HTTPError(Exception):
+    """An HTTP response could not be read."""
+
+
+class AsyncConnection(object):
+    """A keep-alive HTTP connection to librato using asyncio streams."""
+
+    def __init__(self, librato_api):
+        self.librato_api = librato_api
+        host, _, port = librato_api.hostname.partition(':')
+        self.host = host
+        self.ssl = librato_api.protocol == 'https'
+        self.port = int(port) if port else (443 if self.ssl else 80)
+        self.reader = self.writer = None
+
+    async def post(self, chunk):
+        """Post a chunk of measurements and return the response status."""
+        api = self.librato_api
+        body = json.dumps(chunk).encode('utf-8')
+        headers = api._set_headers({'Content-Type': 'application/json'})
+        headers['Host'] = api.hostname
+        headers['Content-Length'] = str(len(body))
+        request = ['POST {} HTTP/1.1'.format(
+            api.base_path + _endpoint(chunk))]
+        for name, value in headers.items():
+            if isinstance(value, bytes):
+                value = value.decode('latin-1')
+            request.append('{}: {}'.format(name, value))
+        request = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1') + body
+        # A kept-alive connection may have been closed by the server since
+        # its last use, so retry once on a fresh connection.
+        for attempt in range(2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port,
+                                            ssl=self.ssl or None),
+                    api.timeout)
+            try:
+                self.writer.write(request)
+                return await asyncio.wait_for(self._read_response(),
+                                              api.timeout)
+            except (_HTTPError, OSError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def _read_response(self):
+        reader = self.reader
+        status_line = await reader.readline()
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise _HTTPError('Invalid status line {!r}'.format(status_line))
+        length, chunked, keep_alive = None, False, True
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise _HTTPError('Connection closed while reading headers')
+            if line in (b'\r\n', b'\n'):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding':
+                chunked = value == 'chunked'
+            elif name == 'connection':
+                keep_alive = value != 'close'
+        if chunked:
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if not size:
+                    break
+        elif length is not None:
+            await reader.readexactly(length)
+        else:
+            await reader.read()
+            keep_alive = False
+        if not keep_alive:
+            self.close()
+        return status
+
+
+class AsyncSubmitter(object):
+    """Submit librato payloads from the event loop.
+
+    Like `BatchSubmitter`, chunks are split into batches of at most
+    `batch_size` measurements, and a batch failing with a connection or
+    server error is retried up to `max_retries` times after a jittered
+    exponential backoff. Batches are posted in turn over one keep-alive
+    connection.
+    """
+
+    def __init__(self, librato_api, batch_size=DEFAULT_BATCH_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.connection = AsyncConnection(librato_api)
+        self.failed_batches = 0
+
+    async def submit(self, chunks):
+        """Submit the chunks and return the number of measurements sent."""
+        sent = 0
+        for batch in _batches(chunks, self.batch_size):
+            if await self._send(batch):
+                sent += _count_measurements([batch])
+            else:
+                self.failed_batches += 1
+        return sent
+
+    def close(self):
+        self.connection.close()
+
+    async def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(
+                    random.uniform(0, self.backoff * 2 ** attempt))
+            try:
+                status = await self.connection.post(batch)
+                if status >= 500:
+                    raise _ServerError(status)
+            except (_ServerError, _HTTPError, OSError,
+                    asyncio.IncompleteReadError, asyncio.TimeoutError):
+                logger.warning(
+                    'Failed to submit a batch to librato (attempt %d of %d)',
+                    attempt + 1, self.max_retries + 1, exc_info=True)
+                continue
+            if status >= 400:
+                logger.error(
+                    'Librato rejected a batch with status %d', status)
+                return False
+            return True
+        logger.error(
+            'Giving up on a batch of %d measurements',
+            _count_measurements([batch]))
+        return False
+
+
+class AsyncLibratoReporter(LibratoReporter):
+    """Report metrics to librato without blocking the event loop.
+
+    Calling the reporter returns a coroutine, as expected by
+    `start_reporting`. `last_cycle` includes the time spent submitting.
+    """
+
+    def __init__(self, librato_email, librato_token, metric_prefix=None,
+                 changed_only=False, keepalive=DEFAULT_KEEPALIVE,
+                 submitter=None):
+        super(AsyncLibratoReporter, self).__init__(
+            librato_email, librato_token, metric_prefix=metric_prefix,
+            changed_only=changed_only, keepalive=keepalive)
+        if submitter is None:
+            submitter = AsyncSubmitter(self.librato_api)
+        self.submitter = submitter
+
+    async def __call__(self, metrics):
+        start = time.time()
+        q = self.librato_api.new_queue()
+        measurements = self.add_measurements(q, metrics)
+        if measurements:
+            await self.submitter.submit(_queued_chunks(q))
+        self.last_cycle = CycleStats(time.time() - start, measurements)
+        logger.info(
+            'Reported %d measurements to librato in %.3fs',
+            measurements, self.last_cycle.duration)
@@ -0,0 +1,175 @@
+"""Histograms that accept samples in bulk and summarize them with NumPy.
+
+NumPy is optional: without it, bulk updates loop over the samples and
+summaries are computed by appmetrics. As it is slow to import, it is only
+imported by the first bulk update or summary.
+"""
+from __future__ import absolute_import, division
+
+import math
+import random
+
+from appmetrics import histogram
+
+_UNRESOLVED = object()
+# The NumPy module once imported by `get_numpy`, or None if not installed
+numpy = _UNRESOLVED
+
+# Percentile levels reported by appmetrics histograms
+PERCENTILE_LEVELS = (50, 75, 90, 95, 99, 99.9)
+
+
+def get_numpy():
+    """Return the NumPy module, imported on first use, or None."""
+    global numpy
+    if numpy is _UNRESOLVED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def as_floats(samples):
+    """Convert samples to a NumPy array, or a list without NumPy."""
+    numpy = get_numpy()
+    if numpy is not None:
+        return numpy.asarray(samples, dtype=float).ravel()
+    return [float(sample) for sample in samples]
+
+
+def add_many(reservoir, samples):
+    """Add many samples to an appmetrics reservoir at once."""
+    if isinstance(reservoir, histogram.UniformReservoir):
+        _add_many_uniform(reservoir, as_floats(samples))
+    elif isinstance(reservoir, histogram.SlidingWindowReservoir):
+        reservoir.deque.extend(_to_list(as_floats(samples)))
+    else:
+        for sample in _to_list(as_floats(samples)):
+            reservoir.add(sample)
+
+
+def _to_list(samples):
+    return samples.tolist() if get_numpy() is not None else samples
+
+
+def _add_many_uniform(reservoir, samples):
+    total = len(samples)
+    with reservoir.lock:
+        count, size, values = (
+            reservoir.count, reservoir.size, reservoir._values)
+        fill = max(0, min(size - count, total))
+        values[count:count + fill] = _to_list(samples[:fill])
+        rest = samples[fill:]
+        first = count + fill
+        # Vitter's Algorithm R, as in `UniformReservoir.add`: the sample
+        # preceded by `seen` others replaces a random slot with probability
+        # size / seen.
+        numpy = get_numpy()
+        if numpy is not None and len(rest):
+            seen = numpy.arange(first, first + len(rest), dtype=float)
+            slots = (numpy.random.random_sample(len(rest)) * seen).astype(
+                numpy.int64)
+            kept = numpy.nonzero(slots < size)[0]
+            for slot, sample in zip(
+                    slots[kept].tolist(), rest[kept].tolist()):
+                values[slot] = sample
+        else:
+            for seen, sample in enumerate(rest, first):
+                slot = int(random.uniform(0, seen))
+                if slot < size:
+                    values[slot] = sample
+        reservoir.count = count + total
+
+
+class Histogram(histogram.Histogram):
+    """An appmetrics histogram that also accepts samples in bulk.
+
+    With NumPy installed, `get` computes the same statistics as appmetrics
+    with vectorized operations.
+    """
+
+    def notify_many(self, samples):
+        """Add many values to the metric"""
+        add_many(self.reservoir, samples)
+
+    def get(self):
+        """Return the computed statistics over the gathered data"""
+        if get_numpy() is None:
+            return super(Histogram, self).get()
+        return summarize(self.reservoir.values)
+
+
+def summarize(values):
+    """Compute appmetrics histogram statistics over values with NumPy."""
+    numpy = get_numpy()
+    values = numpy.sort(numpy.asarray(values, dtype=float))
+    n = len(values)
+    if not n:
+        return dict(
+            kind='histogram', min=0, max=0, arithmetic_mean=0.0,
+            geometric_mean=0.0, harmonic_mean=0.0, median=0.0, variance=0.0,
+            standard_deviation=0.0, skewness=0.0, kurtosis=0.0,
+            percentile=[(level, 0.0) for level in PERCENTILE_LEVELS],
+            histogram=[(0, 0)], n=0)
+    mean = float(values.mean())
+    deviations = values - mean
+    # appmetrics computes exactly, so identical values have no variance
+    if n > 1 and values[0] != values[-1]:
+        variance = float(numpy.dot(deviations, deviations)) / (n - 1)
+    else:
+        variance = 0.0
+    stdev = math.sqrt(variance)
+    if stdev:
+        skewness = float((deviations ** 3).sum()) / stdev ** 3 / n
+        kurtosis = float((deviations ** 4).sum()) / stdev ** 4 / n - 3
+    else:
+        skewness = kurtosis = 0.0
+    # appmetrics maps zero to e and negative values to 1
+    logs = numpy.log(numpy.where(
+        values > 0, values, numpy.where(values == 0, math.e, 1.0)))
+    nonzero = values[values != 0]
+    reciprocal_sum = float((1.0 / nonzero).sum())
+    if n % 2:
+        median = float(values[n // 2])
+    else:
+        median = float(values[n // 2 - 1] + values[n // 2]) / 2
+    percentiles = []
+    for level in PERCENTILE_LEVELS:
+        index = level / 100 * n - 0.5
+        percentiles.append(
+            (level, float(values[int(index)]) if 0 <= index < n else 0.0))
+    return dict(
+        kind='histogram',
+        min=float(values[0]),
+        max=float(values[-1]),
+        arithmetic_mean=mean,
+        geometric_mean=math.exp(float(logs.mean())),
+        harmonic_mean=n / reciprocal_sum if reciprocal_sum else 0.0,
+        median=median,
+        variance=variance,
+        standard_deviation=stdev,
+        skewness=skewness,
+        kurtosis=kurtosis,
+        percentile=percentiles,
+        histogram=_histogram_bins(values, stdev) if n > 1 else [(0, 0)],
+        n=n)
+
+
+def _histogram_bins(values, stdev):
+    """Count sorted values into appmetrics' Sturges histogram bins."""
+    numpy = get_numpy()
+    n = len(values)
+    minimum, maximum = float(values[0]), float(values[-1])
+    width = int(round((3.5 * stdev) / (n ** (1.0 / 3)))) or 1
+    count = int(round((maximum - minimum) / width) + 1)
+    if count:
+        bins = numpy.arange(1, count + 1) * width + minimum
+    else:
+        bins = numpy.array([minimum])
+    # Each value falls into the first bin that is not lower than it
+    counts = numpy.bincount(
+        numpy.searchsorted(bins, values, side='left'),
+        minlength=len(bins) + 1)[:len(bins)]
+    return list(zip(bins.tolist(), counts.tolist()))
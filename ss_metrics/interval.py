@@ -0,0 +1,144 @@
+"""Histograms summarizing only the samples of the latest reporting interval.
+
+Unlike appmetrics histograms, whose reservoirs span the process lifetime or
+a fixed window, an `IntervalHistogram` starts afresh every time it is
+reported, so reported counts, sums and percentiles describe one interval.
+"""
+from __future__ import absolute_import, division
+
+import random
+import threading
+import time
+
+from .histogram import PERCENTILE_LEVELS, _to_list, as_floats
+
+# The size of appmetrics' uniform reservoirs
+DEFAULT_SIZE = 1028
+# Reads closer together than this share an interval
+DEFAULT_MIN_INTERVAL = 1.0
+
+
+class _Buffer(object):
+    """The samples of one interval: exact aggregates and a uniform sample."""
+
+    __slots__ = ('values', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.values = []
+        self.clear()
+
+    def clear(self):
+        del self.values[:]
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value, size):
+        count = self.count
+        if count < size:
+            self.values.append(value)
+        else:
+            # Vitter's Algorithm R, as in appmetrics' `UniformReservoir`
+            slot = int(random.uniform(0, count))
+            if slot < size:
+                self.values[slot] = value
+        self.count = count + 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def summarize(self):
+        n = self.count
+        values = sorted(self.values)
+        percentiles = []
+        for level in PERCENTILE_LEVELS:
+            # As computed by appmetrics over its reservoirs
+            index = level / 100 * len(values) - 0.5
+            percentiles.append((
+                level,
+                values[int(index)] if 0 <= index < len(values) else 0.0))
+        return dict(
+            kind='histogram',
+            n=n,
+            min=self.min if n else 0,
+            max=self.max if n else 0,
+            arithmetic_mean=self.sum / n if n else 0.0,
+            median=_median(values),
+            percentile=percentiles)
+
+
+def _median(values):
+    n = len(values)
+    if not n:
+        return 0.0
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+class IntervalHistogram(object):
+    """A histogram of the samples recorded since it was last reported.
+
+    Samples are recorded into one of two buffers. `get` swaps in the other,
+    empty buffer and summarizes the full one, so recording threads only wait
+    for the swap, never for the summary. Counts, sums, minimums and maximums
+    are exact, while percentiles are computed over a uniform sample of at
+    most `size` samples of the interval.
+
+    Calls to `get` within `min_interval` seconds of the latest swap return
+    the same summary, so that reporters on the same schedule report the same
+    interval. Its `get` returns the same `n`, `min`, `max`,
+    `arithmetic_mean`, `median` and `percentile` fields as an appmetrics
+    histogram.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, min_interval=DEFAULT_MIN_INTERVAL):
+        self.size = size
+        self.min_interval = min_interval
+        self.current = _Buffer()
+        self.spare = _Buffer()
+        # Held by recording threads and while swapping buffers
+        self.lock = threading.Lock()
+        # Held while reading, so that only one reader swaps
+        self.read_lock = threading.Lock()
+        self.summary = None
+        self.swapped_at = None
+
+    def notify(self, value):
+        """Add a new value to the metric"""
+        value = float(value)
+        with self.lock:
+            self.current.add(value, self.size)
+
+    def notify_many(self, values):
+        """Add many values to the metric"""
+        values = _to_list(as_floats(values))
+        size = self.size
+        with self.lock:
+            add = self.current.add
+            for value in values:
+                add(value, size)
+
+    def raw_data(self):
+        """Return the sampled values of the current interval"""
+        with self.lock:
+            return list(self.current.values)
+
+    def get(self):
+        """Return the statistics of the interval ended by this call"""
+        with self.read_lock:
+            now = time.time()
+            if self.summary is not None and (
+                    now - self.swapped_at < self.min_interval):
+                return self.summary
+            with self.lock:
+                full, self.current = self.current, self.spare
+            summary = full.summarize()
+            full.clear()
+            self.spare = full
+            self.summary = summary
+            self.swapped_at = now
+            return summary
@@ -1,94 +1,1038 @@
 from __future__ import absolute_import
 
-import logging
+import inspect
+import random
 import threading
+import time
 from functools import wraps
 
+from appmetrics import histogram as appmetrics_histogram
+from appmetrics import reporter as appmetrics_reporter
 from appmetrics import metrics
-from appmetrics.exceptions import InvalidMetricError
+from appmetrics.exceptions import DuplicateMetricError, InvalidMetricError
+from appmetrics.meter import Meter
 
 from . import logger
+from .histogram import Histogram, add_many
+from .interval import IntervalHistogram
+from .sketch import SketchHistogram
 from .utils import get_function_name
 
+try:
+    from sys import intern
+except ImportError:  # Python 2, where it is a builtin
+    pass
+
+try:
+    from time import perf_counter_ns as _clock_ns
+except ImportError:  # Before Python 3.7
+    _clock = getattr(time, 'perf_counter', time.time)
+
+    def _clock_ns():
+        return int(_clock() * 1e9)
+
+# Reservoir type of histograms backed by a mergeable quantile sketch
+SKETCH = 'ddsketch'
+# Reservoir type of histograms reset every time they are reported
+INTERVAL = 'interval'
+
+_HISTOGRAM_CLASSES = {SKETCH: SketchHistogram, INTERVAL: IntervalHistogram}
+
+
+DEFAULT_SHARDS = 16
+DEFAULT_MAX_IDLE_CYCLES = 10
 
-class DeltaTracker(object):
-    """A class that tracks the change between two measurements of a metric."""
+
+class _DeltaShard(object):
+    """A lock-protected subset of the counts tracked by a DeltaTracker."""
+
+    __slots__ = ('lock', 'counts', 'last_seen')
 
     def __init__(self):
-        self.name_to_count = {}
         self.lock = threading.Lock()
+        self.counts = {}
+        # The cycle in which each name was last updated
+        self.last_seen = {}
+
+
+class DeltaTracker(object):
+    """A class that tracks the change between two measurements of a metric.
+
+    Counts are spread over `shards` independently locked shards. Names that
+    have not been updated for at least `max_idle_cycles` reporting cycles
+    (see `end_cycle`) are forgotten; pass None to never forget names.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS,
+                 max_idle_cycles=DEFAULT_MAX_IDLE_CYCLES):
+        self.shards = tuple(_DeltaShard() for _ in range(shards))
+        self.max_idle_cycles = max_idle_cycles
+        self.cycle = 0
+
+    @property
+    def name_to_count(self):
+        """A copy of the current count of every tracked name."""
+        name_to_count = {}
+        for shard in self.shards:
+            with shard.lock:
+                name_to_count.update(shard.counts)
+        return name_to_count
+
+    @name_to_count.setter
+    def name_to_count(self, name_to_count):
+        for shard in self.shards:
+            with shard.lock:
+                shard.counts.clear()
+                shard.last_seen.clear()
+        for name, count in name_to_count.items():
+            shard = self.get_shard(name)
+            with shard.lock:
+                shard.counts[name] = count
+                shard.last_seen[name] = self.cycle
+
+    def get_shard(self, name):
+        """Get the shard that tracks the named metric."""
+        return self.shards[hash(name) % len(self.shards)]
 
     def peek_delta(self, name, count):
         """Calculate the delta without updating the current count."""
-        previous = self.name_to_count.get(name, 0)
+        shard = self.get_shard(name)
+        with shard.lock:
+            previous = shard.counts.get(name, 0)
         return self.calculate_delta(name, previous, count)
 
     def get_delta(self, name, count):
         """Retrive the delta and update the current count."""
-        with self.lock:
-            previous = self.name_to_count.get(name, 0)
-            self.name_to_count[name] = count
+        shard = self.get_shard(name)
+        with shard.lock:
+            previous = shard.counts.get(name, 0)
+            shard.counts[name] = count
+            shard.last_seen[name] = self.cycle
         return self.calculate_delta(name, previous, count)
 
+    def get_deltas(self, name_to_count):
+        """Retrieve the deltas for a snapshot of counts and end the cycle.
+
+        Each shard is locked once for the whole snapshot. Return a dict of
+        deltas by name.
+        """
+        shard_count = len(self.shards)
+        items_by_shard = [[] for _ in range(shard_count)]
+        for item in name_to_count.items():
+            items_by_shard[hash(item[0]) % shard_count].append(item)
+        cycle = self.cycle
+        changes = []
+        for shard, items in zip(self.shards, items_by_shard):
+            if not items:
+                continue
+            counts, last_seen = shard.counts, shard.last_seen
+            with shard.lock:
+                for name, count in items:
+                    changes.append((name, counts.get(name, 0), count))
+                    counts[name] = count
+                    last_seen[name] = cycle
+        deltas = dict(
+            (name, self.calculate_delta(name, previous, count))
+            for name, previous, count in changes)
+        self.end_cycle()
+        return deltas
+
+    def end_cycle(self):
+        """Mark the end of a reporting cycle, forgetting idle names."""
+        self.cycle += 1
+        max_idle_cycles = self.max_idle_cycles
+        # Idle names are swept once every `max_idle_cycles` cycles
+        if max_idle_cycles is None or self.cycle % max_idle_cycles:
+            return
+        self.evict_idle(self.cycle - max_idle_cycles)
+
+    def evict_idle(self, threshold):
+        """Forget names last updated before the `threshold` cycle."""
+        for shard in self.shards:
+            with shard.lock:
+                idle = [
+                    name for name, cycle in shard.last_seen.items()
+                    if cycle < threshold]
+                for name in idle:
+                    del shard.counts[name]
+                    del shard.last_seen[name]
+
     def calculate_delta(self, name, previous, count):
-        """Calculate the delta, ensuring the values are increasing."""
+        """Calculate the delta, accounting for counter resets.
+
+        A count lower than the previous one means the counter was reset,
+        e.g. by a process restart or the metric being recreated, so the whole
+        count accrued since the reset.
+        """
         if count < previous:
-            logger.error(
-                "Saw a non-monotonically increasing value for "
-                "metric {name}".format(name=name))
-            return 0
+            logger.info(
+                "Counter reset detected for metric {name}".format(name=name))
+            return count
         return count - previous
 
 
-def _get_metric(name):
-    """Get the named metric or return None."""
-    try:
-        return metrics.metric(name)
-    except InvalidMetricError:
+DEFAULT_KEEPALIVE = 10
+
+
+class ChangeTracker(DeltaTracker):
+    """A DeltaTracker that also tracks whether measurements have changed.
+
+    A measurement whose value has not changed since it was last reported is
+    still reported every `keepalive` intervals, so that its series does not
+    go stale.
+    """
+
+    def __init__(self, keepalive=DEFAULT_KEEPALIVE, **kwargs):
+        super(ChangeTracker, self).__init__(**kwargs)
+        self.keepalive = keepalive
+        # Last reported value, number of intervals it was skipped since and
+        # the cycle in which it was last seen
+        self.name_to_report = {}
+        self.lock = threading.Lock()
+
+    def should_report(self, name, value, changed=False):
+        """Decide whether to report a measurement and record the decision.
+
+        `changed` reports a measurement known to have changed even if its
+        value is the same, such as the change of a count that is not 0.
+        """
+        with self.lock:
+            previous = self.name_to_report.get(name)
+            if previous is not None and not changed:
+                previous_value, skipped, _ = previous
+                if (previous_value == value and
+                        skipped + 1 < self.keepalive):
+                    self.name_to_report[name] = (
+                        value, skipped + 1, self.cycle)
+                    return False
+            self.name_to_report[name] = (value, 0, self.cycle)
+        return True
+
+    def evict_idle(self, threshold):
+        super(ChangeTracker, self).evict_idle(threshold)
+        with self.lock:
+            idle = [
+                name for name, (_, _, cycle) in self.name_to_report.items()
+                if cycle < threshold]
+            for name in idle:
+                del self.name_to_report[name]
+
+
+# Separates the metric name and each tag of a series key
+TAG_SEPARATOR = ';'
+
+
+class SeriesKey(str):
+    """The registry key of a metric name along with a set of tags.
+
+    A series key is the string `name;tag=value;...`, with tags sorted, so it
+    can be used wherever a metric name is. Its metric name and tags are kept
+    as `metric_name` and `tags`, a tuple of (tag, value) pairs, so reporters
+    need not parse it. Get series keys from `series_key`, which reuses them.
+    """
+
+    def __new__(cls, metric_name, tags):
+        pairs = []
+        for tag, value in sorted(tags.items()):
+            tag, value = str(tag), str(value)
+            if (not tag or TAG_SEPARATOR in tag + value or '=' in tag):
+                raise ValueError(
+                    'Invalid tag {tag!r}={value!r}'.format(
+                        tag=tag, value=value))
+            pairs.append((tag, value))
+        key = str.__new__(cls, TAG_SEPARATOR.join(
+            [metric_name] + ['='.join(pair) for pair in pairs]))
+        key.metric_name = metric_name
+        key.tags = tuple(pairs)
+        return key
+
+    def __reduce__(self):
+        return SeriesKey, (self.metric_name, dict(self.tags))
+
+
+# Series keys by metric name and frozen set of tags
+_series_keys = {}
+
+
+def series_key(name, tags):
+    """Get the registry key of a metric name with tags.
+
+    Keys are cached, so the same key object is returned for the same name
+    and tags, and its hash is only computed once. Keep the key to record
+    updates of a series without looking it up again. Without tags, the name
+    itself is returned.
+    """
+    if not tags:
+        return name
+    cache_key = (name, frozenset(tags.items()))
+    key = _series_keys.get(cache_key)
+    if key is None:
+        key = _series_keys.setdefault(cache_key, SeriesKey(name, tags))
+    return key
+
+
+def split_series_key(key):
+    """Split a registry key into its metric name and tuple of tag pairs.
+
+    Keys of untagged metrics have no tags. Keys that were serialized, for
+    example by a forwarder, are parsed.
+    """
+    tags = getattr(key, 'tags', None)
+    if tags is not None:
+        return key.metric_name, tags
+    if TAG_SEPARATOR not in key:
+        return key, ()
+    parts = key.split(TAG_SEPARATOR)
+    return parts[0], tuple(
+        tuple(part.split('=', 1)) for part in parts[1:])
+
+
+_enabled = True
+_debug_logging = False
+_forwarder = None
+_limiter = None
+# Effective sample rates of sampled metrics, by name
+_sample_rates = {}
+# Timers returned by `timer`, by name
+_timers = {}
+
+
+def set_enabled(enabled=True):
+    """Enable or disable recording metrics.
+
+    While disabled, recording functions return immediately, and `timed` and
+    `with_meter` return the functions they decorate unchanged. Functions
+    decorated while enabled, and timers, stop recording too, but still
+    measure their calls, so disable recording before decorated functions are
+    defined to avoid any overhead.
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def set_debug_logging(enabled=True):
+    """Enable or disable logging of every metric update at DEBUG level."""
+    global _debug_logging
+    _debug_logging = enabled
+
+
+def set_forwarder(forwarder):
+    """Send metric updates to `forwarder` instead of the local registry.
+
+    The forwarder must provide `send(kind, name, value, reservoir_type=None)`
+    and `bind(kind, name)`, which returns an object with a `notify` method.
+    Pass None to record into the local registry again.
+    """
+    global _forwarder
+    _forwarder = forwarder
+
+
+# Overflow buckets of the global series limit are named under this prefix
+OVERFLOW_NAMESPACE = 'ss_metrics'
+
+
+class _Series(object):
+    """A name admitted by a CardinalityLimiter."""
+
+    __slots__ = ('name', 'prefix', 'last_used')
+
+    def __init__(self, name, prefix, last_used):
+        self.name = name
+        self.prefix = prefix
+        self.last_used = last_used
+
+
+class CardinalityLimiter(object):
+    """Bound the number of distinct metric names recorded.
+
+    At most `max_series` names are admitted in total, and at most
+    `prefix_limits[prefix]` names starting with `prefix` followed by a dot,
+    or by tags; the longest matching prefix applies. A series key counts as
+    a name of its own. Updates of names beyond a limit are
+    recorded into an overflow bucket per metric kind instead, named
+    `<prefix>.overflow.<kind>`, or `ss_metrics.overflow.<kind>` for the
+    global limit, and counted in `overflowed`.
+
+    Admitted names are interned. With `max_idle`, names that have not been
+    updated for `max_idle` seconds are removed from the registry and no
+    longer count towards the limits. Idle names are swept at most once every
+    `max_idle` seconds by `sweep`, which reporters call every reporting
+    cycle through `sweep_idle_names`, so recording never waits for a sweep.
+    """
+
+    def __init__(self, max_series=None, prefix_limits=None, max_idle=None):
+        self.max_series = max_series
+        self.prefix_limits = dict(prefix_limits or {})
+        # Longest prefixes first, so that the most specific limit applies
+        self.prefixes = sorted(self.prefix_limits, key=len, reverse=True)
+        self.max_idle = max_idle
+        self.series = {}
+        self.counts_by_prefix = {}
+        self.buckets = {}
+        self.overflowed = 0
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+
+    def admit(self, name, kind):
+        """Return the name under which to record an update of `name`."""
+        now = time.time()
+        series = self.series.get(name)
+        if series is not None:
+            series.last_used = now
+            return series.name
+        with self.lock:
+            series = self.series.get(name)
+            if series is not None:
+                return series.name
+            prefix = self.get_prefix(name)
+            if self.is_full(prefix):
+                self.overflowed += 1
+                return self.get_bucket(prefix, kind)
+            if type(name) is str:
+                name = intern(name)
+            self.series[name] = _Series(name, prefix, now)
+            if prefix is not None:
+                self.counts_by_prefix[prefix] = (
+                    self.counts_by_prefix.get(prefix, 0) + 1)
+            return name
+
+    def get_prefix(self, name):
+        """Get the limited prefix that `name` belongs to, if any."""
+        for prefix in self.prefixes:
+            if name.startswith(prefix) and (
+                    name[len(prefix):][:1] in ('.', TAG_SEPARATOR)):
+                return prefix
         return None
 
+    def is_full(self, prefix):
+        if self.max_series is not None and (
+                len(self.series) >= self.max_series):
+            return True
+        return prefix is not None and (
+            self.counts_by_prefix.get(prefix, 0) >=
+            self.prefix_limits[prefix])
+
+    def get_bucket(self, prefix, kind):
+        key = (prefix, kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if prefix is None:
+                prefix = OVERFLOW_NAMESPACE
+            bucket = self.buckets[key] = '.'.join((prefix, 'overflow', kind))
+            logger.warning(
+                'Too many metric names, recording into %s instead', bucket)
+        return bucket
+
+    def sweep(self):
+        """Forget idle names, if a sweep is due."""
+        if self.max_idle is None:
+            return
+        now = time.time()
+        if now - self.last_sweep >= self.max_idle:
+            self.evict_idle(now - self.max_idle)
+
+    def evict_idle(self, threshold):
+        """Forget names last updated before `threshold`, a timestamp."""
+        with self.lock:
+            self.last_sweep = time.time()
+            idle = [
+                series for series in self.series.values()
+                if series.last_used < threshold]
+            for series in idle:
+                del self.series[series.name]
+                if series.prefix is not None:
+                    self.counts_by_prefix[series.prefix] -= 1
+                # Deleted under the lock, so that a metric recreated after
+                # its name is admitted again is not deleted
+                metrics.delete_metric(series.name)
+                _sample_rates.pop(series.name, None)
+                _timers.pop(series.name, None)
+                if isinstance(series.name, SeriesKey):
+                    _series_keys.pop((series.name.metric_name,
+                                      frozenset(series.name.tags)), None)
+
+
+def get_sample_rate(name):
+    """Get the fraction of updates recorded for a metric, if sampled."""
+    return _sample_rates.get(name)
+
+
+def _sampling_period(sample_rate):
+    """Convert a sample rate to the number of calls per measured call."""
+    if not 0 < sample_rate <= 1:
+        raise ValueError('sample_rate must be greater than 0 and at most 1')
+    return max(1, int(round(1 / sample_rate)))
+
+
+def set_cardinality_limiter(limiter):
+    """Record metric updates under the names admitted by `limiter`.
+
+    Pass None to stop limiting names.
+    """
+    global _limiter
+    _limiter = limiter
+
+
+def sweep_idle_names():
+    """Forget the names the cardinality limiter found idle, if a sweep is due.
+
+    Reporters call this every reporting cycle. Call it periodically when
+    metrics are reported by other means.
+    """
+    limiter = _limiter
+    if limiter is not None:
+        limiter.sweep()
+
+
+def _get_or_create_metric(name, factory):
+    """Get the named metric, creating it with `factory` on the first use."""
+    # The registry itself serves as the name to metric cache: a plain dict
+    # lookup avoids the exception raised by `metrics.metric` on a miss and
+    # always reflects metrics deleted from the registry.
+    metric = metrics.REGISTRY.get(name)
+    if metric is None:
+        try:
+            metric = factory(name)
+        except DuplicateMetricError:
+            # Created by another thread since the lookup
+            metric = metrics.metric(name)
+    return metric
+
 
-def gauge(name, value):
+def gauge(name, value, tags=None):
     """Record the current value of a gauge metric."""
-    metric = _get_metric(name) or metrics.new_gauge(name)
-    metric.notify(value)
+    if not _enabled:
+        return
+    if tags:
+        name = series_key(name, tags)
+    if _debug_logging:
+        logger.debug('Setting gauge %s to %r', name, value)
+    if _limiter is not None:
+        name = _limiter.admit(name, 'gauge')
+    if _forwarder is not None:
+        _forwarder.send('gauge', name, value)
+        return
+    _get_or_create_metric(name, metrics.new_gauge).notify(value)
 
 
-def inc_meter(name, by=1):
+def inc_meter(name, by=1, tags=None):
     """Increment the value of a meter."""
-    logging.info('Incrementing meter %s', name)
-    counter = _get_metric(name) or metrics.new_meter(name)
-    counter.notify(by)
+    if not _enabled:
+        return
+    if tags:
+        name = series_key(name, tags)
+    if _debug_logging:
+        logger.debug('Incrementing meter %s by %s', name, by)
+    if _limiter is not None:
+        name = _limiter.admit(name, 'meter')
+    if _forwarder is not None:
+        _forwarder.send('meter', name, by)
+        return
+    _get_or_create_metric(name, metrics.new_meter).notify(by)
 
 
-def update_histogram(name, sample, reservoir_type='uniform'):
-    histogram = metrics.get_or_create_histogram(name, reservoir_type)
+def _get_or_create_histogram(name, reservoir_type):
+    """Get the named histogram, creating it if it does not exist.
+
+    Besides the appmetrics reservoir types, `reservoir_type` may be `SKETCH`
+    for a histogram backed by a mergeable quantile sketch, or `INTERVAL` for
+    a histogram of the samples recorded since it was last reported.
+    """
+    histogram_class = _HISTOGRAM_CLASSES.get(reservoir_type)
+    if histogram_class is not None:
+        histogram = _get_or_create_metric(
+            name, lambda name: metrics.new_metric(name, histogram_class))
+        if not isinstance(histogram, histogram_class):
+            raise DuplicateMetricError(
+                'Metric {name!r} already exists of type {kind}'.format(
+                    name=name, kind=type(histogram).__name__))
+        return histogram
+    try:
+        reservoir_class = metrics.RESERVOIR_TYPES[reservoir_type]
+    except KeyError:
+        raise InvalidMetricError(
+            'Unknown reservoir type: {kind}'.format(kind=reservoir_type))
+    # Unlike `metrics.get_or_create_histogram`, a reservoir is only built
+    # when the histogram is created.
+    histogram = _get_or_create_metric(
+        name, lambda name: metrics.new_metric(
+            name, Histogram, metrics.new_reservoir(reservoir_type)))
+    if not isinstance(histogram, appmetrics_histogram.Histogram):
+        raise DuplicateMetricError(
+            'Metric {name!r} already exists of type {kind}'.format(
+                name=name, kind=type(histogram).__name__))
+    if type(histogram.reservoir) is not reservoir_class:
+        raise DuplicateMetricError(
+            'Metric {name!r} already exists with a different '
+            'reservoir: {reservoir}'.format(
+                name=name, reservoir=histogram.reservoir))
+    return histogram
+
+
+def _histogram_kind(reservoir_type):
+    # Overflow buckets of different reservoir types must not collide
+    if reservoir_type == 'uniform':
+        return 'histogram'
+    return '_'.join(('histogram', reservoir_type))
+
+
+def update_histogram(name, sample, reservoir_type='uniform', sample_rate=1,
+                     tags=None):
+    """Add a sample to a histogram.
+
+    With a `sample_rate` below 1, only that fraction of samples is recorded,
+    chosen at random, and the rate is reported along with the histogram.
+    """
+    if not _enabled:
+        return
+    if tags:
+        name = series_key(name, tags)
+    if sample_rate < 1:
+        if random.random() >= sample_rate:
+            return
+        if _limiter is not None:
+            name = _limiter.admit(name, _histogram_kind(reservoir_type))
+        _sample_rates[name] = sample_rate
+    elif _limiter is not None:
+        name = _limiter.admit(name, _histogram_kind(reservoir_type))
+    if _forwarder is not None:
+        _forwarder.send('histogram', name, sample, reservoir_type)
+        return
+    histogram = _get_or_create_histogram(name, reservoir_type)
     histogram.notify(sample)
 
 
+def update_histogram_many(name, samples, reservoir_type='uniform'):
+    """Add a sequence or NumPy array of samples to a histogram at once."""
+    if not _enabled:
+        return
+    if _limiter is not None:
+        name = _limiter.admit(name, _histogram_kind(reservoir_type))
+    if _forwarder is not None:
+        for sample in samples:
+            _forwarder.send('histogram', name, float(sample), reservoir_type)
+        return
+    histogram = _get_or_create_histogram(name, reservoir_type)
+    notify_many = getattr(histogram, 'notify_many', None)
+    if notify_many is not None:
+        notify_many(samples)
+    else:
+        add_many(histogram.reservoir, samples)
+
+
+def inc_meter_many(counts):
+    """Increment several meters at once.
+
+    `counts` is a mapping or a sequence of (name, count) pairs. Counts for
+    the same name are summed, so each meter is only updated once.
+    """
+    if not _enabled:
+        return
+    totals = {}
+    items = counts.items() if hasattr(counts, 'items') else counts
+    for name, by in items:
+        totals[name] = totals.get(name, 0) + int(by)
+    for name, by in totals.items():
+        inc_meter(name, by)
+
+
+DEFAULT_MAX_STALENESS = 1.0
+DEFAULT_MAX_PENDING = 1000
+
+
+class _RecordingBuffer(object):
+    """Measurements recorded by a single thread and not yet flushed."""
+
+    __slots__ = (
+        'thread', 'lock', 'meters', 'gauges', 'histograms', 'pending',
+        'deadline')
+
+    def __init__(self, thread, deadline):
+        self.thread = thread
+        # Only contended while the buffer is being flushed by another thread
+        self.lock = threading.Lock()
+        self.reset(deadline)
+
+    def reset(self, deadline):
+        self.meters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.pending = 0
+        self.deadline = deadline
+
+
+class BufferedRecorder(object):
+    """Record metrics into per-thread buffers that are merged in bulk.
+
+    Each thread accumulates meter increments, gauge values and histogram
+    samples in its own buffer, so hot metrics do not contend on the shared
+    appmetrics locks. A thread flushes its buffer into the registry once it
+    holds `max_pending` measurements or is older than `max_staleness`
+    seconds; `flush` merges every thread's buffer, and `flushing` wraps a
+    reporter so that it always sees up-to-date values.
+    """
+
+    def __init__(self, max_staleness=DEFAULT_MAX_STALENESS,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.max_staleness = max_staleness
+        self.max_pending = max_pending
+        self.local = threading.local()
+        self.buffers = []
+        self.lock = threading.Lock()
+
+    def gauge(self, name, value):
+        """Buffer the current value of a gauge metric."""
+        if not _enabled:
+            return
+        buf = self._get_buffer()
+        now = time.time()
+        with buf.lock:
+            buf.gauges[name] = (now, value)
+            buf.pending += 1
+        self._flush_if_necessary(buf, now)
+
+    def inc_meter(self, name, by=1):
+        """Buffer an increment of a meter."""
+        if not _enabled:
+            return
+        buf = self._get_buffer()
+        with buf.lock:
+            buf.meters[name] = buf.meters.get(name, 0) + by
+            buf.pending += 1
+        self._flush_if_necessary(buf, time.time())
+
+    def update_histogram(self, name, sample, reservoir_type='uniform'):
+        """Buffer a histogram sample."""
+        if not _enabled:
+            return
+        buf = self._get_buffer()
+        key = (name, reservoir_type)
+        with buf.lock:
+            samples = buf.histograms.get(key)
+            if samples is None:
+                samples = buf.histograms[key] = []
+            samples.append(sample)
+            buf.pending += 1
+        self._flush_if_necessary(buf, time.time())
+
+    def flush(self):
+        """Merge every thread's buffered measurements into the registry."""
+        with self.lock:
+            buffers = list(self.buffers)
+            # Buffers of finished threads are drained one final time below
+            self.buffers = [buf for buf in buffers if buf.thread.is_alive()]
+        drained = [self._drain(buf) for buf in buffers]
+        latest_gauges = {}
+        for _, gauges, _ in drained:
+            for name, (timestamp, value) in gauges.items():
+                current = latest_gauges.get(name)
+                if current is None or current[0] <= timestamp:
+                    latest_gauges[name] = (timestamp, value)
+        for meters, _, histograms in drained:
+            self._apply(meters, {}, histograms)
+        self._apply({}, latest_gauges, {})
+
+    def flushing(self, reporter, tag=None):
+        """Wrap a reporter so that buffered measurements are flushed first.
+
+        The metrics passed in by the scheduler are collected before the flush,
+        so the wrapper collects them again for the given tag.
+        """
+        return _FlushingReporter(self, reporter, tag)
+
+    def _get_buffer(self):
+        try:
+            return self.local.buffer
+        except AttributeError:
+            buf = self.local.buffer = _RecordingBuffer(
+                threading.current_thread(), time.time() + self.max_staleness)
+            with self.lock:
+                self.buffers.append(buf)
+            return buf
+
+    def _flush_if_necessary(self, buf, now):
+        if buf.pending >= self.max_pending or now >= buf.deadline:
+            self._apply(*self._drain(buf))
+
+    def _drain(self, buf):
+        with buf.lock:
+            drained = buf.meters, buf.gauges, buf.histograms
+            buf.reset(time.time() + self.max_staleness)
+        return drained
+
+    def _apply(self, meters, gauges, histograms):
+        for name, by in meters.items():
+            inc_meter(name, by)
+        for name, (_, value) in gauges.items():
+            gauge(name, value)
+        for (name, reservoir_type), samples in histograms.items():
+            update_histogram_many(name, samples, reservoir_type)
+
+
+class _FlushingReporter(object):
+    """A reporter that flushes a `BufferedRecorder` before reporting."""
+
+    def __init__(self, recorder, reporter, tag=None):
+        self.recorder = recorder
+        self.reporter = reporter
+        self.tag = tag
+
+    def __call__(self, stale_metrics):
+        self.recorder.flush()
+        return self.reporter(appmetrics_reporter.get_metrics(self.tag))
+
+
+def _get_or_create_meter(name):
+    """Get the named meter, creating it if it does not exist."""
+    try:
+        return metrics.new_meter(name)
+    except DuplicateMetricError:
+        meter = metrics.metric(name)
+        if not isinstance(meter, Meter):
+            raise DuplicateMetricError(
+                'Metric {name!r} already exists of type {kind}'.format(
+                    name=name, kind=type(meter).__name__))
+        return meter
+
+
+def _get_or_create_timer(name):
+    """Get the named timing histogram, creating it if it does not exist."""
+    return _get_or_create_histogram(name, 'uniform')
+
+
+class _DisabledMetric(object):
+    """Stands in for the metric of a binding while recording is disabled."""
+
+    __slots__ = ()
+
+    def notify(self, value):
+        pass
+
+
+_DISABLED_METRIC = _DisabledMetric()
+
+
+class _MetricBinding(object):
+    """A decorated function's metric, resolved once and reused across calls.
+
+    The metric name is derived from the function when the binding is created.
+    If the name cannot be resolved yet, resolution is deferred to the first
+    call. The metric itself is bound on the first call and rebound if it is
+    removed from the registry. While a forwarder is set, the forwarder's
+    binding for the metric is used instead.
+
+    A sampled binding measures one in every `period` calls, counted in
+    `calls`. With `tags`, the metric is the tagged series of the name. A
+    binding given a `name` is not derived from a function.
+    """
+
+    __slots__ = (
+        'fn', 'suffix', 'kind', 'factory', 'name', 'metric', 'period',
+        'calls', 'tags')
+
+    def __init__(self, fn, suffix, kind, factory, period=1, tags=None,
+                 name=None):
+        self.fn = fn
+        self.suffix = suffix
+        self.kind = kind
+        self.factory = factory
+        self.metric = None
+        self.period = period
+        self.tags = tags
+        # Unsynchronized, so concurrent calls may rarely skew the sampling
+        self.calls = 0
+        if name is not None:
+            self.name = name
+            return
+        try:
+            self.name = self.resolve_name()
+        except ValueError:
+            self.name = None
+
+    def resolve_name(self):
+        return series_key(
+            '.'.join((get_function_name(self.fn), self.suffix)), self.tags)
+
+    def get(self):
+        if not _enabled:
+            return _DISABLED_METRIC
+        if self.name is None:
+            self.name = self.resolve_name()
+        name = self.name
+        if _limiter is not None:
+            name = _limiter.admit(name, self.kind)
+        if _forwarder is not None:
+            if self.period > 1:
+                # Forwarders may forward sample rates along with updates
+                _sample_rates[name] = 1.0 / self.period
+            return _forwarder.bind(self.kind, name)
+        metric = self.metric
+        if metric is None or metrics.REGISTRY.get(name) is not metric:
+            metric = self.metric = self.factory(name)
+            if self.period > 1:
+                _sample_rates[name] = 1.0 / self.period
+        return metric
+
+    def skip(self):
+        """Count a call, returning whether it should not be measured."""
+        self.calls += 1
+        return self.calls % self.period
+
+
+class Timer(_MetricBinding):
+    """Time code blocks into a histogram of durations in seconds.
+
+    Used as a context manager, a block is recorded unless it raises. Start
+    times are kept per thread, so a timer may be shared by blocks running
+    concurrently in several threads, but its blocks must not nest within
+    one. `start` and `stop` time code that does not fit in a block, such as
+    recursive or nested code, and are cheaper than a block:
+
+        token = DB_TIMER.start()
+        ...
+        DB_TIMER.stop(token)
+
+    The histogram is bound on first use and rebound if it is removed from
+    the registry.
+    """
+
+    __slots__ = ('local',)
+
+    def __init__(self, name):
+        super(Timer, self).__init__(
+            None, None, 'histogram', _get_or_create_timer, name=name)
+        # The start time of the block being timed, per thread
+        self.local = threading.local()
+
+    def start(self):
+        """Return a token to pass to `stop`: the current clock in ns."""
+        return _clock_ns()
+
+    def stop(self, token):
+        """Record and return the seconds elapsed since `start`."""
+        elapsed = (_clock_ns() - token) / 1e9
+        self.get().notify(elapsed)
+        return elapsed
+
+    def __enter__(self):
+        self.local.started = _clock_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = _clock_ns() - self.local.started
+        if exc_type is None:
+            self.get().notify(elapsed / 1e9)
+
+
+def timer(name, tags=None):
+    """Get a `Timer` recording into the named histogram, tagged with `tags`.
+
+    Timers are cached by name, so that timing a block inline reuses the
+    timer of the previous call:
+
+        with timer('db.query'):
+            ...
+
+    Keep the timer to skip looking it up on every use.
+    """
+    key = series_key(name, tags)
+    timer = _timers.get(key)
+    if timer is None:
+        timer = _timers.setdefault(key, Timer(key))
+    return timer
+
+
+def _never(fn):
+    return False
+
+
+def _is_async(fn):
+    """Return whether `fn` is a coroutine or async generator function."""
+    # Coroutine functions do not exist before Python 3.5, nor async
+    # generator functions before Python 3.6
+    return (getattr(inspect, 'iscoroutinefunction', _never)(fn) or
+            getattr(inspect, 'isasyncgenfunction', _never)(fn))
+
+
 # Use indirection to appmetrics to keep implementation details of our
 # metrics library solely in this module
-def timed(fn):
+def timed(fn=None, sample_rate=1, tags=None):
     """Time function calls and report metrics based on timings.
 
     Automatically generares metric names based on the decorated function's
     fully qualified name.
+
+    Used as `@timed(sample_rate=0.01)`, only every 100th call is timed, and
+    as `@timed(tags={...})`, timings are recorded with tags.
     """
+    if fn is None:
+        return lambda fn: timed(fn, sample_rate, tags)
+    if not _enabled:
+        return fn
+    period = _sampling_period(sample_rate)
+    binding = _MetricBinding(
+        fn, 'timer', 'histogram', _get_or_create_timer, period, tags)
+    if _is_async(fn):
+        from . import aio
+        return aio.wrap_timed(fn, binding)
+
+    if period > 1:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if binding.skip():
+                return fn(*args, **kwargs)
+            histogram = binding.get()
+            start = time.time()
+            result = fn(*args, **kwargs)
+            histogram.notify(time.time() - start)
+            return result
+        return wrapper
+
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        name = '.'.join((get_function_name(fn), 'timer'))
-        return metrics.with_histogram(name)(fn)(*args, **kwargs)
+        histogram = binding.get()
+        start = time.time()
+        result = fn(*args, **kwargs)
+        histogram.notify(time.time() - start)
+        return result
     return wrapper
 
 
-def with_meter(fn):
+def with_meter(fn=None, sample_rate=1, tags=None):
     """Count function calls and report metrics based on count and rates.
 
     Automatically generares metric names based on the decorated function's
     fully qualified name.
+
+    Used as `@with_meter(sample_rate=0.01)`, only every 100th call is
+    counted, as 100 calls.
     """
+    if fn is None:
+        return lambda fn: with_meter(fn, sample_rate, tags)
+    if not _enabled:
+        return fn
+    period = _sampling_period(sample_rate)
+    binding = _MetricBinding(
+        fn, 'rate', 'meter', _get_or_create_meter, period, tags)
+    if _is_async(fn):
+        from . import aio
+        return aio.wrap_metered(fn, binding)
+
+    if period > 1:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if binding.skip():
+                return fn(*args, **kwargs)
+            meter = binding.get()
+            result = fn(*args, **kwargs)
+            meter.notify(period)
+            return result
+        return wrapper
+
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        name = '.'.join((get_function_name(fn), 'rate'))
-        return metrics.with_meter(name)(fn)(*args, **kwargs)
+        meter = binding.get()
+        result = fn(*args, **kwargs)
+        meter.notify(1)
+        return result
     return wrapper
@@ -0,0 +1,297 @@
+"""Aggregate metrics across the worker processes of a pre-fork server.
+
+Workers forward every metric update over a Unix datagram socket to a single
+`Aggregator`, in batches sent from a background thread, and the aggregator
+records the updates into its own registry. Reporters
+registered in the aggregator's process then submit host-wide counts and
+percentiles once, instead of once per worker.
+
+Sample usage::
+
+    # In the process that reports, e.g. the master before forking
+    aggregator = Aggregator('/run/myapp/metrics.sock')
+    aggregator.start()
+    appmetrics.reporter.register(
+        LibratoReporter(librato_email, librato_token),
+        fixed_interval_scheduler(5))
+
+    # In each worker after forking, e.g. from a post_fork hook
+    forward_to('/run/myapp/metrics.sock')
+"""
+from __future__ import absolute_import
+
+import atexit
+import collections
+import errno
+import json
+import os
+import socket
+import threading
+
+from appmetrics import metrics as appmetrics
+
+from . import logger, metrics
+
+# Updates are sent in batches of at most this many bytes
+MAX_MESSAGE_SIZE = 65536
+DEFAULT_POLL_INTERVAL = 0.1
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_PENDING = 100000
+# How long the flushing thread waits for a lagging aggregator
+SEND_TIMEOUT = 1.0
+
+# Held while a forked process replaces the state of a forwarder
+_fork_lock = threading.Lock()
+
+
+class _ForwardedMetric(object):
+    """A stand-in for a registry metric that forwards its updates."""
+
+    __slots__ = ('forwarder', 'kind', 'name')
+
+    def __init__(self, forwarder, kind, name):
+        self.forwarder = forwarder
+        self.kind = kind
+        self.name = name
+
+    def notify(self, value):
+        self.forwarder.send(self.kind, self.name, value)
+
+
+class SocketForwarder(object):
+    """Forward metric updates to an `Aggregator` over a Unix socket.
+
+    Updates are queued in memory and sent from a background thread every
+    `flush_interval` seconds, many to a datagram, so recording never waits
+    for the aggregator. Updates beyond `max_pending` queued ones, and those
+    that cannot be sent, e.g. because the aggregator is not running, are
+    dropped and counted in `dropped`. `flush` sends queued updates at once,
+    and should be called before exiting.
+
+    The sample rates of sampled metrics are forwarded along with their
+    updates, so that the aggregator's reporters report them.
+
+    A forwarder may be set up before forking: a forked process starts
+    afresh, with neither the updates queued by its parent nor its lock,
+    which the parent's background thread may have held while forking.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.bindings = {}
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sock = None
+        self.thread = None
+        self.pid = None
+        # The process the lock and the queue belong to
+        self.owner = os.getpid()
+
+    def send(self, kind, name, value, reservoir_type=None):
+        """Queue a single metric update to be forwarded."""
+        if self.pid != os.getpid():
+            self._start()
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append((
+            kind, name, value, reservoir_type,
+            metrics.get_sample_rate(name)))
+
+    def bind(self, kind, name):
+        """Get an object whose `notify` forwards updates of a metric."""
+        key = (kind, name)
+        binding = self.bindings.get(key)
+        if binding is None:
+            binding = self.bindings[key] = _ForwardedMetric(self, kind, name)
+        return binding
+
+    def flush(self):
+        """Send the queued updates."""
+        self._check_fork()
+        with self.lock:
+            if self.sock is None or self.pid != os.getpid():
+                return
+            batch, size = [], 0
+            while self.pending:
+                line = _encode(self.pending.popleft())
+                if batch and size + len(line) + 1 > MAX_MESSAGE_SIZE:
+                    self._send(batch)
+                    batch, size = [], 0
+                batch.append(line)
+                size += len(line) + 1
+            if batch:
+                self._send(batch)
+
+    def close(self):
+        """Send the queued updates and stop the background thread."""
+        self._check_fork()
+        self.stopped.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+        self.flush()
+        self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        # Updates sent after closing start forwarding again
+        self.pid = None
+
+    def _check_fork(self):
+        # The state inherited from the parent process is replaced without
+        # taking its lock, which may never be released in this process
+        pid = os.getpid()
+        if self.owner == pid:
+            return
+        with _fork_lock:
+            if self.owner == pid:
+                return
+            self.lock = threading.Lock()
+            self.pending = collections.deque()
+            self.stopped = threading.Event()
+            self.sock = self.thread = self.pid = None
+            self.owner = pid
+
+    def _start(self):
+        self._check_fork()
+        with self.lock:
+            pid = os.getpid()
+            if self.pid == pid:
+                return
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.settimeout(SEND_TIMEOUT)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(
+                target=self._flush_forever, name='metrics-forwarder')
+            self.thread.daemon = True
+            self.pid = pid
+            self.thread.start()
+
+    def _flush_forever(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def _send(self, batch):
+        try:
+            self.sock.sendto(b'\n'.join(batch), self.path)
+        except socket.error:
+            self.dropped += len(batch)
+
+
+def _encode(update):
+    kind, name, value, reservoir_type, sample_rate = update
+    message = [kind, name, value]
+    if sample_rate is not None:
+        message.extend((reservoir_type, sample_rate))
+    elif reservoir_type is not None:
+        message.append(reservoir_type)
+    return json.dumps(message, default=str).encode('utf-8')
+
+
+def forward_to(path):
+    """Forward this process's metric updates to the aggregator at `path`.
+
+    Queued updates are sent when the interpreter exits.
+    """
+    forwarder = SocketForwarder(path)
+    metrics.set_forwarder(forwarder)
+    atexit.register(forwarder.close)
+    return forwarder
+
+
+def stop_forwarding():
+    """Record this process's metric updates into its own registry again."""
+    metrics.set_forwarder(None)
+
+
+class Aggregator(object):
+    """Record metric updates forwarded by other processes.
+
+    Updates are received on a Unix datagram socket bound to `path` and
+    recorded directly into this process's registry, even if this process
+    forwards its own updates.
+    """
+
+    def __init__(self, path, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.received = 0
+        self.sock = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def bind(self):
+        """Bind the socket, replacing any stale socket file."""
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(self.poll_interval)
+
+    def start(self):
+        """Receive updates on a background thread."""
+        self.bind()
+        self.thread = threading.Thread(
+            target=self.serve_forever, name='metrics-aggregator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        """Receive and record updates until `close` is called."""
+        if self.sock is None:
+            self.bind()
+        while not self.stopped.is_set():
+            try:
+                payload = self.sock.recv(MAX_MESSAGE_SIZE)
+            except socket.timeout:
+                continue
+            self.handle(payload)
+
+    def handle(self, payload):
+        """Record a datagram of forwarded updates, one per line."""
+        for line in payload.split(b'\n'):
+            self.handle_update(line)
+
+    def handle_update(self, line):
+        """Record a single forwarded update."""
+        try:
+            message = json.loads(line.decode('utf-8'))
+            kind, name, value = message[:3]
+            reservoir_type = message[3] if len(message) > 3 else None
+            if kind == 'gauge':
+                metric = metrics._get_or_create_metric(
+                    name, appmetrics.new_gauge)
+            elif kind == 'meter':
+                metric = metrics._get_or_create_metric(
+                    name, appmetrics.new_meter)
+            elif kind == 'histogram':
+                metric = metrics._get_or_create_histogram(
+                    name, reservoir_type or 'uniform')
+            else:
+                raise ValueError('Unknown metric kind {kind!r}'.format(
+                    kind=kind))
+            metric.notify(value)
+            if len(message) > 4:
+                metrics._sample_rates[name] = message[4]
+        except Exception:
+            logger.exception('Ignoring invalid metric update %r', line)
+        self.received += 1
+
+    def close(self):
+        """Stop receiving updates and remove the socket file."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            os.unlink(self.path)
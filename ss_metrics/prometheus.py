@@ -0,0 +1,270 @@
+"""Expose metrics to Prometheus in its text exposition format.
+
+`PrometheusExporter` is a WSGI application that can be mounted in an
+existing server, or served on its own with `start_http_server`::
+
+    start_http_server(9100)
+
+Each metric is rendered to a cached chunk of the response, which is only
+rebuilt when the metric's values change, and the response is streamed as
+those chunks instead of being joined into one string. Metrics are exposed
+in the order of their names. A metric whose name collides with another's
+once sanitized is not exposed, as Prometheus rejects a response with
+duplicate metric families.
+"""
+from __future__ import absolute_import, division
+
+import math
+import numbers
+import re
+import threading
+import time
+from collections import OrderedDict
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from appmetrics import reporter as appmetrics_reporter
+
+from . import logger
+from .reporter import _EmissionPlan, _MeterPlan, _PlannedReporter
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from SocketServer import ThreadingMixIn
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Scrapes within this many seconds of each other share a response
+DEFAULT_MAX_AGE = 1.0
+
+_INVALID = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def format_name(name):
+    """Replace the characters Prometheus does not allow in metric names."""
+    name = _INVALID.sub('_', name)
+    if name[:1].isdigit():
+        name = '_' + name
+    return name
+
+
+def format_value(value):
+    """Format a number for Prometheus, or return None for other values."""
+    if isinstance(value, bool) or not isinstance(value, numbers.Real):
+        return None
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class _Exposition(object):
+    """The chunks of a response and the names of the families in them."""
+
+    __slots__ = ('chunks', 'families')
+
+    def __init__(self):
+        self.chunks = []
+        self.families = set()
+
+
+class _PrometheusPlan(_EmissionPlan):
+    """Render a metric to a chunk of the exposition, cached until it changes.
+
+    Subclasses implement `render(info)`, returning the metric's lines and the
+    number of samples in them, and list the suffixes of the names of the
+    families they render, including of the samples of summaries, in
+    `suffixes`.
+    """
+
+    __slots__ = ('name', 'families', 'collided', 'info', 'chunk', 'samples')
+
+    suffixes = ('',)
+
+    def __init__(self, reporter, name, full_name):
+        self.name = format_name(full_name)
+        self.families = frozenset(
+            self.name + suffix for suffix in self.suffixes)
+        self.collided = False
+        self.info = None
+        self.chunk = None
+        self.samples = 0
+
+    def add(self, q, info, source):
+        if not q.families.isdisjoint(self.families):
+            if not self.collided:
+                logger.warning(
+                    'Not exposing metric %s to Prometheus, as its name '
+                    'collides with another metric', self.name)
+                self.collided = True
+            return 0
+        q.families.update(self.families)
+        if self.chunk is None or info != self.info:
+            lines, self.samples = self.render(info)
+            self.chunk = ''.join(lines).encode('utf-8')
+            self.info = info
+        if self.samples:
+            q.chunks.append(self.chunk)
+        return self.samples
+
+    def render(self, info):
+        raise NotImplementedError
+
+
+def _family(lines, name, metric_type, samples):
+    """Append the lines of a metric family, returning its sample count."""
+    samples = [(suffix, format_value(value)) for suffix, value in samples]
+    samples = [(suffix, value) for suffix, value in samples
+               if value is not None]
+    if samples:
+        lines.append('# TYPE {} {}\n'.format(name, metric_type))
+        for suffix, value in samples:
+            lines.append('{}{} {}\n'.format(name, suffix, value))
+    return len(samples)
+
+
+class _PrometheusGaugePlan(_PrometheusPlan):
+    __slots__ = ()
+
+    def render(self, info):
+        lines = []
+        return lines, _family(lines, self.name, 'gauge',
+                              [('', info['value'])])
+
+
+class _PrometheusMeterPlan(_PrometheusPlan):
+    __slots__ = ()
+
+    suffixes = ('_total',) + tuple(
+        '_' + suffix for _, suffix in _MeterPlan.meter_names)
+
+    def render(self, info):
+        # Prometheus computes rates from the cumulative count
+        lines = []
+        samples = _family(lines, self.name + '_total', 'counter',
+                          [('', info['count'])])
+        for appmetrics_name, suffix in _MeterPlan.meter_names:
+            samples += _family(lines, '_'.join((self.name, suffix)), 'gauge',
+                               [('', info[appmetrics_name])])
+        return lines, samples
+
+
+class _PrometheusHistogramPlan(_PrometheusPlan):
+    __slots__ = ()
+
+    suffixes = ('', '_min', '_max')
+
+    def render(self, info):
+        # Not a summary, as the sample count of a reservoir is capped or
+        # reset every interval, while the count of a summary must only grow
+        lines = []
+        if info['n'] <= 0:
+            return lines, 0
+        samples = _family(lines, self.name, 'gauge', [
+            ('{{quantile="{:g}"}}'.format(level / 100), value)
+            for level, value in info['percentile']])
+        samples += _family(lines, self.name + '_min', 'gauge',
+                           [('', info['min'])])
+        samples += _family(lines, self.name + '_max', 'gauge',
+                           [('', info['max'])])
+        return lines, samples
+
+
+class _PrometheusUnsupportedKindPlan(_PrometheusPlan):
+    __slots__ = ()
+
+    suffixes = ()
+
+    def render(self, info):
+        return [], 0
+
+
+_PROMETHEUS_PLANS_BY_KIND = {
+    'gauge': _PrometheusGaugePlan,
+    'meter': _PrometheusMeterPlan,
+    'histogram': _PrometheusHistogramPlan,
+}
+
+
+class PrometheusExporter(_PlannedReporter):
+    """A WSGI application exposing the registry's metrics to Prometheus.
+
+    Gauges are exposed as gauges, meters as a `_total` counter and rate
+    gauges, and histograms as gauges of their quantiles, labeled
+    `quantile`, along with `_min` and `_max` gauges.
+    Names are prefixed with `metric_prefix` and characters Prometheus does
+    not allow are replaced with underscores, including in the tags of tagged
+    series, which are exposed as part of their names. Only metrics with
+    `tag` are exposed if it is set.
+
+    A response is reused by the scrapes in the following `max_age` seconds.
+    """
+
+    # Series of a metric family would have to be rendered together to be
+    # exposed with labels
+    supports_tags = False
+    # Meters are exposed with their cumulative counts
+    uses_deltas = False
+
+    def __init__(self, metric_prefix=None, tag=None,
+                 max_age=DEFAULT_MAX_AGE):
+        super(PrometheusExporter, self).__init__(metric_prefix)
+        self.tag = tag
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.body = None
+        self.rendered_at = None
+
+    def __call__(self, environ, start_response):
+        body = self.render()
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(sum(len(chunk) for chunk in body))),
+        ])
+        return body
+
+    def render(self):
+        """Return the exposition as a list of byte strings."""
+        with self.lock:
+            now = time.time()
+            if self.body is None or now - self.rendered_at >= self.max_age:
+                exposition = _Exposition()
+                metrics = appmetrics_reporter.get_metrics(self.tag)
+                self.add_measurements(
+                    exposition, OrderedDict(sorted(metrics.items())))
+                self.body = exposition.chunks
+                self.rendered_at = now
+            return self.body
+
+    def plan_class(self, kind):
+        return _PROMETHEUS_PLANS_BY_KIND.get(
+            kind, _PrometheusUnsupportedKindPlan)
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, addr='', exporter=None):
+    """Serve metrics to Prometheus from a background thread.
+
+    Return the server, whose `shutdown` method stops it.
+    """
+    if exporter is None:
+        exporter = PrometheusExporter()
+    server = make_server(
+        addr, port, exporter, server_class=_ThreadingWSGIServer,
+        handler_class=_QuietHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics-prometheus')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,13 +1,49 @@
 from __future__ import absolute_import, print_function
 
+import collections
+import json
+import os
+import random
 import socket
+import threading
+import time
 
 import librato
 
 from . import logger
-from .metrics import DeltaTracker
+from .metrics import (
+    DEFAULT_KEEPALIVE, ChangeTracker, DeltaTracker, gauge, get_sample_rate,
+    inc_meter, split_series_key, sweep_idle_names, update_histogram)
+
+try:
+    from http import client as http_client
+    import queue
+except ImportError:  # Python 2
+    import httplib as http_client
+    import Queue as queue
 
 _hostname = None
+# Tells checkpoints saved by this process from those of previous ones
+_started = time.time()
+
+# Policies applied by `BackgroundSubmitter` when its queue is full
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+OVERFLOW_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+DEFAULT_MAX_PENDING = 10
+DEFAULT_BLOCK_TIMEOUT = 1.0
+
+# Librato recommends at most 300 measurements per request
+DEFAULT_BATCH_SIZE = 300
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+# Spooled batches replayed per submission
+DEFAULT_MAX_REPLAY = 10
+
+# Namespace reserved for the metrics reporters record about themselves
+SELF_METRICS_NAMESPACE = 'ss_metrics'
 
 
 # Hostname is done this way to avoid socket operations as a side
@@ -20,69 +56,807 @@ def _get_hostname():
     return _hostname
 
 
+class SelfMetrics(object):
+    """Record a reporter's own metrics under `SELF_METRICS_NAMESPACE`.
+
+    They are recorded into the registry like any other metric, so each
+    cycle's values are reported alongside the user metrics in the next one:
+
+    - `<reporter>.cycle_duration`, `<reporter>.metrics` and
+      `<reporter>.measurements` gauges for the latest cycle
+    - a `<reporter>.submit_latency` histogram
+    - `<reporter>.bytes_sent`, `<reporter>.errors` and
+      `<reporter>.skipped_names` meters
+    """
+
+    fields = (
+        'cycle_duration', 'metrics', 'measurements', 'submit_latency',
+        'bytes_sent', 'errors', 'skipped_names')
+
+    def __init__(self, reporter_name):
+        prefix = '.'.join((SELF_METRICS_NAMESPACE, reporter_name))
+        for field in self.fields:
+            setattr(self, field, '.'.join((prefix, field)))
+
+    def cycle(self, duration, metrics, measurements=None):
+        gauge(self.cycle_duration, duration)
+        gauge(self.metrics, metrics)
+        if measurements is not None:
+            gauge(self.measurements, measurements)
+
+    def submit(self, submit, chunks, submitter=None):
+        """Call `submit` to send `chunks`, recording latency, size and errors.
+
+        Batches that `submitter` counts in `failed_batches` are errors too.
+        """
+        size = sum(len(json.dumps(chunk)) for chunk in chunks)
+        failed = getattr(submitter, 'failed_batches', 0)
+        start = time.time()
+        try:
+            result = submit()
+        except Exception:
+            inc_meter(self.errors)
+            raise
+        finally:
+            update_histogram(self.submit_latency, time.time() - start)
+        errors = getattr(submitter, 'failed_batches', 0) - failed
+        if errors:
+            inc_meter(self.errors, errors)
+        inc_meter(self.bytes_sent, size)
+        return result
+
+    def skipped_name(self):
+        inc_meter(self.skipped_names)
+
+
 class ConsoleReporter(object):
+    """Log metrics at INFO level.
+
+    With `self_metrics=True`, the reporter records its cycle duration and
+    number of metrics (see `SelfMetrics`).
+    """
+
+    def __init__(self, self_metrics=False):
+        self.self_metrics = SelfMetrics('console') if self_metrics else None
+
     def __call__(self, metrics):
+        start = time.time()
         logger.info(metrics)
+        if self.self_metrics is not None:
+            self.self_metrics.cycle(time.time() - start, len(metrics))
 
 
-class LibratoReporter(object):
-    def __init__(self, librato_email, librato_token, metric_prefix=None):
-        self.delta_tracker = DeltaTracker()
-        self.librato_api = librato.connect(librato_email, librato_token)
+CycleStats = collections.namedtuple('CycleStats', ('duration', 'measurements'))
+
+
+class _ServerError(Exception):
+    """Librato responded with a retryable server error."""
+
+
+class KeepAliveConnection(object):
+    """A persistent HTTP connection to the librato metrics endpoint."""
+
+    def __init__(self, librato_api):
+        self.librato_api = librato_api
+        self.connection = None
+
+    def post(self, chunk):
+        """Post a chunk of measurements and return the response status."""
+        api = self.librato_api
+        body = json.dumps(chunk)
+        headers = api._set_headers({'Content-Type': 'application/json'})
+        path = api.base_path + _endpoint(chunk)
+        # A kept-alive connection may have been closed by the server since
+        # its last use, so retry once on a fresh connection.
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = self._connect()
+            try:
+                self.connection.request('POST', path, body, headers)
+                response = self.connection.getresponse()
+                response.read()
+                return response.status
+            except (http_client.HTTPException, socket.error):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _connect(self):
+        api = self.librato_api
+        if api.protocol == 'https':
+            connection_class = http_client.HTTPSConnection
+        else:
+            connection_class = http_client.HTTPConnection
+        return connection_class(api.hostname, timeout=api.timeout)
+
+
+# Kinds of measurements in librato queue chunks. Tagged measurements are
+# submitted to a separate endpoint.
+_MEASUREMENT_KINDS = ('gauges', 'counters', 'measurements')
+
+
+def _endpoint(chunk):
+    """Get the librato API endpoint to submit a chunk to."""
+    return 'measurements' if 'measurements' in chunk else 'metrics'
+
+
+def _queued_chunks(q):
+    """Get both the untagged and the tagged chunks of a librato queue."""
+    if not q.tagged_chunks:
+        return q.chunks
+    return q.chunks + q.tagged_chunks
+
+
+def _count_measurements(chunks):
+    """Count the measurements in a list of librato queue chunks."""
+    return sum(
+        len(chunk.get(kind, ()))
+        for chunk in chunks for kind in _MEASUREMENT_KINDS)
+
+
+def _batches(chunks, batch_size):
+    """Split librato queue chunks into batches of `batch_size`."""
+    for kind in _MEASUREMENT_KINDS:
+        measurements = [
+            measurement for chunk in chunks
+            for measurement in chunk.get(kind, ())]
+        for start in range(0, len(measurements), batch_size):
+            yield {kind: measurements[start:start + batch_size]}
+
+
+class BatchSubmitter(object):
+    """Submit librato payloads in size-bounded batches.
+
+    Queued chunks are split into batches of at most `batch_size`
+    measurements, which are posted by up to `pool_size` threads, each over
+    its own keep-alive connection. A batch that fails with a connection or
+    server error is retried up to `max_retries` times after a jittered
+    exponential backoff starting at `backoff` seconds, so one failed batch
+    does not discard the whole interval.
+
+    With a `spool` (see `ss_metrics.spool.Spool`), batches that still fail
+    are stamped with their measurement time and spooled. Up to
+    `max_replay` spooled batches are replayed after each submission without
+    failures, so that a long backlog does not hold up reporting.
+    """
+
+    def __init__(self, librato_api, batch_size=DEFAULT_BATCH_SIZE,
+                 pool_size=1, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, spool=None,
+                 max_replay=DEFAULT_MAX_REPLAY):
+        self.librato_api = librato_api
+        self.spool = spool
+        self.max_replay = max_replay
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.connections = queue.Queue()
+        for _ in range(pool_size):
+            self.connections.put(KeepAliveConnection(librato_api))
+        self.failed_batches = 0
+
+    def submit(self, chunks):
+        """Submit the chunks and return the number of measurements sent."""
+        measure_time = int(time.time())
+        batches = collections.deque(self.batches(chunks))
+        sent, failed = [], []
+        workers = min(self.pool_size, len(batches))
+        if workers <= 1:
+            self._send_batches(batches, sent, failed)
+        else:
+            threads = [
+                threading.Thread(
+                    target=self._send_batches, args=(batches, sent, failed))
+                for _ in range(workers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.failed_batches += len(failed)
+        if self.spool is not None:
+            if failed:
+                self.spool.append([
+                    dict(batch, **{_time_property(batch): measure_time})
+                    for batch in failed])
+            elif sent and self.spool.segments:
+                self.replay()
+        return sum(sent)
+
+    def replay(self):
+        """Submit up to `max_replay` spooled batches until one fails.
+
+        Each batch is tried once, and is left spooled for the next replay if
+        it fails. Return the number of measurements sent.
+        """
+        connection = self.connections.get()
+        sent = []
+        try:
+            self.spool.replay(
+                lambda batch: self._replay(connection, batch, sent),
+                self.max_replay)
+        finally:
+            self.connections.put(connection)
+        logger.info(
+            'Replayed %d spooled measurements to librato, %d batches left',
+            sum(sent), self.spool.pending)
+        return sum(sent)
+
+    def batches(self, chunks):
+        """Split librato queue chunks into batches of `batch_size`."""
+        return _batches(chunks, self.batch_size)
+
+    def close(self):
+        """Close the pooled connections."""
+        for _ in range(self.pool_size):
+            connection = self.connections.get()
+            connection.close()
+            self.connections.put(connection)
+
+    def _send_batches(self, batches, sent, failed):
+        connection = self.connections.get()
+        try:
+            while True:
+                try:
+                    batch = batches.popleft()
+                except IndexError:
+                    return
+                if self._send(connection, batch):
+                    sent.append(_count_measurements([batch]))
+                else:
+                    failed.append(batch)
+        finally:
+            self.connections.put(connection)
+
+    def _send(self, connection, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            try:
+                status = connection.post(batch)
+                if status >= 500:
+                    raise _ServerError(status)
+            except (_ServerError, http_client.HTTPException, socket.error):
+                logger.warning(
+                    'Failed to submit a batch to librato (attempt %d of %d)',
+                    attempt + 1, self.max_retries + 1, exc_info=True)
+                continue
+            if status >= 400:
+                logger.error(
+                    'Librato rejected a batch with status %d', status)
+                return False
+            return True
+        logger.error(
+            'Giving up on a batch of %d measurements',
+            _count_measurements([batch]))
+        return False
+
+    def _replay(self, connection, batch, sent):
+        try:
+            status = connection.post(batch)
+        except (http_client.HTTPException, socket.error):
+            logger.warning('Failed to replay a batch to librato',
+                           exc_info=True)
+            return False
+        if status >= 500:
+            return False
+        if status >= 400:
+            # Would be rejected again, so it is dropped
+            logger.error(
+                'Librato rejected a spooled batch with status %d', status)
+        else:
+            sent.append(_count_measurements([batch]))
+        return True
+
+
+def _time_property(batch):
+    """Get the property of a batch's measurement time."""
+    return 'time' if 'measurements' in batch else 'measure_time'
+
+
+class BackgroundSubmitter(object):
+    """Submit librato payloads from a background thread.
+
+    Payloads are held in a queue of at most `max_pending` entries and handed
+    to `submitter`, by default a `BatchSubmitter` using a single keep-alive
+    connection. When the queue is full, `overflow_policy` decides whether to
+    block the caller for up to `block_timeout` seconds, discard the new
+    payload or discard the oldest queued one. Discarded payloads are counted
+    in `dropped`.
+    """
+
+    def __init__(self, librato_api, max_pending=DEFAULT_MAX_PENDING,
+                 overflow_policy=DROP_OLDEST,
+                 block_timeout=DEFAULT_BLOCK_TIMEOUT, submitter=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                'Unknown overflow policy {policy!r}'.format(
+                    policy=overflow_policy))
+        if submitter is None:
+            submitter = BatchSubmitter(librato_api)
+        self.submitter = submitter
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, chunks):
+        """Queue a list of librato measurement chunks for submission."""
+        self._ensure_started()
+        if self.overflow_policy == BLOCK:
+            try:
+                self.queue.put(chunks, timeout=self.block_timeout)
+            except queue.Full:
+                self._drop()
+        elif self.overflow_policy == DROP_NEWEST:
+            try:
+                self.queue.put_nowait(chunks)
+            except queue.Full:
+                self._drop()
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(chunks)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self.queue.task_done()
+                    self._drop()
+
+    def join(self):
+        """Wait until every queued payload has been processed."""
+        self.queue.join()
+
+    def close(self, timeout=None):
+        """Stop the worker once the queued payloads have been submitted."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join(timeout)
+
+    def _ensure_started(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self._run, name='librato-submitter')
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def _drop(self):
+        self.dropped += 1
+        logger.warning(
+            'Librato submission queue is full, dropped a payload (%d total)',
+            self.dropped)
+
+    def _run(self):
+        while True:
+            chunks = self.queue.get()
+            try:
+                if chunks is None:
+                    self.submitter.close()
+                    return
+                self.submitter.submit(chunks)
+            except Exception:
+                logger.exception('Failed to submit metrics to librato')
+            finally:
+                self.queue.task_done()
+
+
+class _InstrumentedSubmitter(object):
+    """Record the latency, size and errors of another submitter's payloads."""
+
+    def __init__(self, submitter, self_metrics):
+        self.submitter = submitter
+        self.self_metrics = self_metrics
+
+    def submit(self, chunks):
+        return self.self_metrics.submit(
+            lambda: self.submitter.submit(chunks), chunks, self.submitter)
+
+    def __getattr__(self, name):
+        return getattr(self.submitter, name)
+
+
+class _PlannedReporter(object):
+    """Base class for reporters that emit metrics through emission plans.
+
+    Emission plans are cached per metric and write measurements to a queue
+    exposing librato's `add(name, value, **properties)`. The measurements of
+    tagged series are added with a `tags` dict.
+    """
+
+    # Whether tags are passed to the queue, rather than left in the name
+    supports_tags = True
+    # The tag the source of tagged measurements is sent as, if any
+    source_tag = None
+    # Whether plans read the meter count deltas of each cycle
+    uses_deltas = True
+
+    def __init__(self, metric_prefix=None, changed_only=False,
+                 keepalive=DEFAULT_KEEPALIVE, self_metrics=None):
+        self.self_metrics = self_metrics
+        self.changed_only = changed_only
+        if changed_only:
+            self.delta_tracker = ChangeTracker(keepalive)
+        else:
+            self.delta_tracker = DeltaTracker()
         self.metric_prefix = metric_prefix
+        self.last_cycle = None
+        # Meter count deltas of the current cycle, by name
+        self.deltas = {}
+        # Emission plans by (name, kind), built for `plans_prefix`
+        self.plans = {}
+        self.plans_prefix = metric_prefix
+
+    def add_measurements(self, q, metrics):
+        """Add measurements for each metric to a queue.
+
+        Return the number of measurements added.
+        """
+        sweep_idle_names()
+        if self.metric_prefix != self.plans_prefix:
+            self.plans = {}
+            self.plans_prefix = self.metric_prefix
+        if self.changed_only:
+            q = _ChangedOnlyQueue(q, self.delta_tracker)
+        if self.uses_deltas:
+            # Taken in one batch, which also ends the tracker's cycle
+            self.deltas = self.delta_tracker.get_deltas(dict(
+                (name, info['count']) for name, info in metrics.items()
+                if info['kind'] == 'meter'))
+        added = 0
+        hostname = _get_hostname()
+        previous_plans, plans = self.plans, {}
+        for name, info in metrics.items():
+            kind = info['kind']
+            key = (name, kind)
+            plan = previous_plans.get(key)
+            if plan is None:
+                plan = self.make_plan(name, kind)
+            # Plans of metrics missing from this cycle are dropped
+            plans[key] = plan
+            added += plan.add(q, info, hostname)
+        self.plans = plans
+        if self.changed_only:
+            added -= q.skipped
+        return added
+
+    def make_plan(self, name, kind):
+        """Build the emission plan for a metric."""
+        if self.supports_tags:
+            metric_name, tags = split_series_key(name)
+        else:
+            metric_name, tags = name, ()
+        # Add a prefix for separate environments
+        # Workaround unless/until we have separate Librato buckets
+        # for each environment
+        # (lily|2015-07-28)
+        if self.metric_prefix is not None:
+            full_name = '.'.join((self.metric_prefix, metric_name))
+        else:
+            full_name = metric_name
+        if len(full_name) > 255:
+            return _InvalidNamePlan(self, full_name)
+        plan = self.plan_class(kind)(self, name, full_name)
+        if tags:
+            tags = dict(tags)
+            if self.source_tag is not None:
+                tags.setdefault(self.source_tag, _get_hostname())
+            plan = _TaggedPlan(plan, tags)
+        return plan
+
+    def plan_class(self, kind):
+        """Get the emission plan class for a kind of metric."""
+        return _PLANS_BY_KIND.get(kind, _UnsupportedKindPlan)
+
+
+class LibratoReporter(_PlannedReporter):
+    """Report metrics to librato.
+
+    By default measurements are submitted synchronously on the reporting
+    thread. Setting `pool_size` submits them in batches over that many
+    concurrent keep-alive connections (see `BatchSubmitter`), and
+    `asynchronous=True` hands each interval's payload to a background worker
+    (see `BackgroundSubmitter`), so a slow librato endpoint does not stall the
+    scheduler. A preconfigured `submitter` may be passed instead.
+
+    With `changed_only=True`, measurements whose value has not changed since
+    the previous interval are skipped, except for a keepalive every
+    `keepalive` intervals. Meter counts are only skipped when the meter did
+    not change.
+
+    The duration and size of the latest reporting cycle are kept in
+    `last_cycle`. With `self_metrics=True`, they are also recorded along with
+    submission latencies, sizes and errors (see `SelfMetrics`).
+
+    With a `spool` (see `ss_metrics.spool.Spool`), payloads that cannot be
+    submitted are kept on disk and replayed once librato recovers, and the
+    counts meter deltas are computed from are checkpointed every interval.
+    A reporter created later in the same process resumes from the
+    checkpoint rather than reporting whole counts again. After a restart,
+    counts start from zero, so the checkpoint is ignored.
+
+    Tagged series (see `metrics.series_key`) are submitted as librato tagged
+    measurements, with the hostname as their `host` tag instead of a source.
+    """
+
+    source_tag = 'host'
+
+    def __init__(self, librato_email, librato_token, metric_prefix=None,
+                 asynchronous=False, pool_size=None, submitter=None,
+                 changed_only=False, keepalive=DEFAULT_KEEPALIVE,
+                 self_metrics=False, spool=None):
+        super(LibratoReporter, self).__init__(
+            metric_prefix, changed_only, keepalive,
+            SelfMetrics('librato') if self_metrics else None)
+        self.librato_api = librato.connect(librato_email, librato_token)
+        if submitter is None and (
+                pool_size is not None or spool is not None or
+                (asynchronous and self_metrics)):
+            submitter = BatchSubmitter(
+                self.librato_api, pool_size=pool_size or 1, spool=spool)
+        if submitter is not None and self_metrics:
+            # Record the actual submission, which happens on the background
+            # worker when asynchronous.
+            submitter = _InstrumentedSubmitter(submitter, self.self_metrics)
+        if asynchronous:
+            submitter = BackgroundSubmitter(
+                self.librato_api, submitter=submitter)
+        self.submitter = submitter
+        self.spool = spool
+        if spool is not None:
+            self.restore_checkpoint()
 
     def __call__(self, metrics):
-        # No point in caching the LibratoConnection instance, as initialization
-        # does not involve any socket operations and each call to `submit`
-        # creates a new socket connection.
-        with self.librato_api.new_queue() as q:
-            hostname = _get_hostname()
-            for name, info in metrics.items():
-                # Add a prefix for separate environments
-                # Workaround unless/until we have separate Librato buckets
-                # for each environment
-                # (lily|2015-07-28)
-                if self.metric_prefix is not None:
-                    full_name = '.'.join((self.metric_prefix, name))
-                else:
-                    full_name = name
-                if len(full_name) > 255:
-                    logger.error(
-                        'Metric name "%s" exceeds maximum allowed length',
-                        full_name)
-                    continue
-                kind = info['kind']
-                if kind == 'gauge':
-                    value = info['value']
-                    q.add(full_name, value, type='gauge', source=hostname)
-                elif kind == 'meter':
-                    q.add('.'.join((full_name, 'count')),
-                          self.delta_tracker.get_delta(name, info['count']),
-                          type='gauge',
-                          source=hostname)
-
-                    # pairs of appmetrics metrics names with their
-                    # counterparts on librato
-                    meter_names = (('one', '1m'), ('five', '5m'))
-                    for meter_name in meter_names:
-                        appmetrics_name, librato_name = meter_name
-                        q.add('.'.join((full_name, librato_name)),
-                              info[appmetrics_name],
-                              type='gauge',
-                              source=hostname)
-                elif kind == 'histogram':
-                    # Librato will reject if n is not > 0
-                    if info['n'] > 0:
-                        q.add(full_name,
-                              None,
-                              type='gauge',
-                              count=info['n'],
-                              sum=(info['n'] * info['arithmetic_mean']),
-                              max=info['max'],
-                              min=info['min'],
-                              source=hostname)
-                        for percentile_name, value in info['percentile']:
-                            q.add('.'.join((full_name, str(percentile_name))),
-                                  value,
-                                  type='gauge',
-                                  source=hostname)
+        start = time.time()
+        q = self.librato_api.new_queue()
+        measurements = self.add_measurements(q, metrics)
+        if self.submitter is None:
+            # Each call to `submit` creates a new socket connection.
+            if self.self_metrics is None:
+                q.submit()
+            else:
+                self.self_metrics.submit(q.submit, _queued_chunks(q))
+        elif measurements:
+            # Measurements are plain values, so the queued chunks are a
+            # snapshot that is safe to hand to another thread.
+            self.submitter.submit(_queued_chunks(q))
+        if self.spool is not None:
+            self.save_checkpoint()
+        self.last_cycle = CycleStats(time.time() - start, measurements)
+        if self.self_metrics is not None:
+            self.self_metrics.cycle(
+                self.last_cycle.duration, len(metrics), measurements)
+        logger.info(
+            'Reported %d measurements to librato in %.3fs',
+            measurements, self.last_cycle.duration)
+
+    def save_checkpoint(self):
+        """Save the delta tracker's counts to the spool."""
+        self.spool.save_checkpoint({
+            'process': [os.getpid(), _started],
+            'counts': self.delta_tracker.name_to_count,
+        })
+
+    def restore_checkpoint(self):
+        """Restore the counts saved by this process, returning if any were."""
+        checkpoint = self.spool.load_checkpoint()
+        if (checkpoint is None or
+                checkpoint.get('process') != [os.getpid(), _started]):
+            return False
+        self.delta_tracker.name_to_count = checkpoint['counts']
+        return True
+
+
+class _ChangedOnlyQueue(object):
+    """A librato queue proxy that drops measurements which have not changed."""
+
+    def __init__(self, q, change_tracker):
+        self.q = q
+        self.change_tracker = change_tracker
+        self.skipped = 0
+
+    def add(self, name, value, **properties):
+        self.add_if_changed(name, value, False, properties)
+
+    def add_count(self, name, value, **properties):
+        # The change of a count is only unchanged when it is 0
+        self.add_if_changed(name, value, value != 0, properties)
+
+    def add_if_changed(self, name, value, changed, properties):
+        tags = properties.get('tags')
+        if tags is None:
+            series = name
+            key = (value, tuple(sorted(properties.items())))
+        else:
+            # Tagged series share measurement names
+            series = (name, tuple(sorted(tags.items())))
+            key = (value, tuple(sorted(
+                item for item in properties.items() if item[0] != 'tags')))
+        if self.change_tracker.should_report(series, key, changed):
+            self.q.add(name, value, **properties)
+        else:
+            self.skipped += 1
+
+
+def _add_count(q, name, value, **properties):
+    """Add the change of a count since the previous interval to a queue.
+
+    A queue dropping unchanged measurements still adds every change that is
+    not 0, even if it equals the previous change.
+    """
+    if isinstance(q, (_ChangedOnlyQueue, _TaggedQueue)):
+        q.add_count(name, value, **properties)
+    else:
+        q.add(name, value, **properties)
+
+
+class _EmissionPlan(object):
+    """Precomputed librato names and field extractors for one metric."""
+
+    __slots__ = ()
+
+    def add(self, q, info, source):
+        """Add the metric's measurements to a librato queue.
+
+        Return the number of measurements added.
+        """
+        raise NotImplementedError
+
+
+class _TaggedQueue(object):
+    """A queue proxy adding measurements with the tags of their series."""
+
+    __slots__ = ('q', 'tags')
+
+    def __init__(self, q, tags):
+        self.q = q
+        self.tags = tags
+
+    def add(self, name, value, source=None, **properties):
+        # Tagged measurements have no source, see `source_tag`
+        self.q.add(name, value, tags=self.tags, **properties)
+
+    def add_count(self, name, value, source=None, **properties):
+        _add_count(self.q, name, value, tags=self.tags, **properties)
+
+
+class _TaggedPlan(_EmissionPlan):
+    """Emit the measurements of another plan with the tags of its series."""
+
+    __slots__ = ('plan', 'tags')
+
+    def __init__(self, plan, tags):
+        self.plan = plan
+        self.tags = tags
+
+    def add(self, q, info, source):
+        return self.plan.add(_TaggedQueue(q, self.tags), info, source)
+
+
+class _InvalidNamePlan(_EmissionPlan):
+    __slots__ = ('reporter', 'full_name')
+
+    def __init__(self, reporter, full_name):
+        self.reporter = reporter
+        self.full_name = full_name
+
+    def add(self, q, info, source):
+        logger.error(
+            'Metric name "%s" exceeds maximum allowed length', self.full_name)
+        if self.reporter.self_metrics is not None:
+            self.reporter.self_metrics.skipped_name()
+        return 0
+
+
+class _UnsupportedKindPlan(_EmissionPlan):
+    __slots__ = ()
+
+    def __init__(self, reporter, name, full_name):
+        pass
+
+    def add(self, q, info, source):
+        return 0
+
+
+class _GaugePlan(_EmissionPlan):
+    __slots__ = ('full_name',)
+
+    def __init__(self, reporter, name, full_name):
+        self.full_name = full_name
+
+    def add(self, q, info, source):
+        q.add(self.full_name, info['value'], type='gauge', source=source)
+        return 1
+
+
+def _add_sample_rate(q, name, full_name, source):
+    """Add the sample rate of a sampled metric, returning the count added."""
+    sample_rate = get_sample_rate(name)
+    if sample_rate is None:
+        return 0
+    q.add('.'.join((full_name, 'sample_rate')), sample_rate, type='gauge',
+          source=source)
+    return 1
+
+
+class _MeterPlan(_EmissionPlan):
+    __slots__ = ('reporter', 'name', 'full_name', 'count_name', 'rate_names')
+
+    # pairs of appmetrics metrics names with their counterparts on librato
+    meter_names = (('one', '1m'), ('five', '5m'))
+    # the measurement type of the count delta
+    count_type = 'gauge'
+
+    def __init__(self, reporter, name, full_name):
+        self.reporter = reporter
+        self.name = name
+        self.full_name = full_name
+        self.count_name = '.'.join((full_name, 'count'))
+        self.rate_names = tuple(
+            (appmetrics_name, '.'.join((full_name, librato_name)))
+            for appmetrics_name, librato_name in self.meter_names)
+
+    def add(self, q, info, source):
+        _add_count(
+            q, self.count_name, self.reporter.deltas[self.name],
+            type=self.count_type, source=source)
+        for appmetrics_name, librato_name in self.rate_names:
+            q.add(librato_name, info[appmetrics_name], type='gauge',
+                  source=source)
+        return 1 + len(self.rate_names) + _add_sample_rate(
+            q, self.name, self.full_name, source)
+
+
+class _HistogramPlan(_EmissionPlan):
+    __slots__ = ('name', 'full_name', 'percentile_names')
+
+    def __init__(self, reporter, name, full_name):
+        self.name = name
+        self.full_name = full_name
+        # Percentile levels are only known once values are read
+        self.percentile_names = {}
+
+    def add(self, q, info, source):
+        n = info['n']
+        # Librato will reject if n is not > 0
+        if n <= 0:
+            return 0
+        q.add(self.full_name,
+              None,
+              type='gauge',
+              count=n,
+              sum=(n * info['arithmetic_mean']),
+              max=info['max'],
+              min=info['min'],
+              source=source)
+        added = 1
+        percentile_names = self.percentile_names
+        for percentile, value in info['percentile']:
+            librato_name = percentile_names.get(percentile)
+            if librato_name is None:
+                librato_name = percentile_names[percentile] = '.'.join(
+                    (self.full_name, str(percentile)))
+            q.add(librato_name, value, type='gauge', source=source)
+            added += 1
+        return added + _add_sample_rate(q, self.name, self.full_name, source)
+
+
+_PLANS_BY_KIND = {
+    'gauge': _GaugePlan,
+    'meter': _MeterPlan,
+    'histogram': _HistogramPlan,
+}
@@ -0,0 +1,225 @@
+"""Mergeable, fixed-memory quantile sketches.
+
+`DDSketch` implements the sketch described in "DDSketch: A Fast and
+Fully-Mergeable Quantile Sketch with Relative-Error Guarantees"
+(Masson et al., 2019). Values are counted in logarithmically sized buckets,
+so every quantile is estimated within a relative error of
+`relative_accuracy`, inserts take constant time and two sketches with the
+same parameters merge exactly.
+"""
+from __future__ import absolute_import, division
+
+import math
+import threading
+
+from .histogram import PERCENTILE_LEVELS, as_floats, get_numpy
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+
+class DDSketch(object):
+    """A quantile sketch with bounded relative error.
+
+    At most `max_bins` buckets are kept for each sign. Beyond that, the
+    buckets closest to zero are collapsed together, which only degrades the
+    accuracy of the lowest quantiles.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_bins=DEFAULT_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def same_kind(self, other):
+        """Return whether `other` can be merged into this sketch."""
+        return (isinstance(other, DDSketch) and
+                self.relative_accuracy == other.relative_accuracy and
+                self.max_bins == other.max_bins)
+
+    def add(self, value, count=1):
+        """Add a value to the sketch `count` times."""
+        value = float(value)
+        if value > 0:
+            bins = self.positive
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+        elif value < 0:
+            bins = self.negative
+            index = int(math.ceil(math.log(-value) / self.log_gamma))
+        else:
+            bins = None
+            self.zero_count += count
+        if bins is not None:
+            bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def add_many(self, values):
+        """Add many values to the sketch at once."""
+        values = as_floats(values)
+        numpy = get_numpy()
+        if numpy is None:
+            for value in values:
+                self.add(value)
+            return
+        if not len(values):
+            return
+        for bins, magnitudes in ((self.positive, values[values > 0]),
+                                 (self.negative, -values[values < 0])):
+            if not len(magnitudes):
+                continue
+            indices, counts = numpy.unique(
+                numpy.ceil(numpy.log(magnitudes) / self.log_gamma).astype(
+                    numpy.int64),
+                return_counts=True)
+            for index, count in zip(indices.tolist(), counts.tolist()):
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero_count += int((values == 0).sum())
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        """Add every value counted by another sketch to this one."""
+        if not self.same_kind(other):
+            raise ValueError('Cannot merge sketches with different parameters')
+        for bins, other_bins in ((self.positive, other.positive),
+                                 (self.negative, other.negative)):
+            for index, count in other_bins.items():
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        sketch = DDSketch(self.relative_accuracy, self.max_bins)
+        sketch.merge(self)
+        return sketch
+
+    def quantile(self, q):
+        """Estimate the value at quantile `q`, between 0 and 1."""
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return self._clamp(-self._value(index))
+        seen += self.zero_count
+        if seen > rank:
+            return self._clamp(0.0)
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._clamp(self._value(index))
+        return self.max
+
+    def quantiles(self, qs):
+        """Estimate the values at several ascending quantiles in one pass."""
+        if not self.count:
+            return [0.0] * len(qs)
+        buckets = [
+            (-self._value(index), self.negative[index])
+            for index in sorted(self.negative, reverse=True)]
+        buckets.append((0.0, self.zero_count))
+        buckets.extend(
+            (self._value(index), self.positive[index])
+            for index in sorted(self.positive))
+        results = []
+        position, seen = 0, buckets[0][1]
+        for q in qs:
+            rank = q * (self.count - 1)
+            while seen <= rank and position + 1 < len(buckets):
+                position += 1
+                seen += buckets[position][1]
+            results.append(self._clamp(buckets[position][0]))
+        return results
+
+    def _value(self, index):
+        # The midpoint, in relative terms, of the bucket's value range
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    def _collapse(self, bins):
+        # Fold the buckets closest to zero into the lowest remaining one
+        indices = sorted(bins)
+        excess = len(indices) - self.max_bins
+        target = indices[excess]
+        for index in indices[:excess]:
+            bins[target] += bins.pop(index)
+
+
+class SketchHistogram(object):
+    """A histogram metric backed by a `DDSketch` instead of a reservoir.
+
+    Its `get` returns the same `n`, `min`, `max`, `arithmetic_mean`,
+    `median` and `percentile` fields as an appmetrics histogram.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_bins=DEFAULT_MAX_BINS):
+        self.sketch = DDSketch(relative_accuracy, max_bins)
+        self.lock = threading.Lock()
+
+    def notify(self, value):
+        """Add a new value to the metric"""
+        with self.lock:
+            self.sketch.add(value)
+
+    def notify_many(self, values):
+        """Add many values to the metric"""
+        with self.lock:
+            self.sketch.add_many(values)
+
+    def merge(self, sketch):
+        """Add every value counted by a sketch to the metric."""
+        with self.lock:
+            self.sketch.merge(sketch)
+
+    def raw_data(self):
+        """Return a copy of the underlying sketch"""
+        with self.lock:
+            return self.sketch.copy()
+
+    def get(self):
+        """Return the computed statistics over the gathered data"""
+        with self.lock:
+            sketch = self.sketch
+            n = sketch.count
+            quantiles = sketch.quantiles(
+                [level / 100 for level in PERCENTILE_LEVELS])
+            return dict(
+                kind='histogram',
+                n=n,
+                min=sketch.min if n else 0,
+                max=sketch.max if n else 0,
+                arithmetic_mean=sketch.sum / n if n else 0.0,
+                median=quantiles[0],
+                percentile=list(zip(PERCENTILE_LEVELS, quantiles)))
@@ -0,0 +1,320 @@
+"""A compact binary snapshot of the metrics registry.
+
+A snapshot stores the values reporters receive as columns of fixed-size
+numbers rather than as a dict per metric, so it is cheap to write to a file
+or send to another process::
+
+    data = snapshot.dumps()
+    ...
+    reporter(snapshot.Snapshot(data))
+
+`Snapshot` reads a snapshot in place from any buffer, such as bytes or an
+`mmap`, and is a read-only mapping of metric names to the dicts reporters
+expect, built on access. Its columns can also be read directly.
+
+All numbers are little-endian. The layout of version 1 is a header
+
+    magic ``b'SSMS'``, version (u16), number of percentile levels (u16),
+    number of metrics, of gauges and counters, of meters and of histograms,
+    size of the names, reserved (u32 each), timestamp (f64)
+
+followed by these columns, each padded to a multiple of 8 bytes:
+
+    ============= ======================= =================================
+    column        type                    content
+    ============= ======================= =================================
+    levels        f64 x levels            the percentile levels
+    values        f64 x gauges            gauge and counter values
+    meter_counts  i64 x meters            meter counts
+    rates         f64 x meters x 5        mean, one, five, fifteen and day
+                                          meter rates
+    counts        i64 x histograms        histogram sample counts
+    stats         f64 x histograms x 4    min, max, arithmetic mean and
+                                          median of histograms
+    percentiles   f64 x histograms        histogram percentiles, NaN where
+                  x levels                missing
+    offsets       u32 x (metrics + 1)     where each name starts in the
+                                          names, and where they end
+    slots         u32 x metrics           the index of each metric in the
+                                          columns of its kind
+    kinds         u8 x metrics            indices into `KINDS`
+    names         utf-8                   metric names, concatenated
+    ============= ======================= =================================
+
+Metrics are sorted by name. Gauges without a numeric value and metrics of
+other kinds are left out.
+"""
+from __future__ import absolute_import
+
+import bisect
+import math
+import mmap
+import numbers
+import struct
+import sys
+import time
+
+from appmetrics import reporter as appmetrics_reporter
+
+from .histogram import PERCENTILE_LEVELS
+from .spool import _write_atomically
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+MAGIC = b'SSMS'
+VERSION = 1
+KINDS = ('gauge', 'counter', 'meter', 'histogram')
+RATES = ('mean', 'one', 'five', 'fifteen', 'day')
+STATS = ('min', 'max', 'arithmetic_mean', 'median')
+
+_HEADER = struct.Struct('<4sHHIIIIIId')
+_KIND_CODES = dict((kind, code) for code, kind in enumerate(KINDS))
+# Columns can only be viewed in place when stored in the native byte order
+_ZERO_COPY = sys.byteorder == 'little' and hasattr(memoryview, 'cast')
+
+
+def _padding(size):
+    return b'\0' * (-size % 8)
+
+
+def _pack(code, values):
+    data = struct.pack('<{:d}{}'.format(len(values), code), *values)
+    return data + _padding(len(data))
+
+
+def _number(value):
+    if value is None:
+        return float('nan')
+    return float(value)
+
+
+def dumps(metrics=None, timestamp=None):
+    """Encode metrics, by default those of the registry, to a snapshot.
+
+    `metrics` maps names to the dicts returned by `get` of appmetrics
+    metrics, as passed to reporters. `timestamp` defaults to now.
+
+    Reading the registry ends the interval of every `IntervalHistogram`,
+    as a report does, so snapshots of a registry whose interval histograms
+    are reported should be taken from the reporter's metrics instead.
+    """
+    if metrics is None:
+        metrics = appmetrics_reporter.get_metrics(None)
+    if timestamp is None:
+        timestamp = time.time()
+    levels = PERCENTILE_LEVELS
+    names, kinds, slots = [], [], []
+    values, meter_counts, rates = [], [], []
+    counts, stats, percentiles = [], [], []
+    for name, info in sorted(metrics.items()):
+        kind = info['kind']
+        code = _KIND_CODES.get(kind)
+        if code is None:
+            continue
+        if kind == 'meter':
+            slots.append(len(meter_counts))
+            meter_counts.append(int(info['count']))
+            rates.extend(float(info[rate]) for rate in RATES)
+        elif kind == 'histogram':
+            slots.append(len(counts))
+            counts.append(int(info['n']))
+            stats.extend(_number(info[stat]) for stat in STATS)
+            by_level = dict(info['percentile'])
+            percentiles.extend(
+                _number(by_level.get(level)) for level in levels)
+        else:
+            value = info['value']
+            if not isinstance(value, numbers.Real):
+                continue
+            slots.append(len(values))
+            values.append(float(value))
+        names.append(name.encode('utf-8'))
+        kinds.append(code)
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    blob = b''.join(names)
+    return b''.join((
+        _HEADER.pack(
+            MAGIC, VERSION, len(levels), len(names), len(values),
+            len(meter_counts), len(counts), len(blob), 0, timestamp),
+        _pack('d', levels),
+        _pack('d', values),
+        _pack('q', meter_counts),
+        _pack('d', rates),
+        _pack('q', counts),
+        _pack('d', stats),
+        _pack('d', percentiles),
+        _pack('I', offsets),
+        _pack('I', slots),
+        _pack('B', kinds),
+        blob,
+        _padding(len(blob)),
+    ))
+
+
+def dump(path, metrics=None, timestamp=None):
+    """Write a snapshot of metrics, by default of the registry, to a file.
+
+    The file is replaced atomically, so it can be loaded at any time.
+    """
+    _write_atomically(path, dumps(metrics, timestamp))
+
+
+def load(path):
+    """Map a snapshot file into memory and return it as a `Snapshot`.
+
+    The file stays mapped until the snapshot is released.
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(mapped, _mapped=mapped)
+
+
+class Snapshot(Mapping):
+    """A snapshot read in place from a buffer.
+
+    Columns are exposed as attributes named as in the layout, which are
+    flat memoryviews of numbers, or tuples on Python 2 and big-endian
+    platforms. The columns of a metric's kind are indexed by its slot, in
+    groups of 5 rates, 4 stats or one percentile per level. Names are only
+    decoded when read, and are looked up by bisecting the sorted names.
+
+    Views of the buffer are held until `release` is called, which an `mmap`
+    needs before it can be closed.
+    """
+
+    def __init__(self, buffer, _mapped=None):
+        # Without zero-copy columns, the buffer is read through slices,
+        # which Python 2's mmap supports but not its memoryview
+        view = memoryview(buffer) if _ZERO_COPY else buffer
+        if len(view) < _HEADER.size:
+            raise ValueError('Snapshot is truncated')
+        (magic, version, levels, count, scalars, meters, histograms,
+         names_size, _, self.timestamp) = _HEADER.unpack(
+             bytes(view[:_HEADER.size]))
+        if magic != MAGIC:
+            raise ValueError('Not a metrics snapshot')
+        if version != VERSION:
+            raise ValueError(
+                'Unsupported snapshot version: {:d}'.format(version))
+        self.mapped = _mapped
+        self.views = [view] if _ZERO_COPY else []
+        self.end = _HEADER.size
+        self.levels = self._column(view, 'd', levels)
+        self.values = self._column(view, 'd', scalars)
+        self.meter_counts = self._column(view, 'q', meters)
+        self.rates = self._column(view, 'd', meters * len(RATES))
+        self.counts = self._column(view, 'q', histograms)
+        self.stats = self._column(view, 'd', histograms * len(STATS))
+        self.percentiles = self._column(view, 'd', histograms * levels)
+        self.offsets = self._column(view, 'I', count + 1)
+        self.slots = self._column(view, 'I', count)
+        self.kinds = self._column(view, 'B', count)
+        self.count = count
+        start, self.end = self.end, self.end + names_size
+        if self.end > len(view):
+            raise ValueError('Snapshot is truncated')
+        # Sliced into the bytes of each name
+        self.blob = view[start:self.end]
+        if _ZERO_COPY:
+            self.views.append(self.blob)
+
+    def _column(self, view, code, length):
+        size = struct.calcsize(code) * length
+        start, end = self.end, self.end + size
+        if end > len(view):
+            raise ValueError('Snapshot is truncated')
+        self.end = end + -size % 8
+        if not _ZERO_COPY:
+            return struct.unpack(
+                '<{:d}{}'.format(length, code), bytes(view[start:end]))
+        data = view[start:end]
+        column = data.cast(code)
+        self.views.extend((data, column))
+        return column
+
+    def __getitem__(self, name):
+        return self.info(self.find(name))
+
+    def __iter__(self):
+        return (self.name(row) for row in range(self.count))
+
+    def __len__(self):
+        return self.count
+
+    def name(self, row):
+        """Return the name of the metric in a row."""
+        return self._name_bytes(row).decode('utf-8')
+
+    def _name_bytes(self, row):
+        return bytes(self.blob[self.offsets[row]:self.offsets[row + 1]])
+
+    def find(self, name):
+        """Return the row of a metric, or raise `KeyError`."""
+        key = name.encode('utf-8')
+        names = _SortedNames(self)
+        row = bisect.bisect_left(names, key)
+        if row == self.count or names[row] != key:
+            raise KeyError(name)
+        return row
+
+    def kind(self, row):
+        """Return the kind of metric in a row."""
+        return KINDS[self.kinds[row]]
+
+    def info(self, row):
+        """Return the dict of a row, as returned by the metric's `get`."""
+        kind = KINDS[self.kinds[row]]
+        slot = self.slots[row]
+        if kind == 'meter':
+            start = slot * len(RATES)
+            info = dict(zip(RATES, self.rates[start:start + len(RATES)]))
+            info.update(kind=kind, count=self.meter_counts[slot])
+            return info
+        if kind != 'histogram':
+            return dict(kind=kind, value=self.values[slot])
+        start = slot * len(STATS)
+        info = dict(zip(STATS, self.stats[start:start + len(STATS)]))
+        levels = len(self.levels)
+        start = slot * levels
+        info.update(
+            kind=kind,
+            n=self.counts[slot],
+            percentile=[
+                (_level(level), value) for level, value in zip(
+                    self.levels, self.percentiles[start:start + levels])
+                if not math.isnan(value)])
+        return info
+
+    def release(self):
+        """Release the views of the buffer, and unmap a loaded file."""
+        for view in reversed(self.views):
+            view.release()
+        del self.views[:]
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class _SortedNames(object):
+    """The encoded names of a snapshot as a sequence, for bisecting."""
+
+    __slots__ = ('snapshot',)
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, row):
+        return self.snapshot._name_bytes(row)
+
+    def __len__(self):
+        return self.snapshot.count
+
+
+def _level(level):
+    # Levels are stored as floats, but integral ones are named as ints
+    return int(level) if level == int(level) else level
@@ -0,0 +1,217 @@
+"""Keep librato payloads on disk while librato cannot be reached.
+
+A `Spool` holds the batches a `BatchSubmitter` failed to submit, so they can
+be replayed once librato recovers, even after a restart::
+
+    reporter = LibratoReporter(
+        librato_email, librato_token, spool=Spool('/var/spool/myapp'))
+
+Each interval's failed batches are written to a segment file of their own.
+Segment files are replaced rather than modified. When there are more than
+`compact_after` segments, the oldest are merged into one, and when the spool
+grows past `max_bytes`, the oldest batches are discarded.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+import zlib
+
+from . import logger
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_COMPACT_AFTER = 16
+
+_SEGMENT_SUFFIX = '.seg'
+_CHECKPOINT = 'checkpoint.json'
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _write_atomically(path, data):
+    """Write a file so that it is either complete or not there at all."""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(temporary, path)
+
+
+def _encode(batches):
+    return zlib.compress(
+        b'\n'.join(json.dumps(batch).encode('utf-8') for batch in batches))
+
+
+def _decode(data):
+    return [json.loads(line.decode('utf-8'))
+            for line in zlib.decompress(data).split(b'\n')]
+
+
+class _Segment(object):
+    """A spooled file of batches.
+
+    A segment is named after the range of sequences it holds the batches of,
+    which spans several once segments are merged, and its batch count.
+    """
+
+    __slots__ = ('path', 'first', 'last', 'batches', 'size')
+
+    def __init__(self, path, first, last, batches, size):
+        self.path = path
+        self.first = first
+        self.last = last
+        self.batches = batches
+        self.size = size
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return _decode(f.read())
+
+
+class Spool(object):
+    """An on-disk queue of librato batches, along with a checkpoint.
+
+    Segments are compressed and written atomically, so a crash never leaves
+    a partial segment behind. Batches discarded to keep the spool within
+    `max_bytes` are counted in `dropped`.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES,
+                 compact_after=DEFAULT_COMPACT_AFTER):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compact_after = compact_after
+        self.dropped = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = self._scan()
+        self.next_sequence = (
+            self.segments[-1].last + 1 if self.segments else 0)
+
+    @property
+    def pending(self):
+        """The number of spooled batches."""
+        return sum(segment.batches for segment in self.segments)
+
+    def append(self, batches):
+        """Spool a list of batches as a new segment."""
+        if not batches:
+            return
+        with self.lock:
+            self.segments.append(self._write(
+                self.next_sequence, self.next_sequence, batches))
+            self.next_sequence += 1
+            if len(self.segments) > self.compact_after:
+                self._compact()
+            self._trim()
+
+    def replay(self, send, limit=None):
+        """Pass spooled batches to `send`, oldest first, until it fails.
+
+        `send` returns whether the batch was consumed. At most `limit`
+        batches are passed, if given. Return the number of batches consumed.
+        """
+        consumed = 0
+        with self.lock:
+            while self.segments:
+                segment = self.segments[0]
+                batches = segment.read()
+                for index, batch in enumerate(batches):
+                    if consumed == limit or not send(batch):
+                        if index:
+                            self._keep(segment, batches[index:])
+                        return consumed
+                    consumed += 1
+                os.remove(segment.path)
+                self.segments.pop(0)
+        return consumed
+
+    def save_checkpoint(self, state):
+        """Save a JSON-serializable state, replacing the previous one."""
+        _write_atomically(
+            os.path.join(self.directory, _CHECKPOINT),
+            json.dumps(state).encode('utf-8'))
+
+    def load_checkpoint(self):
+        """Load the saved state, or return None if there is none."""
+        try:
+            with open(os.path.join(self.directory, _CHECKPOINT), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _scan(self):
+        segments = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(_SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                first, last, batches = map(
+                    int, filename[:-len(_SEGMENT_SUFFIX)].split('-'))
+            except ValueError:
+                logger.warning('Ignoring unexpected spool file %s', path)
+                continue
+            segments.append(
+                _Segment(path, first, last, batches, os.path.getsize(path)))
+        # Widest and then smallest first, so that segments left over by an
+        # interrupted compaction or replay follow the segment replacing them
+        segments.sort(key=lambda segment: (
+            segment.first, -segment.last, segment.batches))
+        kept = []
+        for segment in segments:
+            if kept and segment.last <= kept[-1].last:
+                os.remove(segment.path)
+            else:
+                kept.append(segment)
+        return kept
+
+    def _write(self, first, last, batches):
+        path = os.path.join(self.directory, '{:020d}-{:020d}-{:d}{}'.format(
+            first, last, len(batches), _SEGMENT_SUFFIX))
+        data = _encode(batches)
+        _write_atomically(path, data)
+        return _Segment(path, first, last, len(batches), len(data))
+
+    def _keep(self, segment, batches):
+        # Replace the oldest segment with its newest batches, under the same
+        # sequences
+        self.segments[0] = self._write(segment.first, segment.last, batches)
+        os.remove(segment.path)
+
+    def _compact(self):
+        # The newest segment is left alone, as it is the likeliest to be
+        # replayed soon. Merged segments compress better together.
+        merged = self.segments[:-1]
+        batches = []
+        for segment in merged:
+            batches.extend(segment.read())
+        compacted = self._write(merged[0].first, merged[-1].last, batches)
+        for segment in merged:
+            if segment.path != compacted.path:
+                os.remove(segment.path)
+        self.segments[:-1] = [compacted]
+
+    def _trim(self):
+        size = sum(segment.size for segment in self.segments)
+        while size > self.max_bytes and self.segments:
+            segment = self.segments[0]
+            # Only as many of the oldest batches as needed are dropped, as a
+            # compacted segment may hold most of the spool. Their size is
+            # estimated from the segment's.
+            dropped = min(segment.batches, -(
+                -(size - self.max_bytes) * segment.batches // segment.size))
+            if dropped < segment.batches:
+                self._keep(segment, segment.read()[dropped:])
+                size += self.segments[0].size - segment.size
+            else:
+                self.segments.pop(0)
+                os.remove(segment.path)
+                size -= segment.size
+            self.dropped += dropped
+            logger.warning(
+                'Spool is full, dropped %d batches (%d total)',
+                dropped, self.dropped)
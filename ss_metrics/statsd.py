@@ -0,0 +1,318 @@
+"""Report metrics to a StatsD or DogStatsD agent over UDP.
+
+`StatsdReporter` is an appmetrics reporter: every interval it emits the
+registry's metrics the same way `LibratoReporter` does, with meter counts
+sent as counter deltas. `StatsdClient` instead skips the registry entirely
+and emits every update as it is recorded::
+
+    metrics.set_forwarder(StatsdClient('localhost', 8125))
+
+Both coalesce measurements into datagrams of at most `max_packet_size`
+bytes, sent over a single socket.
+"""
+from __future__ import absolute_import
+
+import numbers
+import re
+import socket
+import threading
+import time
+
+from . import logger
+from .metrics import DEFAULT_KEEPALIVE, split_series_key
+from .reporter import (
+    _PLANS_BY_KIND, CycleStats, _MeterPlan, _PlannedReporter,
+    _UnsupportedKindPlan)
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8125
+# Fits in a single Ethernet frame along with the IP and UDP headers
+DEFAULT_MAX_PACKET_SIZE = 1432
+
+# StatsD types of librato measurement types and appmetrics metric kinds.
+# Histograms are sent as DogStatsD histograms, which StatsD takes as timings,
+# as their values, such as the seconds of timers, are not in milliseconds.
+_TYPES = {
+    'counter': b'c',
+    'gauge': b'g',
+    'histogram': b'h',
+    'meter': b'c',
+}
+
+# Characters with a meaning in the StatsD line protocol
+_RESERVED = re.compile(r'[:|@#,\s]')
+
+
+def format_name(name):
+    """Replace the characters StatsD does not allow in metric names."""
+    return _RESERVED.sub('_', name)
+
+
+def format_value(value):
+    """Format a number for StatsD, or return None for other values."""
+    if isinstance(value, bool) or not isinstance(value, numbers.Real):
+        return None
+    if isinstance(value, numbers.Integral):
+        return str(int(value)).encode('ascii')
+    return repr(float(value)).encode('ascii')
+
+
+def format_tags(tags, series_tags=()):
+    """Format DogStatsD tags, and the (tag, value) pairs of a series.
+
+    Return a line suffix.
+    """
+    tags = list(tags or ())
+    tags.extend(':'.join(pair) for pair in series_tags)
+    if not tags:
+        return b''
+    return b'|#' + ','.join(tags).encode('utf-8')
+
+
+class Packets(object):
+    """Coalesce StatsD lines into datagrams of at most `max_size` bytes.
+
+    A line longer than `max_size` is sent in a datagram of its own.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_PACKET_SIZE):
+        self.max_size = max_size
+        self.packets = []
+        self.lines = []
+        self.size = 0
+
+    def add(self, line):
+        """Add a line, completing a datagram if the line does not fit."""
+        if self.lines and self.size + 1 + len(line) > self.max_size:
+            self.complete()
+        self.size += len(line) + (1 if self.lines else 0)
+        self.lines.append(line)
+
+    def complete(self):
+        """Complete the datagram being filled."""
+        if self.lines:
+            self.packets.append(b'\n'.join(self.lines))
+            self.lines = []
+            self.size = 0
+
+    def drain(self):
+        """Return all datagrams, including the one being filled."""
+        self.complete()
+        packets, self.packets = self.packets, []
+        return packets
+
+
+class _StatsdSocket(object):
+    """A UDP socket shared by every datagram sent to one agent.
+
+    The socket is connected to the agent, so that its address is resolved
+    once rather than for every datagram.
+    """
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = None
+        self.dropped = 0
+
+    def send(self, packets):
+        for packet in packets:
+            try:
+                if self.sock is None:
+                    self.sock = self.connect()
+                self.sock.send(packet)
+            except socket.error:
+                self.dropped += 1
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.address)
+        except socket.error:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        return sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class _StatsdQueue(object):
+    """Format measurements added as if to a librato queue as StatsD lines."""
+
+    def __init__(self, packets, tags):
+        self.packets = packets
+        self.tags = tags
+        self.suffix = format_tags(tags)
+        # Suffixes by the identity of the tags dict of each tagged series
+        self.tagged_suffixes = {}
+
+    def add(self, name, value, type='gauge', source=None, tags=None,
+            **properties):
+        suffix = self.suffix
+        if tags is not None:
+            suffix = self.tagged_suffixes.get(id(tags))
+            if suffix is None:
+                suffix = self.tagged_suffixes[id(tags)] = format_tags(
+                    self.tags, sorted(tags.items()))
+        if value is None:
+            # An aggregated histogram measurement
+            for field in ('count', 'sum', 'max', 'min'):
+                self.add_line(
+                    '.'.join((name, field)), properties[field], b'g', suffix)
+        else:
+            self.add_line(name, value, _TYPES[type], suffix)
+
+    def add_line(self, name, value, statsd_type, suffix):
+        value = format_value(value)
+        if value is not None:
+            self.packets.add(b''.join((
+                format_name(name).encode('utf-8'), b':', value, b'|',
+                statsd_type, suffix)))
+
+
+class _StatsdMeterPlan(_MeterPlan):
+    __slots__ = ()
+
+    count_type = 'counter'
+
+
+_STATSD_PLANS_BY_KIND = dict(_PLANS_BY_KIND, meter=_StatsdMeterPlan)
+
+
+class StatsdReporter(_PlannedReporter):
+    """Report metrics to a StatsD agent over UDP.
+
+    Gauges and histograms are reported like `LibratoReporter` reports them,
+    and the change in a meter's count since the previous interval is sent as
+    a counter. Non-numeric gauge values are skipped. `tags` are appended to
+    every measurement using the DogStatsD extension, along with the tags of
+    tagged series.
+
+    Datagrams that cannot be sent are counted in `dropped`.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 metric_prefix=None, tags=None,
+                 max_packet_size=DEFAULT_MAX_PACKET_SIZE,
+                 changed_only=False, keepalive=DEFAULT_KEEPALIVE):
+        super(StatsdReporter, self).__init__(
+            metric_prefix, changed_only, keepalive)
+        self.tags = tags
+        self.max_packet_size = max_packet_size
+        self.socket = _StatsdSocket(host, port)
+
+    @property
+    def dropped(self):
+        return self.socket.dropped
+
+    def __call__(self, metrics):
+        start = time.time()
+        packets = Packets(self.max_packet_size)
+        measurements = self.add_measurements(
+            _StatsdQueue(packets, self.tags), metrics)
+        packets = packets.drain()
+        self.socket.send(packets)
+        self.last_cycle = CycleStats(time.time() - start, measurements)
+        logger.info(
+            'Reported %d measurements to statsd in %d datagrams in %.3fs',
+            measurements, len(packets), self.last_cycle.duration)
+
+    def plan_class(self, kind):
+        return _STATSD_PLANS_BY_KIND.get(kind, _UnsupportedKindPlan)
+
+    def close(self):
+        self.socket.close()
+
+
+class _StatsdBinding(object):
+    """A stand-in for a registry metric that emits its updates."""
+
+    __slots__ = ('client', 'prefix', 'suffix')
+
+    def __init__(self, client, kind, name):
+        self.client = client
+        metric_name, tags = split_series_key(name)
+        self.prefix = format_name(metric_name).encode('utf-8') + b':'
+        self.suffix = b'|' + _TYPES[kind] + format_tags(client.tags, tags)
+
+    def notify(self, value):
+        value = format_value(value)
+        if value is not None:
+            self.client.emit(self.prefix + value + self.suffix)
+
+
+class StatsdClient(object):
+    """Emit metric updates straight to a StatsD agent.
+
+    Installed with `metrics.set_forwarder`, updates skip the appmetrics
+    registry: meters are sent as counters, gauges as gauges, and histograms
+    and timers as DogStatsD histograms of the values recorded, so timers
+    are in seconds. The tags of tagged series are sent as DogStatsD tags.
+
+    With a `max_delay`, lines are coalesced and a datagram is sent once it
+    is full or its first line is older than `max_delay` seconds. As this is
+    only checked when a line is added, `flush` should be called periodically
+    and before exiting. Without it, every update is sent immediately.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, tags=None,
+                 max_packet_size=DEFAULT_MAX_PACKET_SIZE, max_delay=None):
+        self.tags = tags
+        self.max_delay = max_delay
+        self.packets = Packets(max_packet_size)
+        self.socket = _StatsdSocket(host, port)
+        self.bindings = {}
+        self.lock = threading.Lock()
+        self.oldest = None
+
+    @property
+    def dropped(self):
+        return self.socket.dropped
+
+    def send(self, kind, name, value, reservoir_type=None):
+        """Emit a single metric update."""
+        self.bind(kind, name).notify(value)
+
+    def bind(self, kind, name):
+        """Get an object whose `notify` emits updates of a metric."""
+        key = (kind, name)
+        binding = self.bindings.get(key)
+        if binding is None:
+            binding = self.bindings[key] = _StatsdBinding(self, kind, name)
+        return binding
+
+    def emit(self, line):
+        """Send a formatted line, or buffer it with a `max_delay`."""
+        if self.max_delay is None:
+            self.socket.send((line,))
+            return
+        now = time.time()
+        with self.lock:
+            if self.oldest is None:
+                self.oldest = now
+            self.packets.add(line)
+            if now - self.oldest < self.max_delay:
+                packets = self.packets.packets
+                if packets:
+                    # Only the line just added is left in the buffer
+                    self.packets.packets = []
+                    self.oldest = now
+            else:
+                packets = self.packets.drain()
+                self.oldest = None
+        if packets:
+            self.socket.send(packets)
+
+    def flush(self):
+        """Send any buffered lines."""
+        with self.lock:
+            packets = self.packets.drain()
+            self.oldest = None
+        self.socket.send(packets)
+
+    def close(self):
+        self.flush()
+        self.socket.close()
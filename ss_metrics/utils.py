@@ -1,36 +1,77 @@
 from __future__ import absolute_import
 
+import functools
 import inspect
+import weakref
+
+try:
+    from sys import intern
+except ImportError:  # Python 2, where it is a builtin
+    pass
+
+# Resolved names by function or callable, and by class for the functions
+# of methods, dropped along with the functions
+_names = weakref.WeakKeyDictionary()
+_method_names = weakref.WeakKeyDictionary()
 
 
 def get_function_name(fn):
     """Get the fully qualified name of a function.
 
-    This function accounts for module-level functions and instance methods.
+    This function accounts for module-level functions, instance methods,
+    `functools.partial` objects, which are named after the function they
+    wrap, and callable objects, which are named after their class. Names are
+    interned and memoized.
     """
-    module = inspect.getmodule(fn)
-    if module is None:
-        raise ValueError(
-            'Could not resolve module for function {name}'.format(
-                name=fn.__name__))
-    module_name = module.__name__
-    if inspect.isfunction(fn):
-        try:
-            # Unbound python3 method
-            qualname = fn.__qualname__
-        except AttributeError:
-            qualname = fn.__name__
-    elif inspect.ismethod(fn):
+    if inspect.ismethod(fn):
+        function = fn.__func__
         instance = fn.__self__
         if instance is None:
             # Unbound python2 method
-            qualname = '.'.join((fn.im_class.__name__, fn.__name__))
+            cls = fn.im_class
         else:
             # Bound method
             cls = instance if inspect.isclass(instance) else type(instance)
-            qualname = '.'.join((cls.__name__, fn.__name__))
-    else:
+        names = _method_names.get(function)
+        if names is None:
+            names = _method_names.setdefault(function, {})
+        name = names.get(cls)
+        if name is None:
+            name = names[cls] = _qualify(
+                function, '.'.join((cls.__name__, fn.__name__)))
+        return name
+    try:
+        return _names[fn]
+    except (KeyError, TypeError):
+        # Not resolved yet, or not weakly referenceable
+        pass
+    name = _resolve(fn)
+    try:
+        _names[fn] = name
+    except TypeError:
+        pass
+    return name
+
+
+def _resolve(fn):
+    if isinstance(fn, functools.partial):
+        return get_function_name(fn.func)
+    if inspect.isfunction(fn) or inspect.isbuiltin(fn):
+        # Including python3 unbound methods and coroutine functions
+        return _qualify(fn, getattr(fn, '__qualname__', fn.__name__))
+    if callable(fn) and not inspect.isclass(fn):
+        cls = type(fn)
+        return _qualify(cls, getattr(cls, '__qualname__', cls.__name__))
+    raise ValueError(
+        'Could not resolve qualified name for function {name}'.format(
+            name=getattr(fn, '__name__', fn)))
+
+
+def _qualify(obj, qualname):
+    # Failures are not memoized, as the module may be set later
+    module_name = getattr(obj, '__module__', None)
+    if module_name is None:
         raise ValueError(
-            'Could not resolve qualified name for function {name}'.format(
-                name=fn.__name__))
-    return '.'.join((module_name, qualname))
+            'Could not resolve module for function {name}'.format(
+                name=getattr(obj, '__name__', obj)))
+    return intern('.'.join((module_name, qualname)))
@@ -0,0 +1,181 @@
+from __future__ import absolute_import
+
+import asyncio
+
+import appmetrics.metrics as _metrics
+import mock
+import pytest
+
+from ss_metrics import metrics
+from ss_metrics.aio import (
+    AsyncLibratoReporter, AsyncSubmitter, report_forever, start_reporting)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def submit(submitter, chunks):
+    try:
+        return await submitter.submit(chunks)
+    finally:
+        submitter.close()
+
+
+def only_metric(suffix):
+    name, = [name for name in _metrics.REGISTRY if name.endswith(suffix)]
+    return _metrics.metric(name)
+
+
+@pytest.mark.usefixtures('mock_metrics_registry')
+class TestDecorators(object):
+    def test_timed_coroutine(self):
+        @metrics.timed
+        async def sleepy():
+            await asyncio.sleep(0.05)
+            return 'done'
+
+        assert asyncio.iscoroutinefunction(sleepy)
+        assert run(sleepy()) == 'done'
+        timing, = only_metric('.sleepy.timer').raw_data()
+        assert timing >= 0.05
+
+    def test_with_meter_coroutine(self):
+        @metrics.with_meter
+        async def metered():
+            pass
+
+        coroutine = metered()
+        assert len(_metrics.REGISTRY) == 0
+        run(coroutine)
+        assert only_metric('.metered.rate').get()['count'] == 1
+
+    def test_failed_coroutine_is_not_recorded(self):
+        @metrics.timed
+        async def failing():
+            raise ValueError
+
+        with pytest.raises(ValueError):
+            run(failing())
+        assert only_metric('.failing.timer').raw_data() == []
+
+    def test_async_generator(self):
+        @metrics.timed
+        @metrics.with_meter
+        async def producer():
+            for index in range(3):
+                await asyncio.sleep(0.02)
+                yield index
+
+        async def consume():
+            items = []
+            async for item in producer():
+                items.append(item)
+                # Time spent by the consumer is not counted
+                await asyncio.sleep(0.05)
+            return items
+
+        assert run(consume()) == [0, 1, 2]
+        timing, = only_metric('.producer.timer').raw_data()
+        assert 0.06 <= timing < 0.15
+        assert only_metric('.producer.rate').get()['count'] == 1
+
+    def test_async_generator_asend(self):
+        @metrics.with_meter
+        async def echo():
+            received = yield 'ready'
+            yield received
+
+        async def consume():
+            generator = echo()
+            assert await generator.__anext__() == 'ready'
+            assert await generator.asend('ping') == 'ping'
+            with pytest.raises(StopAsyncIteration):
+                await generator.__anext__()
+
+        run(consume())
+        assert only_metric('.echo.rate').get()['count'] == 1
+
+    def test_sampled(self):
+        @metrics.with_meter(sample_rate=0.5)
+        async def metered():
+            pass
+
+        @metrics.with_meter(sample_rate=0.5)
+        async def producer():
+            yield 1
+
+        async def consume():
+            for _ in range(3):
+                await metered()
+                assert [item async for item in producer()] == [1]
+
+        run(consume())
+        assert only_metric('.metered.rate').get()['count'] == 2
+        assert only_metric('.producer.rate').get()['count'] == 2
+
+
+@pytest.mark.usefixtures('mock_metrics_registry')
+def test_report_forever():
+    reports = []
+
+    async def reporter(metrics):
+        reports.append(metrics)
+
+    def failing_reporter(metrics):
+        raise ValueError
+
+    async def main():
+        metrics.gauge('speed', 1)
+        task = start_reporting(reporter, 0.01)
+        failing = asyncio.ensure_future(report_forever(failing_reporter, 0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        failing.cancel()
+
+    with mock.patch('ss_metrics.aio.logger') as logger:
+        run(main())
+    assert len(reports) >= 2
+    assert reports[0]['speed']['value'] == 1
+    assert logger.exception.call_count >= 2
+
+
+class TestAsyncSubmitter(object):
+    def test_submit(self, stub_librato_server, stub_librato_api):
+        submitter = AsyncSubmitter(stub_librato_api, batch_size=2)
+        gauges = [{'name': 'g{}'.format(i), 'value': i} for i in range(3)]
+        assert run(submit(submitter, [{'gauges': gauges}])) == 3
+        # Batches are posted over a single keep-alive connection
+        clients = set(client for client, _, _ in stub_librato_server.requests)
+        assert len(clients) == 1
+        assert [body for _, _, body in stub_librato_server.requests] == [
+            {'gauges': gauges[:2]}, {'gauges': gauges[2:]}]
+
+    def test_retries(self, stub_librato_server, stub_librato_api):
+        stub_librato_server.statuses = [503, 400]
+        submitter = AsyncSubmitter(stub_librato_api, backoff=0)
+        chunks = [{'gauges': [{'name': 'g', 'value': 1}]}]
+        assert run(submit(submitter, chunks)) == 0
+        assert submitter.failed_batches == 1
+        assert len(stub_librato_server.requests) == 2
+
+
+def test_async_librato_reporter(
+        mock_metrics_registry, stub_librato_server, stub_librato_api):
+    reporter = AsyncLibratoReporter('mailbox@example.com', 'token')
+    reporter.submitter = AsyncSubmitter(stub_librato_api)
+    metrics.gauge('speed', 1)
+
+    async def report():
+        await reporter(_metrics.metrics_by_name_list(_metrics.metrics()))
+        reporter.submitter.close()
+
+    run(report())
+    assert reporter.last_cycle.measurements == 1
+    (_, path, body), = stub_librato_server.requests
+    assert path == '/v1/metrics'
+    assert body['gauges'][0]['name'] == 'speed'
@@ -1,11 +1,25 @@
 from __future__ import absolute_import
 
+import json
+import sys
+import threading
 import uuid
 
 import appmetrics.metrics as _metrics
+import librato
 import mock
 import pytest
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# Async generators, used by ss_metrics.aio, are new in Python 3.6
+collect_ignore = ['aio.py'] if sys.version_info < (3, 6) else []
+
 
 @pytest.yield_fixture
 def mock_metrics_registry(metric_count=0):
@@ -15,3 +29,56 @@ def mock_metrics_registry(metric_count=0):
             _metrics.new_metric(
                 str(uuid.uuid4()), mock.Mock, spec=['get'])
         yield _metrics.REGISTRY.copy()
+
+
+class StubLibratoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(
+            (self.client_address, self.path, json.loads(body.decode())))
+        statuses = self.server.statuses
+        self.send_response(statuses.pop(0) if statuses else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubLibratoServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.yield_fixture
+def stub_librato_server():
+    server = StubLibratoServer(('127.0.0.1', 0), StubLibratoHandler)
+    server.requests = []
+    # Response statuses to return, in order, before falling back to 200
+    server.statuses = []
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_librato_api(stub_librato_server, librato_email, librato_token):
+    host, port = stub_librato_server.server_address
+    return librato.connect(
+        librato_email, librato_token,
+        hostname='{}:{}'.format(host, port), protocol='http')
+
+
+@pytest.fixture
+def librato_email():
+    return 'mailbox@example.com'
+
+
+@pytest.fixture
+def librato_token():
+    return 'secretlibratotoken'
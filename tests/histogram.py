@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+
+import random
+import subprocess
+import sys
+
+import mock
+import pytest
+from appmetrics import histogram as appmetrics_histogram
+
+import ss_metrics.histogram
+from ss_metrics.histogram import Histogram, add_many, summarize
+from ss_metrics.sketch import DDSketch
+
+numpy = pytest.importorskip('numpy')
+
+
+def expected_summary(values):
+    reservoir = appmetrics_histogram.SlidingWindowReservoir(len(values) or 1)
+    for value in values:
+        reservoir.add(value)
+    return appmetrics_histogram.Histogram(reservoir).get()
+
+
+def assert_same_summary(expected, actual):
+    assert sorted(actual) == sorted(expected)
+    for key, value in expected.items():
+        if key in ('percentile', 'histogram'):
+            assert [level for level, _ in actual[key]] == pytest.approx(
+                [level for level, _ in value])
+            assert [count for _, count in actual[key]] == pytest.approx(
+                [count for _, count in value])
+        elif key != 'kind':
+            assert actual[key] == pytest.approx(value), key
+
+
+@pytest.mark.parametrize('values', [
+    [],
+    [5.0],
+    [1.0, 2.0],
+    [0.0, 1.0, 2.0, 3.0],
+    [-3.0, 0.0, 2.5, 10.0, 10.0],
+    [1.1] * 10,
+    # Narrow enough that appmetrics' running product does not underflow
+    [rng.lognormvariate(0, 0.5) for rng in [random.Random(42)]
+     for _ in range(1000)],
+])
+def test_summarize(values):
+    assert_same_summary(expected_summary(values), summarize(values))
+
+
+class TestAddMany(object):
+    def test_uniform(self):
+        reservoir = appmetrics_histogram.UniformReservoir(size=10)
+        add_many(reservoir, [1, 2, 3])
+        assert reservoir.values == [1, 2, 3]
+        add_many(reservoir, numpy.arange(100, 1100))
+        assert reservoir.count == 1003
+        assert len(reservoir.values) == 10
+        # The reservoir keeps a sample of everything added so far
+        assert any(value >= 100 for value in reservoir.values)
+
+    def test_sliding_window(self):
+        reservoir = appmetrics_histogram.SlidingWindowReservoir(size=3)
+        add_many(reservoir, numpy.array([[1, 2], [3, 4]]))
+        assert reservoir.values == [2, 3, 4]
+
+    def test_other_reservoirs(self):
+        reservoir = appmetrics_histogram.SlidingTimeWindowReservoir()
+        add_many(reservoir, [1, 2])
+        assert sorted(reservoir.values) == [1, 2]
+
+    def test_without_numpy(self):
+        reservoir = appmetrics_histogram.UniformReservoir(size=10)
+        with mock.patch.object(ss_metrics.histogram, 'numpy', None):
+            add_many(reservoir, range(100))
+        assert reservoir.count == 100
+        assert len(reservoir.values) == 10
+
+
+def test_numpy_imported_lazily():
+    script = (
+        'import sys, ss_metrics\n'
+        'assert "numpy" not in sys.modules\n'
+        'from ss_metrics import metrics\n'
+        'metrics.update_histogram_many("latency", [1.0, 2.0])\n'
+        'assert "numpy" in sys.modules\n')
+    subprocess.check_call([sys.executable, '-c', script])
+
+
+def test_histogram_without_numpy():
+    histogram = Histogram(appmetrics_histogram.SlidingWindowReservoir(10))
+    histogram.notify_many([1, 2, 3])
+    with mock.patch.object(ss_metrics.histogram, 'numpy', None):
+        assert histogram.get() == expected_summary([1.0, 2.0, 3.0])
+
+
+@pytest.mark.parametrize('patch_numpy', [False, True])
+def test_sketch_add_many(patch_numpy):
+    values = [-2.0, -1.0, 0.0, 0.5, 1.0, 1.0, 100.0]
+    expected, actual = DDSketch(), DDSketch()
+    for value in values:
+        expected.add(value)
+    if patch_numpy:
+        with mock.patch.object(ss_metrics.histogram, 'numpy', None):
+            actual.add_many(values)
+    else:
+        actual.add_many(numpy.array(values))
+    assert actual.positive == expected.positive
+    assert actual.negative == expected.negative
+    assert (actual.zero_count, actual.count, actual.min, actual.max) == (
+        expected.zero_count, expected.count, expected.min, expected.max)
+    assert actual.sum == pytest.approx(expected.sum)
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division
+
+import threading
+
+import mock
+
+from ss_metrics import interval
+from ss_metrics.interval import IntervalHistogram
+
+
+class TestIntervalHistogram(object):
+    def test_get(self):
+        histogram = IntervalHistogram()
+        for value in range(1, 101):
+            histogram.notify(value)
+        info = histogram.get()
+        assert info['kind'] == 'histogram'
+        assert info['n'] == 100
+        assert (info['min'], info['max']) == (1, 100)
+        assert info['arithmetic_mean'] == 50.5
+        assert info['median'] == 50.5
+        assert [level for level, _ in info['percentile']] == list(
+            interval.PERCENTILE_LEVELS)
+        percentiles = dict(info['percentile'])
+        assert (percentiles[50], percentiles[99]) == (50, 99)
+
+    def test_get_empty(self):
+        info = IntervalHistogram().get()
+        assert info['n'] == 0
+        assert info['min'] == info['max'] == 0
+        assert info['arithmetic_mean'] == 0
+        assert dict(info['percentile'])[99] == 0
+
+    def test_resets_every_interval(self):
+        histogram = IntervalHistogram(min_interval=0)
+        histogram.notify_many([1, 2, 3])
+        assert histogram.get()['n'] == 3
+        assert histogram.get()['n'] == 0
+        histogram.notify(10)
+        info = histogram.get()
+        assert (info['n'], info['min'], info['max']) == (1, 10, 10)
+
+    def test_reads_share_an_interval(self):
+        histogram = IntervalHistogram(min_interval=60)
+        with mock.patch.object(interval.time, 'time', return_value=1000.0):
+            histogram.notify(1)
+            first = histogram.get()
+            histogram.notify(2)
+            assert histogram.get() is first
+        with mock.patch.object(interval.time, 'time', return_value=1060.0):
+            assert histogram.get()['max'] == 2
+
+    def test_aggregates_are_exact_beyond_size(self):
+        histogram = IntervalHistogram(size=10, min_interval=0)
+        histogram.notify_many(range(1000))
+        assert len(histogram.raw_data()) == 10
+        info = histogram.get()
+        assert (info['n'], info['min'], info['max']) == (1000, 0, 999)
+        assert info['arithmetic_mean'] == 499.5
+
+    def test_concurrent_updates(self):
+        histogram = IntervalHistogram(min_interval=0)
+
+        def record():
+            for _ in range(1000):
+                histogram.notify(1)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        counts = [histogram.get()['n'] for _ in range(10)]
+        for thread in threads:
+            thread.join()
+        counts.append(histogram.get()['n'])
+        assert sum(counts) == 4000
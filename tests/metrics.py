@@ -1,7 +1,14 @@
 from __future__ import absolute_import
 
+import pickle
+import subprocess
+import sys
+import threading
+
 import appmetrics.metrics as _metrics
+import mock
 import pytest
+from appmetrics.exceptions import DuplicateMetricError
 
 from ss_metrics import metrics
 
@@ -39,7 +46,7 @@ class TestDeltaTracker(object):
 
     @pytest.mark.parametrize('key,previous,count,expected', [
         ('equal', 20, 20, 0),
-        ('decreasing', 20, 5, 0),
+        ('reset', 20, 5, 5),
         ('increasing', 20, 30, 10)
     ])
     def test_calculate_delta(self, populated_delta_tracker, key, previous,
@@ -47,6 +54,69 @@ class TestDeltaTracker(object):
         actual = populated_delta_tracker.calculate_delta(key, previous, count)
         assert expected == actual
 
+    def test_get_deltas(self, populated_delta_tracker):
+        deltas = populated_delta_tracker.get_deltas({
+            'client_signups': 20,
+            'impressions': 10,
+            'nonexistent': 3,
+        })
+        assert deltas == {
+            'client_signups': 20, 'impressions': 10, 'nonexistent': 3}
+        assert populated_delta_tracker.name_to_count == {
+            'client_signups': 20, 'impressions': 10, 'nonexistent': 3}
+        assert populated_delta_tracker.cycle == 1
+
+    def test_shards(self):
+        tracker = metrics.DeltaTracker(shards=4)
+        names = [str(i) for i in range(100)]
+        tracker.get_deltas(dict((name, 1) for name in names))
+        assert sorted(tracker.name_to_count) == sorted(names)
+        for shard in tracker.shards:
+            for name in shard.counts:
+                assert tracker.get_shard(name) is shard
+
+    def test_evicts_idle_names(self):
+        tracker = metrics.DeltaTracker(max_idle_cycles=2)
+        tracker.get_deltas({'idle': 5, 'active': 1})
+        for count in range(2, 5):
+            tracker.get_deltas({'active': count})
+        assert tracker.name_to_count == {'active': 4}
+        # An evicted name counts from zero again
+        assert tracker.get_delta('idle', 5) == 5
+
+    def test_never_evicts(self):
+        tracker = metrics.DeltaTracker(max_idle_cycles=None)
+        tracker.get_delta('idle', 5)
+        for _ in range(100):
+            tracker.end_cycle()
+        assert tracker.name_to_count == {'idle': 5}
+
+
+class TestChangeTracker(object):
+    def test_is_delta_tracker(self):
+        assert isinstance(metrics.ChangeTracker(), metrics.DeltaTracker)
+
+    def test_should_report(self):
+        tracker = metrics.ChangeTracker(keepalive=3)
+        reported = [
+            tracker.should_report('queue_depth', value)
+            for value in (1, 1, 1, 1, 2, 2, 1)]
+        assert reported == [True, False, False, True, True, False, True]
+
+    def test_evicts_idle_names(self):
+        tracker = metrics.ChangeTracker(max_idle_cycles=1)
+        tracker.should_report('idle', 1)
+        tracker.end_cycle()
+        tracker.should_report('active', 1)
+        tracker.end_cycle()
+        assert list(tracker.name_to_report) == ['active']
+
+    def test_names_are_independent(self):
+        tracker = metrics.ChangeTracker()
+        assert tracker.should_report('a', 1)
+        assert tracker.should_report('b', 1)
+        assert not tracker.should_report('a', 1)
+
 
 def test_gauge(mock_metrics_registry):
     name, value = 'speedometer', 'too slow'
@@ -89,3 +159,591 @@ def test_with_meter(mock_metrics_registry):
     name, metric = _metrics.REGISTRY.popitem()
     assert name.endswith('.metered_fn.rate')
     assert metric.get()['count'] == 1
+
+
+def test_timed_resolves_name_once(mock_metrics_registry):
+    with mock.patch.object(
+            metrics, 'get_function_name',
+            wraps=metrics.get_function_name) as get_function_name:
+        @metrics.timed
+        def timed_fn():
+            pass
+
+        for _ in range(3):
+            timed_fn()
+    assert get_function_name.call_count == 1
+    name, metric = _metrics.REGISTRY.popitem()
+    assert len(metric.raw_data()) == 3
+
+
+def test_timed_does_not_record_exceptions(mock_metrics_registry):
+    @metrics.timed
+    def failing_fn():
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        failing_fn()
+    name, metric = _metrics.REGISTRY.popitem()
+    assert len(metric.raw_data()) == 0
+
+
+def test_with_meter_rebinds_deleted_metric(mock_metrics_registry):
+    @metrics.with_meter
+    def metered_fn():
+        pass
+
+    metered_fn()
+    name, = _metrics.REGISTRY.keys()
+    _metrics.delete_metric(name)
+    metered_fn()
+    assert _metrics.get(name)['count'] == 1
+
+
+def test_with_meter_defers_unresolvable_name(mock_metrics_registry):
+    def metered_fn():
+        pass
+
+    metered_fn.__module__ = None
+    wrapper = metrics.with_meter(metered_fn)
+    with pytest.raises(ValueError):
+        wrapper()
+
+
+class TestBufferedRecorder(object):
+    @pytest.fixture
+    def recorder(self):
+        return metrics.BufferedRecorder(max_staleness=60, max_pending=100)
+
+    def test_buffers_until_flush(self, mock_metrics_registry, recorder):
+        recorder.inc_meter('requests', 2)
+        recorder.inc_meter('requests', 3)
+        recorder.gauge('queue_depth', 7)
+        recorder.update_histogram('latency', 1.0)
+        recorder.update_histogram('latency', 3.0)
+        assert len(_metrics.REGISTRY) == 0
+        recorder.flush()
+        assert _metrics.get('requests')['count'] == 5
+        assert _metrics.get('queue_depth')['value'] == 7
+        assert sorted(_metrics.metric('latency').raw_data()) == [1.0, 3.0]
+
+    def test_flush_merges_threads(self, mock_metrics_registry, recorder):
+        def record():
+            for _ in range(10):
+                recorder.inc_meter('requests')
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        recorder.flush()
+        assert _metrics.get('requests')['count'] == 40
+        # Buffers of finished threads are discarded once drained
+        assert recorder.buffers == []
+
+    def test_flush_keeps_latest_gauge(self, mock_metrics_registry, recorder):
+        with mock.patch.object(metrics.time, 'time', return_value=2):
+            recorder.gauge('temperature', 'new')
+        thread = threading.Thread(target=recorder.gauge, args=(
+            'temperature', 'old'))
+        with mock.patch.object(metrics.time, 'time', return_value=1):
+            thread.start()
+            thread.join()
+        recorder.flush()
+        assert _metrics.get('temperature')['value'] == 'new'
+
+    def test_stale_buffer_is_flushed(self, mock_metrics_registry):
+        recorder = metrics.BufferedRecorder(max_staleness=0)
+        recorder.inc_meter('requests')
+        assert _metrics.get('requests')['count'] == 1
+
+    def test_full_buffer_is_flushed(self, mock_metrics_registry):
+        recorder = metrics.BufferedRecorder(max_staleness=60, max_pending=2)
+        recorder.inc_meter('requests')
+        assert len(_metrics.REGISTRY) == 0
+        recorder.inc_meter('requests')
+        assert _metrics.get('requests')['count'] == 2
+
+    def test_flushing_reporter(self, mock_metrics_registry, recorder):
+        reporter = mock.Mock()
+        recorder.inc_meter('requests')
+        recorder.flushing(reporter)({})
+        (reported,), _ = reporter.call_args
+        assert reported['requests']['count'] == 1
+
+
+def test_inc_meter_after_delete(mock_metrics_registry):
+    name = 'balance'
+    metrics.inc_meter(name)
+    _metrics.delete_metric(name)
+    metrics.inc_meter(name, 2)
+    assert _metrics.get(name)['count'] == 2
+
+
+def test_gauge_created_concurrently(mock_metrics_registry):
+    name = 'speedometer'
+    new_gauge = _metrics.new_gauge
+
+    def create_concurrently(name):
+        new_gauge(name)
+        return new_gauge(name)
+
+    with mock.patch.object(
+            _metrics, 'new_gauge', side_effect=create_concurrently):
+        metrics.gauge(name, 'fast')
+    assert _metrics.get(name)['value'] == 'fast'
+
+
+@pytest.mark.parametrize('enabled', [False, True])
+def test_debug_logging(mock_metrics_registry, enabled):
+    metrics.set_debug_logging(enabled)
+    try:
+        with mock.patch.object(metrics, 'logger') as logger:
+            metrics.inc_meter('balance')
+            metrics.gauge('speedometer', 'fast')
+    finally:
+        metrics.set_debug_logging(False)
+    assert logger.debug.call_count == (2 if enabled else 0)
+
+
+def test_update_histogram_sketch(mock_metrics_registry):
+    name = 'duration'
+    for value in (1.0, 2.0, 3.0):
+        metrics.update_histogram(name, value, metrics.SKETCH)
+    info = _metrics.get(name)
+    assert info['n'] == 3
+    assert info['min'] == 1.0
+
+
+def test_update_histogram_sketch_conflict(mock_metrics_registry):
+    metrics.update_histogram('duration', 1.0)
+    with pytest.raises(DuplicateMetricError):
+        metrics.update_histogram('duration', 1.0, metrics.SKETCH)
+
+
+def test_update_histogram_interval(mock_metrics_registry):
+    metrics.update_histogram('duration', 1.0, metrics.INTERVAL)
+    metrics.update_histogram('duration', 3.0, metrics.INTERVAL)
+    info = _metrics.get('duration')
+    assert (info['n'], info['arithmetic_mean']) == (2, 2.0)
+    with pytest.raises(DuplicateMetricError):
+        metrics.update_histogram('duration', 1.0, metrics.SKETCH)
+
+
+def test_update_histogram_reservoir_conflict(mock_metrics_registry):
+    metrics.update_histogram('duration', 1.0)
+    with pytest.raises(DuplicateMetricError):
+        metrics.update_histogram('duration', 1.0, 'sliding_window')
+
+
+@pytest.mark.parametrize('reservoir_type', [
+    'uniform', 'sliding_window', 'sliding_time_window', metrics.SKETCH,
+    metrics.INTERVAL])
+def test_update_histogram_many(mock_metrics_registry, reservoir_type):
+    metrics.update_histogram_many('duration', [1, 2, 3], reservoir_type)
+    metrics.update_histogram_many('duration', (4.0,), reservoir_type)
+    info = _metrics.get('duration')
+    assert info['n'] == 4
+    assert (info['min'], info['max']) == (1, 4)
+
+
+def test_inc_meter_many(mock_metrics_registry):
+    with mock.patch.object(metrics, 'inc_meter') as inc_meter:
+        metrics.inc_meter_many([('requests', 1), ('errors', 2),
+                                ('requests', 3.0)])
+    assert sorted(inc_meter.call_args_list) == [
+        mock.call('errors', 2), mock.call('requests', 4)]
+    metrics.inc_meter_many({'requests': 5})
+    assert _metrics.get('requests')['count'] == 5
+
+
+@pytest.yield_fixture
+def limiter():
+    limiter = metrics.CardinalityLimiter(
+        max_series=4, prefix_limits={'http': 2, 'http.path': 1})
+    metrics.set_cardinality_limiter(limiter)
+    yield limiter
+    metrics.set_cardinality_limiter(None)
+
+
+class TestCardinalityLimiter(object):
+    def test_prefix_limits(self, mock_metrics_registry, limiter):
+        metrics.inc_meter('http.path.a')
+        metrics.inc_meter('http.path.b')
+        metrics.inc_meter('http.status.200')
+        metrics.inc_meter('http.status.500')
+        metrics.inc_meter('http.status.404')
+        metrics.inc_meter('https')
+        # The longest matching prefix applies
+        assert sorted(_metrics.REGISTRY) == [
+            'http.overflow.meter', 'http.path.a', 'http.path.overflow.meter',
+            'http.status.200', 'http.status.500', 'https']
+        assert limiter.overflowed == 2
+
+    def test_global_limit(self, mock_metrics_registry, limiter):
+        for index in range(6):
+            metrics.gauge('gauge.{}'.format(index), index)
+        metrics.update_histogram('latency', 1.0)
+        metrics.update_histogram('latency', 2.0, 'sliding_window')
+        assert _metrics.get('ss_metrics.overflow.gauge')['value'] == 5
+        assert _metrics.get('ss_metrics.overflow.histogram')['n'] == 1
+        assert _metrics.get(
+            'ss_metrics.overflow.histogram_sliding_window')['n'] == 1
+        assert limiter.overflowed == 4
+        # Admitted names are still recorded
+        metrics.gauge('gauge.0', 10)
+        assert _metrics.get('gauge.0')['value'] == 10
+
+    def test_decorated(self, mock_metrics_registry):
+        metrics.set_cardinality_limiter(
+            metrics.CardinalityLimiter(max_series=0))
+
+        @metrics.with_meter
+        def metered_fn():
+            pass
+
+        try:
+            metered_fn()
+            metered_fn()
+        finally:
+            metrics.set_cardinality_limiter(None)
+        assert list(_metrics.REGISTRY) == ['ss_metrics.overflow.meter']
+        assert _metrics.get('ss_metrics.overflow.meter')['count'] == 2
+
+    def test_names_are_interned(self, limiter):
+        name = ''.join(['dynamic', '.name'])
+        assert limiter.admit(name, 'gauge') is name
+        assert limiter.admit(''.join(['dynamic', '.name']), 'gauge') is name
+
+    def test_evicts_idle_names(self, mock_metrics_registry):
+        with mock.patch('time.time', return_value=100):
+            limiter = metrics.CardinalityLimiter(max_series=2, max_idle=10)
+        metrics.set_cardinality_limiter(limiter)
+        try:
+            with mock.patch('time.time', return_value=100):
+                metrics.inc_meter('idle')
+            with mock.patch('time.time', return_value=105):
+                metrics.inc_meter('active')
+            with mock.patch('time.time', return_value=112):
+                # Recording never sweeps
+                metrics.inc_meter('full')
+                assert 'idle' in _metrics.REGISTRY
+                metrics.sweep_idle_names()
+                metrics.inc_meter('new')
+        finally:
+            metrics.set_cardinality_limiter(None)
+        assert sorted(_metrics.REGISTRY) == [
+            'active', 'new', 'ss_metrics.overflow.meter']
+        assert limiter.overflowed == 1
+
+    def test_sweep_not_due(self, mock_metrics_registry):
+        with mock.patch('time.time', return_value=100):
+            limiter = metrics.CardinalityLimiter(max_idle=10)
+            limiter.admit('idle', 'meter')
+        with mock.patch.object(limiter, 'evict_idle') as evict_idle:
+            with mock.patch('time.time', return_value=109):
+                limiter.sweep()
+            evict_idle.assert_not_called()
+            with mock.patch('time.time', return_value=110):
+                limiter.sweep()
+            evict_idle.assert_called_once_with(100)
+
+
+@pytest.yield_fixture
+def sample_rates():
+    with mock.patch.dict(metrics._sample_rates, clear=True):
+        yield metrics._sample_rates
+
+
+class TestSampling(object):
+    def test_timed(self, mock_metrics_registry, sample_rates):
+        @metrics.timed(sample_rate=0.25)
+        def timed_fn():
+            return 1
+
+        assert [timed_fn() for _ in range(10)] == [1] * 10
+        name, metric = _metrics.REGISTRY.popitem()
+        assert name.endswith('.timed_fn.timer')
+        assert len(metric.raw_data()) == 2
+        assert metrics.get_sample_rate(name) == 0.25
+
+    def test_with_meter_scales_count(self, mock_metrics_registry,
+                                     sample_rates):
+        @metrics.with_meter(sample_rate=0.1)
+        def metered_fn():
+            pass
+
+        for _ in range(25):
+            metered_fn()
+        name, = _metrics.REGISTRY.keys()
+        assert _metrics.get(name)['count'] == 20
+        assert metrics.get_sample_rate(name) == 0.1
+
+    def test_unsampled(self, mock_metrics_registry, sample_rates):
+        @metrics.with_meter(sample_rate=1)
+        def metered_fn():
+            pass
+
+        metered_fn()
+        name, = _metrics.REGISTRY.keys()
+        assert _metrics.get(name)['count'] == 1
+        assert metrics.get_sample_rate(name) is None
+
+    @pytest.mark.parametrize('sample_rate', [0, -1, 1.5])
+    def test_invalid_rate(self, sample_rate):
+        with pytest.raises(ValueError):
+            metrics.timed(sample_rate=sample_rate)(lambda: None)
+
+    def test_update_histogram(self, mock_metrics_registry, sample_rates):
+        with mock.patch('random.random', side_effect=[0.6, 0.4, 0.5]):
+            for sample in range(3):
+                metrics.update_histogram('latency', sample, sample_rate=0.5)
+        assert _metrics.get('latency')['n'] == 1
+        assert _metrics.get('latency')['min'] == 1
+        assert metrics.get_sample_rate('latency') == 0.5
+
+    def test_eviction_forgets_rate(self, mock_metrics_registry,
+                                   sample_rates):
+        with mock.patch('time.time', return_value=100):
+            limiter = metrics.CardinalityLimiter(max_idle=10)
+        metrics.set_cardinality_limiter(limiter)
+        try:
+            with mock.patch('time.time', return_value=100):
+                metrics.update_histogram('idle', 1.0, sample_rate=0.99999)
+            with mock.patch('time.time', return_value=112):
+                metrics.sweep_idle_names()
+        finally:
+            metrics.set_cardinality_limiter(None)
+        assert metrics.get_sample_rate('idle') is None
+
+
+class TestTimer(object):
+    def test_context_manager(self, mock_metrics_registry):
+        with mock.patch.object(metrics, '_clock_ns',
+                               side_effect=[10**9, 3 * 10**9]):
+            with metrics.timer('block') as timer:
+                pass
+        assert isinstance(timer, metrics.Timer)
+        assert _metrics.get('block')['min'] == 2.0
+
+    def test_does_not_record_exceptions(self, mock_metrics_registry):
+        timer = metrics.timer('block')
+        with pytest.raises(RuntimeError):
+            with timer:
+                raise RuntimeError()
+        with timer:
+            pass
+        assert _metrics.get('block')['n'] == 1
+
+    def test_tokens(self, mock_metrics_registry):
+        timer = metrics.timer('block')
+        with mock.patch.object(metrics, '_clock_ns',
+                               side_effect=[0, 10**6, 5 * 10**6, 10**7]):
+            first, second = timer.start(), timer.start()
+            assert timer.stop(second) == 0.004
+            assert timer.stop(first) == 0.01
+        assert _metrics.metric('block').raw_data() == [0.004, 0.01]
+
+    def test_cached_by_name(self):
+        timer = metrics.timer('block', tags={'region': 'eu'})
+        assert metrics.timer('block', tags={'region': 'eu'}) is timer
+        assert metrics.timer('block') is not timer
+
+    def test_shared_across_threads(self, mock_metrics_registry):
+        timer = metrics.timer('block')
+        entered = [threading.Event(), threading.Event()]
+        # Each thread's clock reads 0 on entering and its own time on exit
+        clocks = {}
+
+        def clock():
+            return clocks.setdefault(threading.current_thread().name, [])[-1]
+
+        def block(index, seconds):
+            clocks[threading.current_thread().name] = [0]
+            with timer:
+                # Both blocks are open at once
+                entered[index].set()
+                entered[1 - index].wait()
+                clocks[threading.current_thread().name].append(
+                    seconds * 10**9)
+
+        threads = [threading.Thread(target=block, args=(index, seconds))
+                   for index, seconds in enumerate((1, 2))]
+        with mock.patch.object(metrics, '_clock_ns', side_effect=clock):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert sorted(_metrics.metric('block').raw_data()) == [1.0, 2.0]
+
+    def test_eviction_forgets_timer(self, mock_metrics_registry):
+        with mock.patch('time.time', return_value=100):
+            limiter = metrics.CardinalityLimiter(max_idle=10)
+        metrics.set_cardinality_limiter(limiter)
+        try:
+            with mock.patch('time.time', return_value=100):
+                with metrics.timer('idle'):
+                    pass
+            with mock.patch('time.time', return_value=112):
+                metrics.sweep_idle_names()
+        finally:
+            metrics.set_cardinality_limiter(None)
+        assert 'idle' not in metrics._timers
+
+    def test_rebinds_deleted_metric(self, mock_metrics_registry):
+        timer = metrics.timer('block')
+        with timer:
+            pass
+        _metrics.delete_metric('block')
+        with timer:
+            pass
+        assert _metrics.get('block')['n'] == 1
+
+    def test_forwarder(self, mock_metrics_registry):
+        forwarder = mock.Mock()
+        metrics.set_forwarder(forwarder)
+        try:
+            with metrics.timer('block'):
+                pass
+        finally:
+            metrics.set_forwarder(None)
+        forwarder.bind.assert_called_once_with('histogram', 'block')
+        assert forwarder.bind.return_value.notify.call_count == 1
+        assert len(_metrics.REGISTRY) == 0
+
+
+class TestTags(object):
+    def test_series_key(self):
+        key = metrics.series_key('requests', {'status': 200, 'method': 'GET'})
+        assert key == 'requests;method=GET;status=200'
+        assert key.metric_name == 'requests'
+        assert key.tags == (('method', 'GET'), ('status', '200'))
+        assert metrics.series_key(
+            'requests', {'method': 'GET', 'status': 200}) is key
+        assert metrics.series_key('requests', None) == 'requests'
+
+    @pytest.mark.parametrize('tags', [
+        {'': 'a'}, {'a=b': 'c'}, {'a': 'b;c'}])
+    def test_invalid_tags(self, tags):
+        with pytest.raises(ValueError):
+            metrics.series_key('requests', tags)
+
+    def test_split_series_key(self):
+        key = metrics.series_key('requests', {'method': 'GET'})
+        assert metrics.split_series_key(key) == (
+            'requests', (('method', 'GET'),))
+        assert metrics.split_series_key(str(key)) == (
+            'requests', (('method', 'GET'),))
+        assert metrics.split_series_key('requests') == ('requests', ())
+
+    def test_pickle(self):
+        key = metrics.series_key('requests', {'method': 'GET'})
+        copy = pickle.loads(pickle.dumps(key))
+        assert copy == key
+        assert copy.tags == key.tags
+
+    def test_recording(self, mock_metrics_registry):
+        metrics.inc_meter('requests', tags={'method': 'GET'})
+        metrics.inc_meter('requests', 2, tags={'method': 'POST'})
+        metrics.gauge('speed', 1, tags={'unit': 'mps'})
+        metrics.update_histogram('latency', 1.0, tags={'method': 'GET'})
+        with metrics.timer('query', tags={'table': 'users'}):
+            pass
+        assert sorted(_metrics.REGISTRY) == [
+            'latency;method=GET', 'query;table=users', 'requests;method=GET',
+            'requests;method=POST', 'speed;unit=mps']
+        assert _metrics.get('requests;method=POST')['count'] == 2
+
+    def test_decorated(self, mock_metrics_registry):
+        @metrics.timed(tags={'region': 'eu'})
+        def timed_fn():
+            pass
+
+        timed_fn()
+        name, = _metrics.REGISTRY
+        assert name.metric_name.endswith('.timed_fn.timer')
+        assert name.tags == (('region', 'eu'),)
+
+    def test_prefix_limits(self, mock_metrics_registry):
+        metrics.set_cardinality_limiter(
+            metrics.CardinalityLimiter(prefix_limits={'requests': 1}))
+        try:
+            metrics.inc_meter('requests', tags={'method': 'GET'})
+            metrics.inc_meter('requests', tags={'method': 'POST'})
+        finally:
+            metrics.set_cardinality_limiter(None)
+        assert sorted(_metrics.REGISTRY) == [
+            'requests.overflow.meter', 'requests;method=GET']
+
+
+@pytest.yield_fixture
+def disabled():
+    metrics.set_enabled(False)
+    try:
+        yield
+    finally:
+        metrics.set_enabled(True)
+
+
+class TestDisabled(object):
+    def test_decorators_return_function(self, disabled):
+        def fn():
+            pass
+
+        assert metrics.timed(fn) is fn
+        assert metrics.timed(sample_rate=0.5)(fn) is fn
+        assert metrics.with_meter(fn) is fn
+
+    def test_nothing_is_recorded(self, mock_metrics_registry, disabled):
+        metrics.gauge('speed', 1)
+        metrics.inc_meter('requests')
+        metrics.inc_meter_many({'errors': 1})
+        metrics.update_histogram('latency', 1.0)
+        metrics.update_histogram_many('latency', [1.0, 2.0])
+        timer = metrics.timer('query')
+        with timer:
+            pass
+        assert timer.stop(timer.start()) >= 0
+        recorder = metrics.BufferedRecorder()
+        recorder.inc_meter('requests')
+        recorder.flush()
+        assert not _metrics.REGISTRY
+
+    def test_decorated_before_disabling(self, mock_metrics_registry):
+        @metrics.timed
+        def timed_fn():
+            return 1
+
+        @metrics.with_meter(sample_rate=0.5)
+        def metered_fn():
+            return 2
+
+        metrics.set_enabled(False)
+        try:
+            for _ in range(4):
+                assert (timed_fn(), metered_fn()) == (1, 2)
+        finally:
+            metrics.set_enabled(True)
+        assert not _metrics.REGISTRY
+
+    def test_enable_again(self, mock_metrics_registry):
+        metrics.set_enabled(False)
+        metrics.set_enabled(True)
+        metrics.inc_meter('requests')
+        assert _metrics.get('requests')['count'] == 1
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='module __getattr__')
+def test_reporters_imported_lazily():
+    script = (
+        'import sys, ss_metrics\n'
+        'assert "ss_metrics.reporter" not in sys.modules\n'
+        'assert "librato" not in sys.modules\n'
+        'assert ss_metrics.LibratoReporter.__name__ == "LibratoReporter"\n'
+        'assert "librato" in sys.modules\n')
+    subprocess.check_call([sys.executable, '-c', script])
+
+
+def test_plain_function_is_not_async_without_inspect_helpers():
+    with mock.patch.object(metrics, 'inspect', spec=[]):
+        assert not metrics._is_async(lambda: None)
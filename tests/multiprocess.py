@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+import appmetrics.metrics as _metrics
+import mock
+import pytest
+
+from ss_metrics import metrics
+from ss_metrics.multiprocess import (
+    Aggregator, SocketForwarder, forward_to, stop_forwarding)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+@pytest.yield_fixture
+def socket_path():
+    # Unix socket paths are limited to about 100 characters
+    directory = tempfile.mkdtemp(dir='/tmp')
+    yield os.path.join(directory, 'metrics.sock')
+    shutil.rmtree(directory)
+
+
+@pytest.yield_fixture
+def aggregator(mock_metrics_registry, socket_path):
+    aggregator = Aggregator(socket_path, poll_interval=0.01)
+    aggregator.start()
+    yield aggregator
+    aggregator.close()
+
+
+@pytest.yield_fixture
+def forwarder(socket_path):
+    forwarder = forward_to(socket_path)
+    yield forwarder
+    stop_forwarding()
+    forwarder.close()
+
+
+@metrics.timed
+def timed_fn():
+    pass
+
+
+def worker(path, index):
+    forwarder = forward_to(path)
+    metrics.inc_meter('requests')
+    metrics.update_histogram('latency', index)
+    metrics.gauge('worker', index)
+    timed_fn()
+    # multiprocessing exits without running atexit handlers
+    forwarder.flush()
+
+
+def test_forwarding(aggregator, forwarder):
+    metrics.inc_meter('requests', 2)
+    metrics.gauge('speedometer', 'fast')
+    metrics.update_histogram('latency', 1.5, 'sliding_window')
+    wait_for(lambda: aggregator.received == 3)
+    assert _metrics.get('requests')['count'] == 2
+    assert _metrics.get('speedometer')['value'] == 'fast'
+    histogram = _metrics.metric('latency')
+    assert histogram.raw_data() == [1.5]
+    assert type(histogram.reservoir).__name__ == 'SlidingWindowReservoir'
+
+
+def test_forwarding_decorated(aggregator, forwarder):
+    @metrics.with_meter
+    def metered_fn():
+        pass
+
+    metered_fn()
+    metered_fn()
+    wait_for(lambda: aggregator.received == 2)
+    name, = _metrics.REGISTRY
+    assert name.endswith('.metered_fn.rate')
+    assert _metrics.get(name)['count'] == 2
+
+
+def test_workers(aggregator, socket_path):
+    workers = 4
+    # Workers are forked, which is the only start method on Python 2
+    context = (
+        multiprocessing.get_context('fork')
+        if hasattr(multiprocessing, 'get_context') else multiprocessing)
+    processes = [
+        context.Process(target=worker, args=(socket_path, index))
+        for index in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    wait_for(lambda: aggregator.received == 4 * workers)
+    assert _metrics.get('requests')['count'] == workers
+    assert sorted(_metrics.metric('latency').raw_data()) == [
+        float(index) for index in range(workers)]
+    assert _metrics.get('worker')['value'] in range(workers)
+    timer, = [name for name in _metrics.REGISTRY if name.endswith('.timer')]
+    assert len(_metrics.metric(timer).raw_data()) == workers
+
+
+def test_fork_while_flushing(aggregator, forwarder):
+    metrics.inc_meter('requests')
+    wait_for(lambda: aggregator.received == 1)
+    # As if the parent's background thread were flushing while forking
+    forwarder.lock.acquire()
+    pid = os.fork()
+    if pid:
+        forwarder.lock.release()
+    else:
+        try:
+            metrics.inc_meter('requests')
+            forwarder.flush()
+        finally:
+            os._exit(0)
+    deadline = time.time() + 5
+    while os.waitpid(pid, os.WNOHANG) == (0, 0):
+        if time.time() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            pytest.fail('The forked process hung')
+        time.sleep(0.01)
+    wait_for(lambda: aggregator.received == 2)
+    assert _metrics.get('requests')['count'] == 2
+
+
+def test_invalid_update(aggregator, forwarder):
+    with mock.patch('ss_metrics.multiprocess.logger') as logger:
+        forwarder.send('unknown', 'name', 1)
+        wait_for(lambda: aggregator.received == 1)
+    assert logger.exception.call_count == 1
+    assert len(_metrics.REGISTRY) == 0
+
+
+def test_forwarding_sample_rates(aggregator, forwarder):
+    with mock.patch.dict(metrics._sample_rates, clear=True), \
+            mock.patch('random.random', return_value=0.0):
+        metrics.update_histogram('latency', 1.0, sample_rate=0.5)
+        metrics._sample_rates.clear()
+        wait_for(lambda: aggregator.received == 1)
+        assert metrics.get_sample_rate('latency') == 0.5
+
+
+def test_aggregator_not_running(socket_path):
+    forwarder = SocketForwarder(socket_path)
+    forwarder.send('meter', 'requests', 1)
+    forwarder.flush()
+    assert forwarder.dropped == 1
+    forwarder.close()
+
+
+def test_max_pending(socket_path):
+    forwarder = SocketForwarder(socket_path, flush_interval=60, max_pending=2)
+    for _ in range(3):
+        forwarder.send('meter', 'requests', 1)
+    assert (len(forwarder.pending), forwarder.dropped) == (2, 1)
+    forwarder.close()
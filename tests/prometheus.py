@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+
+import appmetrics.metrics as _metrics
+import mock
+import pytest
+
+from ss_metrics import metrics
+from ss_metrics.prometheus import (
+    CONTENT_TYPE, PrometheusExporter, format_name, format_value,
+    start_http_server)
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+
+
+def scrape(exporter):
+    start_response = mock.Mock()
+    body = exporter({}, start_response)
+    (status, headers), _ = start_response.call_args
+    assert status == '200 OK'
+    assert dict(headers)['Content-Type'] == CONTENT_TYPE
+    assert int(dict(headers)['Content-Length']) == sum(map(len, body))
+    return body
+
+
+def text(body):
+    return b''.join(body).decode('utf-8')
+
+
+@pytest.mark.parametrize('name,expected', [
+    ('requests.rate', 'requests_rate'),
+    ('9lives', '_9lives'),
+    ('a-b c:d', 'a_b_c:d'),
+])
+def test_format_name(name, expected):
+    assert format_name(name) == expected
+
+
+@pytest.mark.parametrize('value,expected', [
+    (1, '1'), (0.5, '0.5'), (float('inf'), '+Inf'), (float('nan'), 'NaN'),
+    (False, None), ('fast', None)])
+def test_format_value(value, expected):
+    assert format_value(value) == expected
+
+
+@pytest.mark.usefixtures('mock_metrics_registry')
+class TestPrometheusExporter(object):
+    def test_exposition(self):
+        _metrics.new_gauge('speed').notify(2.5)
+        _metrics.new_gauge('status').notify('healthy')
+        _metrics.new_meter('requests.rate').notify(3)
+        histogram = _metrics.new_histogram('latency')
+        histogram.notify(1)
+        histogram.notify(3)
+        _metrics.new_histogram('empty')
+        exposition = text(scrape(PrometheusExporter(metric_prefix='app')))
+        assert exposition == (
+            '# TYPE app_latency gauge\n'
+            'app_latency{quantile="0.5"} 1.0\n'
+            'app_latency{quantile="0.75"} 3.0\n'
+            'app_latency{quantile="0.9"} 3.0\n'
+            'app_latency{quantile="0.95"} 3.0\n'
+            'app_latency{quantile="0.99"} 3.0\n'
+            'app_latency{quantile="0.999"} 3.0\n'
+            '# TYPE app_latency_min gauge\n'
+            'app_latency_min 1.0\n'
+            '# TYPE app_latency_max gauge\n'
+            'app_latency_max 3.0\n'
+            '# TYPE app_requests_rate_total counter\n'
+            'app_requests_rate_total 3\n'
+            '# TYPE app_requests_rate_1m gauge\n'
+            'app_requests_rate_1m 0.0\n'
+            '# TYPE app_requests_rate_5m gauge\n'
+            'app_requests_rate_5m 0.0\n'
+            '# TYPE app_speed gauge\n'
+            'app_speed 2.5\n')
+
+    def test_meter_deltas_are_not_tracked(self):
+        _metrics.new_meter('requests').notify(3)
+        exporter = PrometheusExporter()
+        exporter.delta_tracker = mock.Mock()
+        assert 'requests_total 3' in text(scrape(exporter))
+        assert not exporter.delta_tracker.get_deltas.called
+
+    def test_series_tags(self):
+        metrics.gauge('speed', 1, tags={'region': 'eu'})
+        assert text(scrape(PrometheusExporter())) == (
+            '# TYPE speed_region_eu gauge\n'
+            'speed_region_eu 1\n')
+
+    def test_max_age(self):
+        exporter = PrometheusExporter(max_age=60)
+        gauge = _metrics.new_gauge('speed')
+        gauge.notify(1)
+        body = scrape(exporter)
+        gauge.notify(2)
+        assert scrape(exporter) is body
+
+    def test_unchanged_metrics_are_not_rendered(self):
+        exporter = PrometheusExporter(max_age=0)
+        _metrics.new_gauge('speed').notify(1)
+        gauge = _metrics.new_gauge('temperature')
+        gauge.notify(1)
+        speed, temperature = scrape(exporter)
+        gauge.notify(2)
+        body = scrape(exporter)
+        assert body[0] is speed
+        assert text(body[1:]) == (
+            '# TYPE temperature gauge\ntemperature 2\n')
+
+    def test_colliding_names(self):
+        _metrics.new_gauge('a.b').notify(1)
+        _metrics.new_gauge('a_b').notify(2)
+        _metrics.new_gauge('c_total').notify(3)
+        _metrics.new_meter('c').notify(1)
+        _metrics.new_histogram('d').notify(1)
+        _metrics.new_gauge('d_max').notify(4)
+        exporter = PrometheusExporter(max_age=0)
+        with mock.patch('ss_metrics.prometheus.logger') as logger:
+            exposition = text(scrape(exporter))
+            # Collisions are only logged once
+            scrape(exporter)
+        assert exposition.count('# TYPE a_b ') == 1
+        assert exposition.count('# TYPE c_total ') == 1
+        assert 'd_max 4' not in exposition
+        assert logger.warning.call_count == 3
+
+    def test_tag(self):
+        _metrics.new_gauge('speed').notify(1)
+        _metrics.new_gauge('temperature').notify(1)
+        _metrics.tag('speed', 'exposed')
+        exporter = PrometheusExporter(tag='exposed')
+        assert text(scrape(exporter)) == '# TYPE speed gauge\nspeed 1\n'
+
+
+def test_start_http_server(mock_metrics_registry):
+    _metrics.new_gauge('speed').notify(1)
+    server = start_http_server(0, '127.0.0.1')
+    try:
+        host, port = server.server_address
+        response = urlopen('http://{}:{}/metrics'.format(host, port))
+        assert response.read() == b'# TYPE speed gauge\nspeed 1\n'
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import functools
+import json
 import random
 import string
 import uuid
@@ -11,9 +12,14 @@ import librato
 import mock
 import pytest
 
+import ss_metrics.metrics
 import ss_metrics.reporter
-from ss_metrics.metrics import DeltaTracker
-from ss_metrics.reporter import ConsoleReporter, LibratoReporter, _get_hostname
+from ss_metrics.metrics import ChangeTracker, DeltaTracker
+from ss_metrics.reporter import (
+    BLOCK, DROP_NEWEST, DROP_OLDEST, BackgroundSubmitter, BatchSubmitter,
+    ConsoleReporter, CycleStats, KeepAliveConnection, LibratoReporter,
+    SelfMetrics, _get_hostname)
+from ss_metrics.spool import Spool
 
 
 @pytest.fixture
@@ -40,16 +46,6 @@ def mock_librato():
         yield librato
 
 
-@pytest.fixture
-def librato_email():
-    return 'mailbox@example.com'
-
-
-@pytest.fixture
-def librato_token():
-    return 'secretlibratotoken'
-
-
 @pytest.fixture
 def metric_prefix():
     return None
@@ -80,6 +76,12 @@ def test_console_reporter(mock_logger):
     mock_logger.info.assert_called_once_with(metrics)
 
 
+def test_console_reporter_self_metrics(mock_metrics_registry, mock_logger):
+    ConsoleReporter(self_metrics=True)({'a': {}, 'b': {}})
+    assert _metrics.get('ss_metrics.console.metrics')['value'] == 2
+    assert _metrics.get('ss_metrics.console.cycle_duration')['value'] >= 0
+
+
 @pytest.mark.usefixtures('mock_metrics_registry')
 class TestLibratoReporter(object):
     @pytest.mark.parametrize('metric_prefix', [None, 'namespace'])
@@ -125,7 +127,7 @@ class TestLibratoReporter(object):
             self, mock_librato, librato_reporter, metric,
             metric_name, full_metric_name, value, delta):
         delta_tracker = mock.Mock(spec=DeltaTracker)
-        delta_tracker.get_delta.return_value = delta
+        delta_tracker.get_deltas.return_value = {metric_name: delta}
         librato_reporter.delta_tracker = delta_tracker
         meter = _metrics.new_meter(metric_name)
         meter.notify(value)
@@ -134,7 +136,51 @@ class TestLibratoReporter(object):
             metric('.'.join((full_metric_name, '1m')), meter.m1.rate),
             metric('.'.join((full_metric_name, '5m')), meter.m5.rate),
         ])
-        delta_tracker.get_delta.assert_called_once_with(metric_name, value)
+        delta_tracker.get_deltas.assert_called_once_with(
+            {metric_name: value})
+
+    def test_sampled_meter(
+            self, mock_librato, librato_reporter, metric, metric_name,
+            full_metric_name):
+        meter = _metrics.new_meter(metric_name)
+        meter.notify(10)
+        with mock.patch.dict(ss_metrics.metrics._sample_rates,
+                             {metric_name: 0.1}):
+            self.metric_submission_test(librato_reporter, [
+                metric('.'.join((full_metric_name, 'count')), 10),
+                metric('.'.join((full_metric_name, '1m')), meter.m1.rate),
+                metric('.'.join((full_metric_name, '5m')), meter.m5.rate),
+                metric('.'.join((full_metric_name, 'sample_rate')), 0.1),
+            ])
+
+    def test_sampled_histogram(
+            self, mock_librato, librato_reporter, metric, metric_name,
+            full_metric_name):
+        histogram = _metrics.new_histogram(metric_name)
+        histogram.notify(1.0)
+        percentiles = histogram.get()['percentile']
+        with mock.patch.dict(ss_metrics.metrics._sample_rates,
+                             {metric_name: 0.5}):
+            self.metric_submission_test(librato_reporter, [
+                metric(full_metric_name, None,
+                       count=1, sum=1.0, min=1.0, max=1.0)
+            ] + [
+                metric('.'.join((full_metric_name, str(p))), value)
+                for p, value in percentiles
+            ] + [
+                metric('.'.join((full_metric_name, 'sample_rate')), 0.5),
+            ])
+
+    @pytest.mark.parametrize('metric_prefix', [None, 'namespace'])
+    def test_tagged_gauge(
+            self, mock_librato, librato_reporter, metric, full_metric_name,
+            metric_name, mock_hostname):
+        ss_metrics.metrics.gauge(metric_name, 1, tags={'region': 'eu'})
+        self.metric_submission_test(librato_reporter, [
+            ((full_metric_name, 1),
+             {'type': 'gauge',
+              'tags': {'region': 'eu', 'host': mock_hostname}}),
+        ])
 
     @pytest.mark.parametrize('metric_prefix', [None, 'namespace'])
     @pytest.mark.parametrize('value', [random.random()])
@@ -179,6 +225,125 @@ class TestLibratoReporter(object):
             for i in range(len(names))
         ])
 
+    def test_asynchronous(
+            self, mock_librato, librato_reporter_factory, metric_name):
+        submitter = mock.Mock(spec=BackgroundSubmitter)
+        reporter = librato_reporter_factory(submitter=submitter)
+        queue = reporter.librato_api.new_queue.return_value
+        queue.chunks = [mock.sentinel.chunk]
+        queue.tagged_chunks = []
+        _metrics.new_gauge(metric_name).notify(1)
+        reporter(_reporter.get_metrics(None))
+        assert not queue.submit.called
+        submitter.submit.assert_called_once_with([mock.sentinel.chunk])
+
+    def test_asynchronous_default_submitter(self, librato_reporter_factory):
+        reporter = librato_reporter_factory(asynchronous=True, pool_size=2)
+        assert isinstance(reporter.submitter, BackgroundSubmitter)
+        batch_submitter = reporter.submitter.submitter
+        assert isinstance(batch_submitter, BatchSubmitter)
+        assert batch_submitter.pool_size == 2
+        assert batch_submitter.librato_api is reporter.librato_api
+
+    def test_spool_checkpoint(
+            self, mock_librato, librato_reporter_factory, tmpdir):
+        spool = Spool(str(tmpdir))
+        reporter = librato_reporter_factory(spool=spool)
+        assert reporter.submitter.spool is spool
+        reporter.submitter = mock.Mock(spec=BatchSubmitter)
+        _metrics.new_meter('requests').notify(5)
+        reporter(_reporter.get_metrics(None))
+        # A reporter created later by this process resumes from the counts
+        restored = librato_reporter_factory(spool=Spool(str(tmpdir)))
+        assert restored.delta_tracker.name_to_count == {'requests': 5}
+        # Unlike one in a restarted process, whose counts restarted
+        with mock.patch.object(ss_metrics.reporter, '_started', 0):
+            restarted = librato_reporter_factory(spool=Spool(str(tmpdir)))
+        assert restarted.delta_tracker.name_to_count == {}
+
+    def test_last_cycle(
+            self, mock_librato, librato_reporter, metric_name):
+        _metrics.new_meter(metric_name).notify(1)
+        assert librato_reporter.last_cycle is None
+        librato_reporter(_reporter.get_metrics(None))
+        assert isinstance(librato_reporter.last_cycle, CycleStats)
+        assert librato_reporter.last_cycle.measurements == 3
+        assert librato_reporter.last_cycle.duration >= 0
+        assert librato_reporter.delta_tracker.cycle == 1
+
+    def test_sweeps_idle_names(
+            self, mock_librato, librato_reporter, metric_name):
+        _metrics.new_gauge(metric_name).notify(1)
+        with mock.patch('ss_metrics.reporter.sweep_idle_names') as sweep:
+            librato_reporter(_reporter.get_metrics(None))
+        sweep.assert_called_once_with()
+
+    def test_plans_are_reused(
+            self, mock_librato, librato_reporter, metric_name):
+        _metrics.new_histogram(metric_name).notify(1.0)
+        librato_reporter(_reporter.get_metrics(None))
+        plan = librato_reporter.plans[(metric_name, 'histogram')]
+        with mock.patch.object(librato_reporter, 'make_plan') as make_plan:
+            librato_reporter(_reporter.get_metrics(None))
+        assert not make_plan.called
+        assert librato_reporter.plans[(metric_name, 'histogram')] is plan
+
+    def test_plans_are_evicted(
+            self, mock_librato, librato_reporter, metric_name):
+        _metrics.new_gauge(metric_name).notify(1)
+        librato_reporter(_reporter.get_metrics(None))
+        assert list(librato_reporter.plans) == [(metric_name, 'gauge')]
+        _metrics.delete_metric(metric_name)
+        _metrics.new_gauge('other').notify(1)
+        librato_reporter(_reporter.get_metrics(None))
+        assert list(librato_reporter.plans) == [('other', 'gauge')]
+
+    def test_plans_follow_metric_prefix(
+            self, mock_librato, librato_reporter, metric, metric_name):
+        _metrics.new_gauge(metric_name).notify(1)
+        librato_reporter(_reporter.get_metrics(None))
+        librato_reporter.metric_prefix = 'renamed'
+        librato_reporter.librato_api.new_queue.reset_mock()
+        self.metric_submission_test(librato_reporter, [
+            metric('.'.join(('renamed', metric_name)), 1)
+        ])
+
+    def test_changed_only(
+            self, mock_librato, librato_reporter_factory, metric,
+            metric_name):
+        reporter = librato_reporter_factory(changed_only=True, keepalive=2)
+        assert isinstance(reporter.delta_tracker, ChangeTracker)
+        gauge = _metrics.new_gauge(metric_name)
+        gauge.notify(1)
+        self.metric_submission_test(reporter, [metric(metric_name, 1)])
+        assert reporter.last_cycle.measurements == 1
+        reporter.librato_api.new_queue.reset_mock()
+        self.metric_submission_test(reporter, [])
+        assert reporter.last_cycle.measurements == 0
+        reporter.librato_api.new_queue.reset_mock()
+        # Keepalive
+        self.metric_submission_test(reporter, [metric(metric_name, 1)])
+        reporter.librato_api.new_queue.reset_mock()
+        gauge.notify(2)
+        self.metric_submission_test(reporter, [metric(metric_name, 2)])
+
+    def test_changed_only_meter_counts(
+            self, mock_librato, librato_reporter_factory, metric_name):
+        reporter = librato_reporter_factory(changed_only=True, keepalive=10)
+        meter = _metrics.new_meter(metric_name)
+        queue = reporter.librato_api.new_queue.return_value
+        queue.__enter__.return_value = queue
+        counts = []
+        for increment in (5, 5, 5, 0, 0):
+            meter.notify(increment)
+            queue.add.reset_mock()
+            reporter(_reporter.get_metrics(None))
+            counts.extend(
+                args[1] for args, _ in queue.add.call_args_list
+                if args[0].endswith('.count'))
+        # A repeated change is still reported, an unchanged count is not
+        assert counts == [5, 5, 5, 0]
+
     def metric_submission_test(
             self, librato_reporter, submitted_metrics, input_metrics=None):
         new_queue = librato_reporter.librato_api.new_queue
@@ -216,3 +381,242 @@ class TestLibratoReporter(object):
             return ((name, value), properties)
 
         return make_metric
+
+
+class TestBackgroundSubmitter(object):
+    def test_submit(self, stub_librato_server, stub_librato_api):
+        submitter = BackgroundSubmitter(stub_librato_api)
+        chunks = [{'gauges': [{'name': 'a', 'value': i}], 'counters': []}
+                  for i in range(3)]
+        submitter.submit(chunks[:2])
+        submitter.submit(chunks[2:])
+        submitter.join()
+        submitter.close()
+        requests = stub_librato_server.requests
+        assert [body for _, _, body in requests] == [
+            {'gauges': chunks[0]['gauges'] + chunks[1]['gauges']},
+            {'gauges': chunks[2]['gauges']},
+        ]
+        assert all(path == '/v1/metrics' for _, path, _ in requests)
+        # All payloads share a single kept-alive connection
+        assert len(set(address for address, _, _ in requests)) == 1
+
+    def test_delegates_to_submitter(self, stub_librato_api):
+        batch_submitter = mock.Mock(spec=BatchSubmitter)
+        submitter = BackgroundSubmitter(
+            stub_librato_api, submitter=batch_submitter)
+        submitter.submit(mock.sentinel.chunks)
+        submitter.close()
+        batch_submitter.submit.assert_called_once_with(mock.sentinel.chunks)
+        batch_submitter.close.assert_called_once_with()
+
+    def test_invalid_overflow_policy(self, stub_librato_api):
+        with pytest.raises(ValueError):
+            BackgroundSubmitter(stub_librato_api, overflow_policy='explode')
+
+    @pytest.mark.parametrize('policy,expected', [
+        (DROP_NEWEST, [0, 1]),
+        (DROP_OLDEST, [1, 2]),
+        (BLOCK, [0, 1]),
+    ])
+    def test_overflow_policy(
+            self, mock_logger, stub_librato_api, policy, expected):
+        submitter = BackgroundSubmitter(
+            stub_librato_api, max_pending=2, overflow_policy=policy,
+            block_timeout=0.01)
+        # Keep the worker from consuming the queue
+        submitter.thread = mock.Mock()
+        for i in range(3):
+            submitter.submit(i)
+        assert submitter.dropped == 1
+        assert list(submitter.queue.queue) == expected
+
+
+def test_keep_alive_connection_reconnects(
+        stub_librato_server, stub_librato_api):
+    connection = KeepAliveConnection(stub_librato_api)
+    chunk = {'gauges': [], 'counters': []}
+    assert connection.post(chunk) == 200
+    connection.connection.sock.close()
+    assert connection.post(chunk) == 200
+    connection.close()
+    assert len(stub_librato_server.requests) == 2
+
+
+class TestBatchSubmitter(object):
+    @pytest.fixture
+    def chunks(self):
+        return [
+            {'gauges': [{'name': 'g', 'value': i} for i in range(5)],
+             'counters': [{'name': 'c', 'value': i} for i in range(2)]},
+            {'gauges': [{'name': 'g', 'value': 5}], 'counters': []},
+        ]
+
+    def test_batches(self, stub_librato_api, chunks):
+        submitter = BatchSubmitter(stub_librato_api, batch_size=4)
+        batches = list(submitter.batches(chunks))
+        assert [len(batch.get('gauges', batch.get('counters')))
+                for batch in batches] == [4, 2, 2]
+        assert batches[2] == {'counters': chunks[0]['counters']}
+
+    @pytest.mark.parametrize('pool_size', [1, 3])
+    def test_submit(
+            self, stub_librato_server, stub_librato_api, chunks, pool_size):
+        submitter = BatchSubmitter(
+            stub_librato_api, batch_size=2, pool_size=pool_size)
+        assert submitter.submit(chunks) == 8
+        assert submitter.submit(chunks) == 8
+        submitter.close()
+        requests = stub_librato_server.requests
+        assert len(requests) == 8
+        # Connections are kept alive across submissions
+        assert len(set(address for address, _, _ in requests)) <= pool_size
+
+    def test_retries_failed_batch(
+            self, stub_librato_server, stub_librato_api, chunks):
+        stub_librato_server.statuses = [503, 500]
+        submitter = BatchSubmitter(
+            stub_librato_api, batch_size=10, backoff=0)
+        assert submitter.submit(chunks) == 8
+        assert len(stub_librato_server.requests) == 4
+        assert submitter.failed_batches == 0
+
+    def test_gives_up_on_batch(
+            self, stub_librato_server, stub_librato_api, chunks):
+        stub_librato_server.statuses = [500, 500]
+        submitter = BatchSubmitter(
+            stub_librato_api, batch_size=10, max_retries=1, backoff=0)
+        # Only the batch of counters is sent
+        assert submitter.submit(chunks) == 2
+        assert submitter.failed_batches == 1
+
+    def test_rejected_batch_is_not_retried(
+            self, stub_librato_server, stub_librato_api, chunks, mock_logger):
+        stub_librato_server.statuses = [400]
+        submitter = BatchSubmitter(stub_librato_api, batch_size=10)
+        assert submitter.submit(chunks) == 2
+        assert len(stub_librato_server.requests) == 2
+        assert mock_logger.error.call_count == 1
+
+    def test_spools_failed_batch(
+            self, stub_librato_server, stub_librato_api, chunks, tmpdir):
+        spool = Spool(str(tmpdir))
+        stub_librato_server.statuses = [500, 500]
+        submitter = BatchSubmitter(
+            stub_librato_api, batch_size=10, max_retries=1, backoff=0,
+            spool=spool)
+        with mock.patch('time.time', return_value=1000.5):
+            assert submitter.submit(chunks) == 2
+        assert spool.pending == 1
+        # Replayed after the next successful submission, after its batches
+        assert submitter.submit(chunks) == 8
+        assert spool.pending == 0
+        requests = [body for _, _, body in stub_librato_server.requests]
+        assert requests[-1] == {
+            'gauges': chunks[0]['gauges'] + chunks[1]['gauges'],
+            'measure_time': 1000}
+        assert len(requests) == 6
+
+    def test_replay_stops_at_failure(
+            self, stub_librato_server, stub_librato_api, tmpdir):
+        spool = Spool(str(tmpdir))
+        spool.append([{'gauges': [{'name': 'a', 'value': 1}]}])
+        spool.append([{'gauges': [{'name': 'b', 'value': 1}]},
+                      {'gauges': [{'name': 'c', 'value': 1}]}])
+        stub_librato_server.statuses = [200, 400, 503]
+        submitter = BatchSubmitter(
+            stub_librato_api, batch_size=10, spool=spool)
+        # The rejected batch is dropped, while the failed one is kept
+        assert submitter.replay() == 1
+        assert spool.pending == 1
+        assert submitter.replay() == 1
+        assert spool.pending == 0
+        names = [body['gauges'][0]['name']
+                 for _, _, body in stub_librato_server.requests]
+        assert names == ['a', 'b', 'c', 'c']
+
+    def test_replay_limit(
+            self, stub_librato_server, stub_librato_api, tmpdir):
+        spool = Spool(str(tmpdir))
+        spool.append([{'gauges': [{'name': name, 'value': 1}]}
+                      for name in 'abc'])
+        submitter = BatchSubmitter(
+            stub_librato_api, batch_size=10, spool=spool, max_replay=2)
+        assert submitter.replay() == 2
+        assert spool.pending == 1
+        assert submitter.replay() == 1
+        assert spool.pending == 0
+
+    def test_submits_tagged_measurements(
+            self, stub_librato_server, stub_librato_api):
+        chunks = [
+            {'gauges': [{'name': 'g', 'value': 1}], 'counters': []},
+            {'measurements': [{'name': 't', 'sum': 1, 'count': 1,
+                               'tags': {'region': 'eu'}}]},
+        ]
+        submitter = BatchSubmitter(stub_librato_api)
+        assert submitter.submit(chunks) == 2
+        paths = sorted(path for _, path, _ in stub_librato_server.requests)
+        assert paths == ['/v1/measurements', '/v1/metrics']
+
+
+@pytest.mark.usefixtures('mock_metrics_registry')
+class TestSelfMetrics(object):
+    def test_disabled(self, mock_librato, librato_reporter):
+        _metrics.new_gauge('speed').notify(1)
+        librato_reporter(_reporter.get_metrics(None))
+        assert list(_metrics.REGISTRY) == ['speed']
+
+    def test_cycle(self, mock_librato, librato_reporter_factory):
+        reporter = librato_reporter_factory(self_metrics=True)
+        queue = reporter.librato_api.new_queue.return_value
+        queue.chunks = [{'gauges': [{'name': 'speed', 'value': 1}]}]
+        queue.tagged_chunks = []
+        _metrics.new_gauge('speed').notify(1)
+        reporter(_reporter.get_metrics(None))
+        assert _metrics.get('ss_metrics.librato.metrics')['value'] == 1
+        assert _metrics.get('ss_metrics.librato.measurements')['value'] == 1
+        assert _metrics.get('ss_metrics.librato.bytes_sent')['count'] == len(
+            json.dumps(queue.chunks[0]))
+        assert _metrics.get('ss_metrics.librato.submit_latency')['n'] == 1
+        # The reporter's own metrics are reported in the next cycle
+        queue.reset_mock()
+        reporter(_reporter.get_metrics(None))
+        names = set(call[1][0] for call in queue.add.mock_calls)
+        assert 'ss_metrics.librato.cycle_duration' in names
+
+    def test_submit_error(self, mock_librato, librato_reporter_factory):
+        reporter = librato_reporter_factory(self_metrics=True)
+        queue = reporter.librato_api.new_queue.return_value
+        queue.chunks = queue.tagged_chunks = []
+        queue.submit.side_effect = IOError
+        with pytest.raises(IOError):
+            reporter({})
+        assert _metrics.get('ss_metrics.librato.errors')['count'] == 1
+
+    def test_skipped_names(
+            self, mock_logger, mock_librato, librato_reporter_factory):
+        reporter = librato_reporter_factory(self_metrics=True)
+        queue = reporter.librato_api.new_queue.return_value
+        queue.chunks = queue.tagged_chunks = []
+        _metrics.new_gauge('x' * 256).notify(1)
+        reporter(_reporter.get_metrics(None))
+        assert _metrics.get('ss_metrics.librato.skipped_names')['count'] == 1
+
+    def test_failed_batches(
+            self, stub_librato_server, stub_librato_api):
+        stub_librato_server.statuses = [400]
+        self_metrics = SelfMetrics('test')
+        submitter = BatchSubmitter(stub_librato_api)
+        chunks = [{'gauges': [{'name': 'speed', 'value': 1}]}]
+        self_metrics.submit(
+            lambda: submitter.submit(chunks), chunks, submitter)
+        assert _metrics.get('ss_metrics.test.errors')['count'] == 1
+        submitter.close()
+
+    def test_asynchronous(self, librato_reporter_factory):
+        reporter = librato_reporter_factory(
+            asynchronous=True, self_metrics=True)
+        instrumented = reporter.submitter.submitter
+        assert isinstance(instrumented.submitter, BatchSubmitter)
+        assert instrumented.self_metrics is reporter.self_metrics
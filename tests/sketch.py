@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division
+
+import random
+
+import pytest
+
+from ss_metrics.sketch import PERCENTILE_LEVELS, DDSketch, SketchHistogram
+
+
+def exact_quantile(values, q):
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+def assert_within(expected, actual, relative_accuracy):
+    assert abs(actual - expected) <= relative_accuracy * abs(expected) + 1e-12
+
+
+@pytest.fixture
+def rng():
+    return random.Random(42)
+
+
+class TestDDSketch(object):
+    @pytest.mark.parametrize('distribution', [
+        lambda rng: rng.uniform(0, 1000),
+        lambda rng: rng.lognormvariate(0, 2),
+        lambda rng: rng.uniform(-10, 10),
+        lambda rng: rng.expovariate(1) * -1,
+    ])
+    def test_quantiles_are_within_relative_accuracy(self, rng, distribution):
+        sketch = DDSketch(relative_accuracy=0.02)
+        values = [distribution(rng) for _ in range(5000)]
+        for value in values:
+            sketch.add(value)
+        qs = [0, 0.25, 0.5, 0.9, 0.99, 1]
+        for q, actual in zip(qs, sketch.quantiles(qs)):
+            assert_within(exact_quantile(values, q), actual, 0.02)
+            assert actual == sketch.quantile(q)
+        assert sketch.count == len(values)
+        assert sketch.min == min(values)
+        assert sketch.max == max(values)
+        assert sketch.sum == pytest.approx(sum(values))
+
+    def test_zero(self):
+        sketch = DDSketch()
+        for value in (-1, 0, 0, 0, 1):
+            sketch.add(value)
+        assert sketch.quantile(0.5) == 0
+        assert_within(-1, sketch.quantile(0), 0.01)
+        assert_within(1, sketch.quantile(1), 0.01)
+
+    def test_empty(self):
+        sketch = DDSketch()
+        assert sketch.quantile(0.5) == 0
+        assert sketch.quantiles([0.5, 0.9]) == [0, 0]
+
+    def test_merge(self, rng):
+        merged, left, right = DDSketch(), DDSketch(), DDSketch()
+        for _ in range(1000):
+            value = rng.uniform(0, 100)
+            merged.add(value)
+            (left if rng.random() < 0.5 else right).add(value)
+        left.merge(right)
+        assert left.positive == merged.positive
+        assert left.count == merged.count
+        assert (left.min, left.max) == (merged.min, merged.max)
+
+    def test_merge_requires_same_parameters(self):
+        with pytest.raises(ValueError):
+            DDSketch(0.01).merge(DDSketch(0.02))
+
+    def test_max_bins(self, rng):
+        sketch = DDSketch(relative_accuracy=0.01, max_bins=64)
+        values = [10 ** rng.uniform(-6, 6) for _ in range(5000)]
+        for value in values:
+            sketch.add(value)
+        assert len(sketch.positive) <= 64
+        # Only the lowest quantiles lose accuracy
+        assert_within(
+            exact_quantile(values, 0.99), sketch.quantile(0.99), 0.01)
+
+    @pytest.mark.parametrize('relative_accuracy', [0, 1])
+    def test_invalid_relative_accuracy(self, relative_accuracy):
+        with pytest.raises(ValueError):
+            DDSketch(relative_accuracy)
+
+
+class TestSketchHistogram(object):
+    def test_get(self):
+        histogram = SketchHistogram()
+        for value in range(1, 101):
+            histogram.notify(value)
+        info = histogram.get()
+        assert info['kind'] == 'histogram'
+        assert info['n'] == 100
+        assert (info['min'], info['max']) == (1, 100)
+        assert info['arithmetic_mean'] == 50.5
+        levels = [level for level, _ in info['percentile']]
+        assert levels == list(PERCENTILE_LEVELS)
+        assert_within(50, dict(info['percentile'])[50], 0.01)
+        assert info['median'] == dict(info['percentile'])[50]
+
+    def test_get_empty(self):
+        info = SketchHistogram().get()
+        assert info['n'] == 0
+        assert info['min'] == info['max'] == 0
+        assert info['arithmetic_mean'] == 0
+
+    def test_merge(self):
+        histogram, sketch = SketchHistogram(), DDSketch()
+        histogram.notify(1)
+        sketch.add(2)
+        histogram.merge(sketch)
+        assert histogram.raw_data().count == 2
@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+
+import math
+
+import mock
+import pytest
+
+from ss_metrics import snapshot
+from ss_metrics.reporter import LibratoReporter
+
+METRICS = {
+    'speed': {'kind': 'gauge', 'value': 2.5},
+    'jobs': {'kind': 'counter', 'value': 3},
+    'requests': {
+        'kind': 'meter', 'count': 12, 'mean': 1.5, 'one': 1.0, 'five': 0.5,
+        'fifteen': 0.25, 'day': 0.125},
+    'latency;method=GET': {
+        'kind': 'histogram', 'n': 4, 'min': 1.0, 'max': 4.0,
+        'arithmetic_mean': 2.5, 'median': 2.5, 'variance': 1.25,
+        'percentile': [
+            (50, 2.0), (75, 3.0), (90, 4.0), (95, 4.0), (99, 4.0),
+            (99.9, 4.0)]},
+}
+
+
+def expected_info(name):
+    info = dict(METRICS[name])
+    info.pop('variance', None)
+    return info
+
+
+class TestSnapshot(object):
+    def test_round_trip(self):
+        loaded = snapshot.Snapshot(snapshot.dumps(METRICS, timestamp=100.0))
+        assert loaded.timestamp == 100.0
+        assert sorted(loaded) == sorted(METRICS)
+        for name in METRICS:
+            assert loaded[name] == expected_info(name)
+        assert loaded.kind(loaded.find('requests')) == 'meter'
+
+    def test_columns(self):
+        loaded = snapshot.Snapshot(snapshot.dumps(METRICS))
+        assert list(loaded.levels) == list(snapshot.PERCENTILE_LEVELS)
+        slot = loaded.slots[loaded.find('requests')]
+        assert loaded.meter_counts[slot] == 12
+        assert list(loaded.rates[slot * 5:slot * 5 + 5]) == [
+            1.5, 1.0, 0.5, 0.25, 0.125]
+        slot = loaded.slots[loaded.find('latency;method=GET')]
+        assert loaded.counts[slot] == 4
+
+    def test_missing_percentiles(self):
+        loaded = snapshot.Snapshot(snapshot.dumps({'latency': {
+            'kind': 'histogram', 'n': 1, 'min': 1.0, 'max': 1.0,
+            'arithmetic_mean': 1.0, 'median': 1.0,
+            'percentile': [(50, 1.0)]}}))
+        assert loaded['latency']['percentile'] == [(50, 1.0)]
+        assert math.isnan(loaded.percentiles[1])
+
+    def test_skipped_metrics(self):
+        loaded = snapshot.Snapshot(snapshot.dumps({
+            'status': {'kind': 'gauge', 'value': 'healthy'},
+            'unset': {'kind': 'gauge', 'value': None},
+            'other': {'kind': 'unknown'},
+        }))
+        assert len(loaded) == 0
+
+    def test_dump_and_load(self, tmpdir):
+        path = str(tmpdir.join('metrics.snapshot'))
+        snapshot.dump(path, METRICS)
+        loaded = snapshot.load(path)
+        assert loaded['requests'] == expected_info('requests')
+        loaded.release()
+        assert loaded.mapped is None
+
+    def test_names(self):
+        metrics = {u'caf\xe9': METRICS['speed'], 'jobs': METRICS['jobs']}
+        loaded = snapshot.Snapshot(snapshot.dumps(metrics))
+        assert list(loaded) == [u'caf\xe9', 'jobs']
+        assert loaded[u'caf\xe9'] == expected_info('speed')
+        with pytest.raises(KeyError):
+            loaded['missing']
+        assert 'missing' not in loaded
+
+    def test_without_zero_copy(self, tmpdir):
+        path = str(tmpdir.join('metrics.snapshot'))
+        snapshot.dump(path, METRICS)
+        # As on Python 2, where mmaps are read through slices
+        with mock.patch.object(snapshot, '_ZERO_COPY', False):
+            loaded = snapshot.load(path)
+            assert sorted(loaded) == sorted(METRICS)
+            for name in METRICS:
+                assert loaded[name] == expected_info(name)
+            loaded.release()
+
+    def test_registry(self, mock_metrics_registry):
+        from ss_metrics import metrics
+        metrics.inc_meter('requests', 2)
+        assert snapshot.Snapshot(snapshot.dumps())['requests']['count'] == 2
+
+    @pytest.mark.parametrize('data,message', [
+        (b'SSMS', 'truncated'),
+        (b'XXXX' + snapshot.dumps({})[4:], 'Not a metrics snapshot'),
+        (snapshot.dumps({})[:4] + b'\x09\x00' + snapshot.dumps({})[6:],
+         'version'),
+        (snapshot.dumps(METRICS)[:-16], 'truncated'),
+    ])
+    def test_invalid(self, data, message):
+        with pytest.raises(ValueError) as info:
+            snapshot.Snapshot(data)
+        assert message in str(info.value)
+
+    def test_consumed_by_reporters(self):
+        def measurements(metrics):
+            q = mock.Mock()
+            q.tagged_chunks = []
+            reporter = LibratoReporter('user@example.com', 'token')
+            reporter.add_measurements(q, metrics)
+            return sorted(q.add.call_args_list, key=repr)
+
+        loaded = snapshot.Snapshot(snapshot.dumps(METRICS))
+        assert measurements(loaded) == measurements(METRICS)
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import binascii
+import os
+
+import mock
+import pytest
+
+from ss_metrics.spool import Spool
+
+
+def batch(name):
+    return {'gauges': [{'name': name, 'value': 1}]}
+
+
+def incompressible_batch(name):
+    padding = binascii.hexlify(os.urandom(256)).decode('ascii')
+    return {'gauges': [{'name': name, 'value': 1, 'padding': padding}]}
+
+
+def replay_all(spool, limit=None):
+    replayed = []
+    spool.replay(lambda batch: replayed.append(batch) or True, limit)
+    return [batch['gauges'][0]['name'] for batch in replayed]
+
+
+@pytest.fixture
+def directory(tmpdir):
+    return str(tmpdir.join('spool'))
+
+
+def test_replays_in_order(directory):
+    spool = Spool(directory)
+    spool.append([batch('a'), batch('b')])
+    spool.append([])
+    spool.append([batch('c')])
+    assert spool.pending == 3
+    assert replay_all(spool) == ['a', 'b', 'c']
+    assert spool.pending == 0
+    assert os.listdir(directory) == []
+
+
+def test_survives_restart(directory):
+    Spool(directory).append([batch('a'), batch('b')])
+    spool = Spool(directory)
+    assert spool.pending == 2
+    spool.append([batch('c')])
+    assert replay_all(Spool(directory)) == ['a', 'b', 'c']
+
+
+def test_keeps_batches_left(directory):
+    spool = Spool(directory)
+    spool.append([batch('a'), batch('b'), batch('c')])
+    send = mock.Mock(side_effect=[True, False])
+    assert spool.replay(send) == 1
+    assert spool.pending == 2
+    assert replay_all(Spool(directory)) == ['b', 'c']
+
+
+def test_replay_limit(directory):
+    spool = Spool(directory)
+    spool.append([batch('a'), batch('b')])
+    spool.append([batch('c')])
+    assert replay_all(spool, 1) == ['a']
+    assert replay_all(spool, 5) == ['b', 'c']
+
+
+def test_compacts_oldest_segments(directory):
+    spool = Spool(directory, compact_after=3)
+    for name in 'abcd':
+        spool.append([batch(name)])
+    assert len(os.listdir(directory)) == 2
+    assert spool.pending == 4
+    spool.append([batch('e')])
+    assert replay_all(Spool(directory)) == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_interrupted_compaction(directory):
+    spool = Spool(directory, compact_after=2)
+    for name in 'abc':
+        spool.append([batch(name)])
+    # Left behind if compaction stopped before removing merged segments
+    leftover = spool._write(1, 1, [batch('b')])
+    spool = Spool(directory)
+    assert not os.path.exists(leftover.path)
+    assert replay_all(spool) == ['a', 'b', 'c']
+
+
+def test_drops_oldest_when_full(directory):
+    spool = Spool(directory, max_bytes=1)
+    spool.append([batch('a')])
+    assert spool.pending == 0
+    assert spool.dropped == 1
+
+
+def test_drops_oldest_batches_of_compacted_segment(directory):
+    spool = Spool(directory, compact_after=4)
+    names = ['{:02d}'.format(index) for index in range(40)]
+    for name in names[:30]:
+        spool.append([incompressible_batch(name)])
+    spool.max_bytes = sum(segment.size for segment in spool.segments)
+    for name in names[30:]:
+        spool.append([incompressible_batch(name)])
+    replayed = replay_all(Spool(directory))
+    # Only about as many batches as were added beyond the cap are dropped
+    assert replayed == names[-len(replayed):]
+    assert len(replayed) >= 25
+    assert spool.dropped == len(names) - len(replayed)
+
+
+def test_checkpoint(directory):
+    spool = Spool(directory)
+    assert spool.load_checkpoint() is None
+    spool.save_checkpoint({'counts': {'requests': 3}})
+    spool.save_checkpoint({'counts': {'requests': 5}})
+    assert Spool(directory).load_checkpoint() == {'counts': {'requests': 5}}
+    assert spool.pending == 0
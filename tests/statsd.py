@@ -0,0 +1,203 @@
+from __future__ import absolute_import
+
+import socket
+
+import appmetrics.metrics as _metrics
+import mock
+import pytest
+
+from ss_metrics import metrics
+from ss_metrics.statsd import (
+    Packets, StatsdClient, StatsdReporter, format_name, format_value)
+
+
+class StatsdListener(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(1)
+        self.host, self.port = self.sock.getsockname()
+
+    def receive(self):
+        return self.sock.recv(65536)
+
+    def lines(self, datagrams):
+        return [
+            line
+            for _ in range(datagrams)
+            for line in self.receive().decode().split('\n')]
+
+    def assert_empty(self):
+        self.sock.settimeout(0.01)
+        with pytest.raises(socket.timeout):
+            self.receive()
+
+
+@pytest.yield_fixture
+def listener():
+    listener = StatsdListener()
+    yield listener
+    listener.sock.close()
+
+
+@pytest.yield_fixture
+def reporter(listener):
+    reporter = StatsdReporter(listener.host, listener.port)
+    yield reporter
+    reporter.close()
+
+
+@pytest.yield_fixture
+def client(listener):
+    client = StatsdClient(listener.host, listener.port)
+    metrics.set_forwarder(client)
+    yield client
+    metrics.set_forwarder(None)
+    client.close()
+
+
+@pytest.mark.parametrize('value,expected', [
+    (1, b'1'), (2.5, b'2.5'), (True, None), ('fast', None), (None, None)])
+def test_format_value(value, expected):
+    assert format_value(value) == expected
+
+
+def test_format_name():
+    assert format_name('a:b|c@d#e,f g.h') == 'a_b_c_d_e_f_g.h'
+
+
+def test_packets():
+    packets = Packets(max_size=10)
+    for line in (b'abcd', b'efgh', b'ij', b'klmnopqrstuv', b'w'):
+        packets.add(line)
+    assert packets.drain() == [b'abcd\nefgh', b'ij', b'klmnopqrstuv', b'w']
+    assert packets.drain() == []
+
+
+@pytest.mark.usefixtures('mock_metrics_registry')
+class TestStatsdReporter(object):
+    def test_report(self, reporter, listener):
+        _metrics.new_gauge('speed').notify(2.5)
+        _metrics.new_gauge('status').notify('healthy')
+        _metrics.new_meter('requests').notify(3)
+        _metrics.new_histogram('latency').notify(1)
+        reporter(_metrics.metrics_by_name_list(_metrics.metrics()))
+        lines = listener.lines(1)
+        assert 'speed:2.5|g' in lines
+        assert not [line for line in lines if line.startswith('status')]
+        assert 'requests.count:3|c' in lines
+        assert 'requests.1m:0.0|g' in lines
+        assert 'latency.count:1|g' in lines
+        assert 'latency.sum:1.0|g' in lines
+        assert 'latency.99.9:1.0|g' in lines
+        assert reporter.last_cycle.measurements == 12
+
+        _metrics.metric('requests').notify(2)
+        reporter({'requests': _metrics.get('requests')})
+        assert 'requests.count:2|c' in listener.lines(1)
+
+    def test_packet_size(self, listener):
+        reporter = StatsdReporter(
+            listener.host, listener.port, max_packet_size=100)
+        for index in range(20):
+            _metrics.new_gauge('gauge.{}'.format(index)).notify(index)
+        reporter(_metrics.metrics_by_name_list(_metrics.metrics()))
+        lines = []
+        while len(lines) < 20:
+            datagram = listener.receive()
+            assert len(datagram) <= 100
+            lines.extend(datagram.decode().split('\n'))
+        assert sorted(lines) == sorted(
+            'gauge.{0}:{0}|g'.format(index) for index in range(20))
+        reporter.close()
+
+    def test_prefix_and_tags(self, listener):
+        reporter = StatsdReporter(
+            listener.host, listener.port, metric_prefix='ns',
+            tags=['env:test', 'canary'])
+        _metrics.new_gauge('speed').notify(1)
+        reporter(_metrics.metrics_by_name_list(_metrics.metrics()))
+        assert listener.lines(1) == ['ns.speed:1|g|#env:test,canary']
+        reporter.close()
+
+    def test_series_tags(self, listener):
+        reporter = StatsdReporter(
+            listener.host, listener.port, tags=['env:test'])
+        metrics.gauge('speed', 1, tags={'region': 'eu'})
+        metrics.inc_meter('requests', tags={'region': 'eu'})
+        reporter(_metrics.metrics_by_name_list(_metrics.metrics()))
+        lines = listener.lines(1)
+        assert 'speed:1|g|#env:test,region:eu' in lines
+        assert 'requests.count:1|c|#env:test,region:eu' in lines
+        reporter.close()
+
+    def test_send_failure(self, reporter):
+        _metrics.new_gauge('speed').notify(1)
+        with mock.patch('socket.socket') as mock_socket:
+            mock_socket.return_value.send.side_effect = socket.error
+            reporter(_metrics.metrics_by_name_list(_metrics.metrics()))
+        assert reporter.dropped == 1
+
+
+@pytest.mark.usefixtures('mock_metrics_registry')
+class TestStatsdClient(object):
+    def test_emits_updates(self, client, listener):
+        metrics.inc_meter('requests', 2)
+        metrics.gauge('speed', 1.5)
+        metrics.update_histogram('latency', 3)
+        assert listener.lines(3) == [
+            'requests:2|c', 'speed:1.5|g', 'latency:3|h']
+        assert len(_metrics.REGISTRY) == 0
+
+    def test_decorated(self, client, listener):
+        @metrics.with_meter
+        def metered_fn():
+            pass
+
+        metered_fn()
+        line, = listener.lines(1)
+        assert line.endswith('.metered_fn.rate:1|c')
+
+    def test_connects_once(self):
+        client = StatsdClient('localhost', 8125)
+        with mock.patch('socket.socket') as mock_socket:
+            client.send('meter', 'requests', 1)
+            client.send('meter', 'requests', 1)
+        sock = mock_socket.return_value
+        sock.connect.assert_called_once_with(('localhost', 8125))
+        assert sock.send.call_count == 2
+        assert not sock.sendto.called
+
+    def test_unresolvable_address(self):
+        client = StatsdClient('localhost', 8125)
+        with mock.patch('socket.socket') as mock_socket:
+            mock_socket.return_value.connect.side_effect = socket.gaierror
+            client.send('meter', 'requests', 1)
+            client.send('meter', 'requests', 1)
+        # Connecting is retried with the next datagram
+        assert mock_socket.return_value.connect.call_count == 2
+        assert client.dropped == 2
+
+    def test_timer_in_seconds(self, client, listener):
+        with mock.patch.object(metrics, '_clock_ns',
+                               side_effect=[0, 12 * 10**6]):
+            with metrics.timer('query'):
+                pass
+        assert listener.lines(1) == ['query:0.012|h']
+
+    def test_series_tags(self, client, listener):
+        metrics.inc_meter('requests', tags={'region': 'eu'})
+        assert listener.lines(1) == ['requests:1|c|#region:eu']
+
+    def test_coalesces_until_max_delay(self, listener):
+        client = StatsdClient(listener.host, listener.port, max_delay=60)
+        client.send('meter', 'requests', 1)
+        client.send('gauge', 'speed', 2)
+        listener.assert_empty()
+        client.flush()
+        assert listener.lines(1) == ['requests:1|c', 'speed:2|g']
+        with mock.patch('time.time', side_effect=[0, 100]):
+            client.send('meter', 'requests', 1)
+            client.send('meter', 'requests', 1)
+        assert listener.lines(1) == ['requests:1|c', 'requests:1|c']
+        client.close()
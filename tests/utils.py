@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import functools
 import sys
 
 import pytest
@@ -11,6 +12,11 @@ def noop():
     pass
 
 
+class Handler(object):
+    def __call__(self):
+        pass
+
+
 class TestGetFunctionName(object):
     def test_function(self):
         assert get_function_name(noop) == 'tests.utils.noop'
@@ -48,6 +54,42 @@ class TestGetFunctionName(object):
         with pytest.raises(ValueError):
             get_function_name(type(self))
 
+    def test_partial(self):
+        assert get_function_name(functools.partial(noop)) == 'tests.utils.noop'
+        bound = functools.partial(type(self)().instance_method)
+        assert get_function_name(bound) == self.method_name('instance_method')
+
+    def test_callable_object(self):
+        assert get_function_name(Handler()) == 'tests.utils.Handler'
+
+    @pytest.mark.skipif(sys.version_info < (3, 5), reason='async def')
+    def test_coroutine_function(self):
+        namespace = {'__name__': 'tests.utils'}
+        exec('async def handle():\n    pass', namespace)
+        assert get_function_name(namespace['handle']) == 'tests.utils.handle'
+
+    def test_memoized(self):
+        def f():
+            pass
+
+        name = get_function_name(f)
+        f.__qualname__ = f.__name__ = 'g'
+        assert get_function_name(f) is name
+        instance = type(self)()
+        assert get_function_name(instance.instance_method) is (
+            get_function_name(type(self)().instance_method))
+
+    def test_failure_is_not_memoized(self):
+        def f():
+            pass
+
+        module = f.__module__
+        f.__module__ = None
+        with pytest.raises(ValueError):
+            get_function_name(f)
+        f.__module__ = module
+        assert get_function_name(f).endswith('.f')
+
     def unbound_method_test(self, method):
         expected = self.method_name(method)
         actual = get_function_name(getattr(type(self), method))